@@ -50,6 +50,7 @@ def parse(args=None):
         python3 -m CureIAM -n 
         python3 -m CureIAM -c CureIAM.yaml
         python3 -m CureIAM
+        python3 -m CureIAM --prune
 
     Zero or more config files are specified with the -c/--config option.
     The config files specified are merged with a built-in base config.
@@ -91,6 +92,11 @@ def parse(args=None):
     parser.add_argument('-p', '--print-base-config', action='store_true',
                         help='print base configuration')
 
+    parser.add_argument('--prune', action='store_true',
+                        help='prune old records from the stores of the '
+                             'audits as per their retention settings '
+                             'and exit')
+
     parser.add_argument('-v', '--version', action='version',
                         version='%(prog)s ' + CureIAM.__version__)
 
@@ -0,0 +1,140 @@
+"""Rate limiting helpers for calls to cloud APIs."""
+
+import multiprocessing
+import random
+import time
+
+from CureIAM.helpers import hlogging
+
+_log = hlogging.get_logger(__name__)
+
+# Indices of the values kept in the shared state array.
+_TOKENS, _LAST_REFILL, _RATE, _LAST_DECREASE = range(4)
+
+
+class TokenBucket:
+    """Adaptive token-bucket rate limiter.
+
+    The state of the bucket lives in shared memory guarded by a
+    :class:`multiprocessing.Lock`. Therefore a single bucket created
+    before forking worker processes limits all threads of all those
+    processes together.
+
+    The refill rate adapts to the observed errors in an additive
+    increase, multiplicative decrease fashion. Successful calls
+    reported with :meth:`succeeded` raise the rate linearly over time up
+    to ``qps``. Every throttled call reported with :meth:`throttled`
+    halves the rate down to ``min_qps``, at most once per second so
+    that a burst of concurrent errors counts as one signal.
+    """
+
+    def __init__(self, qps, burst=None, min_qps=None):
+        """Create an instance of :class:`TokenBucket`.
+
+        Arguments:
+            qps (float): Maximum number of calls per second.
+            burst (float): Maximum number of tokens the bucket holds,
+                i.e., calls allowed back to back after an idle period.
+                Defaults to ``qps``.
+            min_qps (float): Rate that the bucket never adapts below.
+                Defaults to a tenth of ``qps``.
+
+        """
+        self._max_qps = float(qps)
+        self._min_qps = float(min_qps if min_qps else qps / 10)
+        self._burst = float(burst if burst else max(qps, 1))
+
+        # Additive increase of the rate per second of successful calls,
+        # so that the rate recovers linearly from min_qps to qps in ten
+        # seconds. Each call adds its share, i.e., the increase divided
+        # by the current rate, since that many calls flow per second.
+        self._increase = (self._max_qps - self._min_qps) / 10
+
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.RawArray(
+            'd', [self._burst, time.monotonic(), self._max_qps, 0.0])
+
+    @property
+    def rate(self):
+        """float: Current refill rate in calls per second."""
+        with self._lock:
+            return self._state[_RATE]
+
+    def reserve(self, tokens=1):
+        """Take tokens from the bucket and return how long to wait.
+
+        The tokens are taken right away even if the bucket runs into
+        debt, so concurrent callers queue up behind each other instead
+        of racing for the next token.
+
+        Arguments:
+            tokens (int): Number of calls about to be made.
+
+        Returns:
+            float: Number of seconds the caller must wait before making
+                the calls.
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            rate = self._state[_RATE]
+            elapsed = now - self._state[_LAST_REFILL]
+            available = min(self._burst,
+                            self._state[_TOKENS] + elapsed * rate)
+            available -= tokens
+            self._state[_TOKENS] = available
+            self._state[_LAST_REFILL] = now
+        return max(0.0, -available / rate)
+
+    def acquire(self, tokens=1):
+        """Block until the calls may be made.
+
+        Arguments:
+            tokens (int): Number of calls about to be made.
+
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def succeeded(self):
+        """Report a successful call."""
+        with self._lock:
+            rate = self._state[_RATE]
+            self._state[_RATE] = min(self._max_qps,
+                                     rate + self._increase / rate)
+
+    def throttled(self):
+        """Report a call rejected due to quota or overload."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._state[_LAST_DECREASE] < 1:
+                return
+            rate = max(self._min_qps, self._state[_RATE] / 2)
+            self._state[_RATE] = rate
+            self._state[_LAST_DECREASE] = now
+        _log.warning('Rate limited; reduced rate to %.2f calls/s', rate)
+
+
+def backoff_delay(attempt, base_delay=1, max_delay=64):
+    """Return a randomized exponential backoff delay.
+
+    The delay is drawn uniformly between zero and the exponential
+    backoff for ``attempt`` (the so-called full jitter strategy), so
+    that workers throttled together do not retry together.
+
+    Example:
+        >>> from CureIAM.helpers import hratelimit
+        >>> 0 <= hratelimit.backoff_delay(3, 1, 64) <= 8
+        True
+
+    Arguments:
+        attempt (int): Number of attempts that failed so far minus one.
+        base_delay (float): Backoff for the first retry in seconds.
+        max_delay (float): Upper bound of the backoff in seconds.
+
+    Returns:
+        float: Number of seconds to wait before the next attempt.
+
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
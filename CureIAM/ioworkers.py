@@ -40,6 +40,12 @@ def run(input_func, output_func, processes=0, threads=0, log_tag=''):
     Yields:
         Each output value returned by ``output_func``.
 
+    Raises:
+        IOWorkerError: If ``input_func`` or any call of ``output_func``
+            failed. This is raised only after the output values of the
+            other work items have been yielded and all workers have
+            stopped.
+
     """
     if processes <= 0:
         processes = os.cpu_count()
@@ -62,21 +68,32 @@ def run(input_func, output_func, processes=0, threads=0, log_tag=''):
         w.start()
         process_workers.append(w)
 
-    # Get input data for thread workers to work on.
-    for args in input_func():
-        in_q.put(args)
+    # Get input data for thread workers to work on. The workers are
+    # told to stop even if the input fails, so that they never hang.
+    input_failed = False
+    try:
+        for args in input_func():
+            in_q.put(args)
+    except Exception as e:
+        _log.exception('%sFailed to get input; error: %s: %s',
+                       log_tag, type(e).__name__, e)
+        input_failed = True
 
     # Tell each thread worker that there is no more input to work on.
     for _ in range(processes * threads):
         in_q.put(None)
 
     # Consume output objects from thread workers and yield them.
-    yield from _get_output(out_q, processes, threads, log_tag)
+    failures = yield from _get_output(out_q, processes, threads, log_tag)
 
     # Wait for process workers to terminate.
     for w in process_workers:
         w.join()
 
+    if input_failed or failures:
+        raise IOWorkerError('{}Input failed: {}; failed work items: {}'
+                            .format(log_tag, input_failed, failures))
+
 def _process_worker(in_q, out_q, threads, output_func, log_tag):
     """Process worker."""
     thread_workers = []
@@ -102,11 +119,18 @@ def _thread_worker(in_q, out_q, output_func, log_tag):
         except Exception as e:
             _log.exception('thread_worker: %sFailed; error: %s: %s',
                            log_tag, type(e).__name__, e)
+            out_q.put(_WorkFailed())
 
 
 def _get_output(out_q, processes, threads, log_tag):
-    """Get output from output queue and yield them."""
+    """Get output from output queue and yield them.
+
+    Returns:
+        int: Number of work items that failed.
+
+    """
     stopped_threads = 0
+    failures = 0
     while True:
         try:
             record = out_q.get()
@@ -115,7 +139,20 @@ def _get_output(out_q, processes, threads, log_tag):
                 if stopped_threads == processes * threads:
                     break
                 continue
+            if isinstance(record, _WorkFailed):
+                failures += 1
+                continue
             yield record
         except Exception as e:
             _log.exception('%sFailed to get output; error: %s: %s',
                            log_tag, type(e).__name__, e)
+            failures += 1
+    return failures
+
+
+class _WorkFailed:
+    """Marker put into the output queue for a work item that failed."""
+
+
+class IOWorkerError(Exception):
+    """Represents a failure of the input or of a work item."""
@@ -9,6 +9,7 @@ subprocess.
 """
 
 import multiprocessing as mp
+import queue
 
 import copy
 import textwrap
@@ -23,15 +24,21 @@ import schedule
 """ . = CureIAM which is the current module, for now it changes, to remove any depedency name incase if there is any changes folder name in the future
 """
 import CureIAM
-from CureIAM import baseconfig, workers
+from CureIAM import baseconfig, transport, workers
 from CureIAM.helpers import hconfigs, hemails, hcmd
 from CureIAM.helpers.hconfigs import Config
+from CureIAM.plugins import util_plugins
+from CureIAM.plugins.gcp import gcpcache
 
 from CureIAM.helpers import hlogging
 # from CureIAM.helpers.hlogging import Logger
 
 _log = hlogging.get_logger(__name__)
 
+# Cloud plugin whose recommendation cache is promoted after a
+# successful audit, see :meth:`Audit._commit_clouds`.
+_GCP_CLOUD_PLUGIN = 'CureIAM.plugins.gcp.gcpcloud.GCPCloudIAMRecommendations'
+
 def main():
     """Run the framework based on the schedule."""
     # Configure the logger as the first thing as per the base
@@ -58,6 +65,10 @@ def main():
     # logging.config.dictConfig(config['logger'])
     _log.info('CureIAM %s; configured', CureIAM.__version__)
 
+    if args.prune:
+        _prune(config)
+        return
+
     # Finally, run the audits, either right now or as per a schedule,
     # depending on the command line options.
     if args.now:
@@ -99,6 +110,41 @@ def _run(config):
     _send_email(config.get('email'), 'all audits', start_time, end_time)
 
 
+def _prune(config):
+    """Prune old records from the stores of the audits.
+
+    Every store plugin of the audits configured to be run that has a
+    ``prune`` method is instantiated and its ``prune`` method is called.
+    The plugin is then released with its ``close`` method, if it has
+    one. Its ``done`` method is not called, since no records are
+    written and stores may prune in ``done`` as well, e.g., with the
+    ``prune_on_done`` parameter of the Elasticsearch store.
+
+    Arguments:
+        config (dict): Configuration dictionary.
+
+    """
+    for audit_key in config['run']:
+        for plugin_key in config['audits'][audit_key].get('stores', []):
+            plugin = None
+            try:
+                plugin = util_plugins.load(config['plugins'][plugin_key])
+                if not hasattr(plugin, 'prune'):
+                    continue
+                _log.info('Pruning store: %s', plugin_key)
+                plugin.prune()
+            except Exception as e:
+                _log.exception('Failed to prune store: %s; error: %s: %s',
+                               plugin_key, type(e).__name__, e)
+            finally:
+                if plugin is not None and hasattr(plugin, 'close'):
+                    try:
+                        plugin.close()
+                    except Exception as e:
+                        _log.error('Failed to close store: %s; error: '
+                                   '%s: %s', plugin_key, type(e).__name__, e)
+
+
 class Audit:
     """Audit manager.
 
@@ -143,11 +189,27 @@ class Audit:
         # We keep all queues in these lists.
         self._store_queues = []
         self._processor_queues = []
+        self._processor_input_queues = []
         self._alert_queues = []
 
+        # Records travel between workers in batches. A batch is sent
+        # once it holds queue_batch_size records or its oldest record
+        # is queue_linger seconds old.
+        queue_batch_size = audit_config.get('queue_batch_size', 100)
+        queue_linger = audit_config.get('queue_linger', 1.0)
+
+        def new_queue():
+            return transport.BatchQueue(queue_batch_size, queue_linger)
+
+        # Processors that implement eval_batch get up to eval_batch_size
+        # records at once, waiting at most eval_batch_wait seconds for a
+        # batch to fill up.
+        eval_batch_size = audit_config.get('eval_batch_size', 100)
+        eval_batch_wait = audit_config.get('eval_batch_wait', 0.1)
+
         # Create alert workers and queues.
         for plugin_key in audit_config.get('alerts', []):
-            input_queue = mp.Queue()
+            input_queue = new_queue()
             args = (
                 audit_key,
                 audit_version,
@@ -159,24 +221,62 @@ class Audit:
             self._alert_workers.append(worker)
             self._alert_queues.append(input_queue)
 
-        # Create processor_workers workers and queues.
+        # Create processor_workers workers and queues. A processor may
+        # run in several replica workers. By default, each replica has
+        # its own input queue and the records of a project always go to
+        # the same replica, so that the recommendations of a project are
+        # processed in order. With replica_partitioning set to shared,
+        # the replicas take records from one shared input queue instead.
+        replicas = audit_config.get('replicas', {})
+        replica_partitioning = audit_config.get('replica_partitioning',
+                                                'project')
+        if replica_partitioning not in ('project', 'shared'):
+            _log.error('Invalid replica_partitioning: %s; expected one of: '
+                       'project, shared; falling back to: project',
+                       replica_partitioning)
+            replica_partitioning = 'project'
+
+        # Processor workers send the statistics returned by the done()
+        # method of their plugins here, to be aggregated across replicas.
+        self._stats_queue = mp.Queue()
+        self.stats = {}
+
+        # Whether all workers succeeded; set by join().
+        self.succeeded = None
+
         for plugin_key in audit_config.get('processors', []):
-            input_queue = mp.Queue()
-            args = (
-                audit_key,
-                audit_version,
-                plugin_key,
-                config['plugins'][plugin_key],
-                input_queue,
-                self._store_queues,
-            )
-            worker = mp.Process(target=workers.processor_worker, args=args)
-            self._processor_workers.append(worker)
-            self._processor_queues.append(input_queue)
+            replica_count = max(int(replicas.get(plugin_key, 1)), 1)
+            if replica_count == 1:
+                input_queues = [new_queue()]
+                processor_queue = input_queues[0]
+            elif replica_partitioning == 'project':
+                input_queues = [new_queue() for _ in range(replica_count)]
+                processor_queue = transport.PartitionedQueue(input_queues)
+            else:
+                input_queues = [new_queue()] * replica_count
+                processor_queue = input_queues[0]
+
+            for input_queue in input_queues:
+                args = (
+                    audit_key,
+                    audit_version,
+                    plugin_key,
+                    config['plugins'][plugin_key],
+                    input_queue,
+                    self._store_queues,
+                    eval_batch_size,
+                    eval_batch_wait,
+                    self._stats_queue,
+                )
+                worker = mp.Process(target=workers.processor_worker,
+                                    args=args)
+                self._processor_workers.append(worker)
+                self._processor_input_queues.append(input_queue)
+            self._processor_queues.append(processor_queue)
 
         # Create store workers and queues.
         for plugin_key in audit_config.get('stores', []):
-            input_queue = mp.Queue()
+            input_queue = new_queue()
             args = (
                 audit_key,
                 audit_version,
@@ -238,14 +338,18 @@ class Audit:
         for w in self._cloud_workers:
             w.join()
 
-        # Stop processor workers.
-        for q in self._processor_queues:
+        # Stop processor workers. Each worker stops at the first None it
+        # gets, so a queue shared by several replicas gets one per
+        # replica.
+        for q in self._processor_input_queues:
             q.put(None)
 
         # Wait for processor workers to terminate.
         for w in self._processor_workers:
             w.join()
 
+        self._collect_stats()
+
         # Stop store workers.
         for q in self._store_queues:
             q.put(None)
@@ -262,6 +366,18 @@ class Audit:
         for w in self._alert_workers:
             w.join()
 
+        # Workers exit with a non-zero exit code if their plugin fails.
+        all_workers = (self._cloud_workers + self._processor_workers +
+                       self._store_workers + self._alert_workers)
+        failed = sum(1 for w in all_workers if w.exitcode != 0)
+        self.succeeded = failed == 0
+        if self.succeeded:
+            self._commit_clouds()
+        else:
+            _log.warning('%s: Audit failed; failed workers: %d; state of '
+                         'cloud plugins not committed', self._audit_key,
+                         failed)
+
         end_time = time.localtime()
         _send_email(self._config.get('email'), self._audit_key,
                     self._start_time, end_time)
@@ -272,6 +388,57 @@ class Audit:
         if self._audit_config.get('applyRecommendations', False):
             _log.info('Apply recommendations gracefully ...')
 
+    def _commit_clouds(self):
+        """Commit the state of the cloud plugins after a successful audit.
+
+        The recommendations staged in the cache of every
+        :class:`CureIAM.plugins.gcp.gcpcloud.GCPCloudIAMRecommendations`
+        cloud with a ``cache_path`` are promoted, since the cloud
+        workers have stopped by the time the audit is known to have
+        succeeded. Errors are logged.
+        """
+        for plugin_key in self._audit_config.get('clouds', []):
+            plugin_config = self._config['plugins'][plugin_key]
+            if plugin_config.get('plugin') != _GCP_CLOUD_PLUGIN:
+                continue
+            cache_path = plugin_config.get('params', {}).get('cache_path')
+            if not cache_path:
+                continue
+            try:
+                cache = gcpcache.RecommendationCache(cache_path)
+                count, pruned = cache.promote()
+                _log.info('%s_%s: Cached recommendations: %d; pruned: %d',
+                          self._audit_key, plugin_key, count, pruned)
+            except Exception as e:
+                _log.exception('%s_%s: Failed to commit; error: %s: %s',
+                               self._audit_key, plugin_key,
+                               type(e).__name__, e)
+
+    def _collect_stats(self):
+        """Aggregate and log the statistics of the processor workers.
+
+        Numeric statistics of the replicas of a processor are summed up.
+        Other values are collected into a list. The aggregated
+        statistics are kept in :attr:`stats` keyed by plugin key.
+        """
+        stats = {}
+        while True:
+            try:
+                plugin_key, plugin_stats = self._stats_queue.get_nowait()
+            except queue.Empty:
+                break
+            totals = stats.setdefault(plugin_key, {})
+            for name, value in plugin_stats.items():
+                if isinstance(value, (int, float)):
+                    totals[name] = totals.get(name, 0) + value
+                else:
+                    totals.setdefault(name, []).append(value)
+
+        for plugin_key, totals in stats.items():
+            _log.info('%s_%s: Stats: %s', self._audit_key, plugin_key,
+                      ', '.join('{}: {}'.format(name, value)
+                                for name, value in totals.items()))
+        self.stats = stats
 
 
 def _send_email(email_config, about, start_time, end_time=None):
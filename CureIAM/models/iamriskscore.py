@@ -1,10 +1,20 @@
 """ IAM Risk score model class implementation
 """
 
+import numpy as np
+
 from CureIAM.helpers import hlogging
 
 _log = hlogging.get_logger(__name__)
 
+# Base safe to apply score of each account type and the score added for
+# each suggestion type. Other values score 0 and 10 respectively.
+_SAFE_SCORE_ACCOUNT_TYPES = {'user': 60, 'group': 30}
+_SAFE_SCORE_SUGGESTION_TYPES = {'REMOVE_ROLE': 30, 'REPLACE_ROLE': 20}
+
+# Exponent of the risk score of each account type.
+_RISK_EXPONENTS = {'user': 2, 'group': 3, 'serviceAccount': 5}
+
 class IAMRiskScoreModel:
     """IAMRiskScoreModel plugin for GCP IAM Recommendation records."""
 
@@ -107,11 +117,7 @@ class IAMRiskScoreModel:
         # Based on the parameters above lets calculate risk_profile
         # Risk can be calculated as compound function ??
         # (1+r)^n 
-        n = {
-            'user': 2,
-            'group': 3,
-            'serviceAccount': 5
-        }
+        n = _RISK_EXPONENTS
         r = _excess_permissions / _total_permissions
         risk_score = r**n[_account_type] * 100
 
@@ -126,4 +132,96 @@ class IAMRiskScoreModel:
                 'over_privilege_score': round(_excess_permissions_percent * 100)
             }
         )
-        return self._score
\ No newline at end of file
+        return self._score
+
+    @staticmethod
+    def score_batch(records):
+        """Return the scores of a batch of records.
+
+        This is the vectorized equivalent of calling :meth:`score` for
+        each record, and returns identical scores.
+
+        Arguments:
+            records (list): Processed records, i.e., the dicts passed
+                to :class:`IAMRiskScoreModel`.
+
+        Returns:
+            list: A score dict for each record.
+
+        """
+        columns = score_columns(
+            [r['account_type'] for r in records],
+            [r['account_permission_insights_category'] for r in records],
+            [r['account_used_permissions'] for r in records],
+            [r['account_total_permissions'] for r in records])
+        safe_scores = columns['safe_to_apply_recommendation_score'].tolist()
+        risk_scores = columns['risk_score'].tolist()
+        over_privilege_scores = columns['over_privilege_score'].tolist()
+
+        return [
+            {
+                'safe_to_apply_recommendation_score': safe_score,
+                'safe_to_apply_recommendation_score_factors': 3,
+                'risk_score': risk_score,
+                'risk_score_factors': 2,
+                'over_privilege_score': over_privilege_score,
+            }
+            for safe_score, risk_score, over_privilege_score
+            in zip(safe_scores, risk_scores, over_privilege_scores)
+        ]
+
+
+def score_columns(account_types, suggestion_types, used_permissions,
+                  total_permissions):
+    """Compute the scores of a columnar batch of recommendations.
+
+    The scores are computed with the same floating point operations as
+    :meth:`IAMRiskScoreModel.score`, so that they are identical.
+    ``numpy.float_power`` is used for the risk score because it calls
+    the same ``pow()`` as Python, whereas ``numpy.power`` may use
+    vectorized approximations that differ in the last bit.
+
+    Arguments:
+        account_types (list): Account type of each recommendation.
+        suggestion_types (list): Suggestion type of each
+            recommendation.
+        used_permissions (list): Number of used permissions of each
+            recommendation.
+        total_permissions (list): Number of total permissions of each
+            recommendation, or ``None`` if unknown.
+
+    Returns:
+        dict: Arrays of integer ``safe_to_apply_recommendation_score``,
+            ``risk_score`` and ``over_privilege_score`` values.
+
+    Raises:
+        KeyError: If an account type has no risk score exponent.
+
+    """
+    used = np.array([int(u) for u in used_permissions], dtype=np.int64)
+    total = np.array([u + 1 if t is None else int(t)
+                      for u, t in zip(used.tolist(), total_permissions)],
+                     dtype=np.int64)
+
+    excess = np.maximum(total - used, 1)
+    total = np.maximum(total, 1)
+    excess_percent = excess / total
+
+    safe_score = np.array(
+        [_SAFE_SCORE_ACCOUNT_TYPES.get(a, 0) +
+         _SAFE_SCORE_SUGGESTION_TYPES.get(s, 10)
+         for a, s in zip(account_types, suggestion_types)],
+        dtype=np.float64) / excess_percent
+
+    exponents = np.array([_RISK_EXPONENTS[a] for a in account_types],
+                         dtype=np.float64)
+    risk_score = np.float_power(excess_percent, exponents) * 100
+
+    # numpy.rint rounds half to even like Python's round().
+    return {
+        'safe_to_apply_recommendation_score':
+            np.rint(safe_score).astype(np.int64),
+        'risk_score': np.rint(risk_score).astype(np.int64),
+        'over_privilege_score':
+            np.rint(excess_percent * 100).astype(np.int64),
+    }
@@ -1,14 +1,106 @@
 """Elasticsearch store plugin."""
 
-import json
+import concurrent.futures
 import datetime
+import hashlib
+import json
 
-from elasticsearch import Elasticsearch, ElasticsearchWarning
+from elasticsearch import Elasticsearch, helpers
 
 from CureIAM.helpers import hlogging
 
 _log = hlogging.get_logger(__name__)
 
+_DOC_ID_MODES = (None, 'version', 'latest')
+
+_INDEX_ROLLOVERS = (None, 'daily', 'ilm')
+
+_KEYWORD = {'type': 'keyword'}
+_INTEGER = {'type': 'integer'}
+_DATE = {'type': 'date'}
+_DISABLED = {'type': 'object', 'enabled': False}
+
+# Explicit mappings of the records of
+# :class:`CureIAM.plugins.gcp.gcpcloudiam.GCPIAMRecommendationProcessor`.
+# Fields not listed here are stored in the source of the documents but
+# not indexed, so that the nested GCP payloads cannot blow up the
+# mappings.
+_MAPPINGS = {
+    'dynamic': False,
+    'properties': {
+        'timestamp': _DATE,
+        'doc_hash': _KEYWORD,
+        'raw': _DISABLED,
+        'processor': {
+            'properties': {
+                'project': _KEYWORD,
+                'recommendation_id': _KEYWORD,
+                'recommendation_description': {
+                    'type': 'text',
+                    'fields': {'keyword': {'type': 'keyword',
+                                           'ignore_above': 256}},
+                },
+                'recommendation_actions': _DISABLED,
+                'recommendetion_recommender_subtype': _KEYWORD,
+                'recommendation_insights': _DISABLED,
+                'account_type': _KEYWORD,
+                'account_id': _KEYWORD,
+                'account_total_permissions': _INTEGER,
+                'account_used_permissions': _INTEGER,
+                'account_permission_insights_category': _KEYWORD,
+            },
+        },
+        'score': {
+            'properties': {
+                'safe_to_apply_recommendation_score': _INTEGER,
+                'safe_to_apply_recommendation_score_factors': _INTEGER,
+                'risk_score': _INTEGER,
+                'risk_score_factors': _INTEGER,
+                'over_privilege_score': _INTEGER,
+            },
+        },
+        'apply_recommendation': {
+            'properties': {
+                'recommendation_id': _KEYWORD,
+                'project_id': _KEYWORD,
+                'account_type': _KEYWORD,
+                'account_id': _KEYWORD,
+                'safe_to_apply_score': _INTEGER,
+                'recommendation_state': _KEYWORD,
+                'recommendation_applied_time': _DATE,
+            },
+        },
+        'com': {
+            'properties': {
+                key: _KEYWORD for key in (
+                    'audit_key', 'audit_version',
+                    'origin_key', 'origin_class', 'origin_worker',
+                    'origin_type', 'target_key', 'target_class',
+                    'target_worker', 'target_type',
+                )
+            },
+        },
+    },
+}
+
+# Painless script of upserts. A document is rewritten only if the hash
+# of its content has changed, so that unchanged records do not create
+# new versions of their documents. With params.touch, the timestamp and
+# com fields of unchanged documents are refreshed instead, so that
+# pruning by age or audit version does not delete current records.
+_UPSERT_SCRIPT = (
+    'if (ctx._source.doc_hash == params.doc_hash) { '
+    'if (params.touch) { ctx._source.timestamp = params.doc.timestamp; '
+    'ctx._source.com = params.doc.com } else { ctx.op = "none" } } '
+    'else { ctx._source.clear(); ctx._source.putAll(params.doc); '
+    'ctx._source.doc_hash = params.doc_hash }'
+)
+
+# Fields of a recommendation and of its insights that the Recommender
+# updates on every refresh, even if nothing else has changed. They are
+# left out of the hash of the content of a record for upserts.
+_VOLATILE_FIELDS = ('lastRefreshTime', 'etag')
+
 class EsStore:
     """Elasticsearch adapter to index cloud data in Elasticsearch."""
 
@@ -16,102 +108,401 @@ class EsStore:
                  username=None,
                  password=None,
                  scheme='http',
-                 buffer_size=5000000):
+                 buffer_size=5000000,
+                 chunk_size=500,
+                 thread_count=4,
+                 max_retries=3,
+                 initial_backoff=2,
+                 max_backoff=600,
+                 doc_id_mode=None,
+                 upsert=False,
+                 install_template=True,
+                 index_rollover=None,
+                 index_settings=None,
+                 ilm_rollover=None,
+                 retention_days=None,
+                 keep_audit_versions=None,
+                 prune_on_done=False,
+                 connections_per_node=None,
+                 http_compress=False,
+                 request_timeout=30,
+                 transport_max_retries=3,
+                 retry_on_timeout=True,
+                 sniff=False):
         """Create an instance of :class:`EsStore` plugin.
 
         The plugin uses the default port for Elasticsearch if not
         specified.
 
-        The ``buffer_size`` for the plugin is the value for the maximum
-        number of bytes of data to be sent in a bulk API request to
-        Elasticsearch.
+        Records are buffered in memory and sent to Elasticsearch with
+        the bulk API once ``chunk_size`` records or ``buffer_size``
+        bytes of data are buffered. Up to ``thread_count`` bulk API
+        requests are kept in flight concurrently. Records rejected
+        with HTTP status 429 because the cluster is overloaded are
+        retried with exponential backoff.
+
+        By default Elasticsearch assigns a new ID to every document, so
+        every run adds new documents. With ``doc_id_mode`` set to
+        ``version``, the ID of a document is derived from the name of
+        the recommendation and the audit version, so that re-running an
+        audit overwrites its own documents. With ``latest``, it is
+        derived from the name of the recommendation alone, so that the
+        index holds the latest state of each recommendation.
+
+        With ``upsert`` enabled, a document is rewritten only if the
+        content of its record has changed, ignoring the ``com`` and
+        ``timestamp`` fields as well as the ``lastRefreshTime`` and
+        ``etag`` fields of the recommendation and its insights, which
+        change whenever the Recommender refreshes them. A hash of the content is stored in the
+        ``doc_hash`` field of each document for this purpose. If
+        ``retention_days`` or ``keep_audit_versions`` is set, the
+        ``com`` and ``timestamp`` fields of unchanged documents are
+        still updated, so that pruning keeps them, and they are no
+        longer counted as unchanged.
+
+        An index template with explicit mappings is installed for the
+        index, so that scores can be aggregated and projects and
+        accounts filtered efficiently, while the ``raw`` GCP payload is
+        kept in the documents without being indexed. With
+        ``index_rollover`` set to ``daily``, records are written to one
+        index per day named like ``<index>-2023.05.01``. With ``ilm``,
+        an index lifecycle management policy rolls the indices over
+        and records are written through the ``index`` name as a write
+        alias of the current index. Note that with time based indices,
+        document IDs and upserts only deduplicate records within the
+        same index.
+
+        Old records are deleted by :meth:`prune`, which runs at the end
+        of every audit if ``prune_on_done`` is enabled, or on demand
+        with the ``--prune`` command line option. Records older than
+        ``retention_days`` are deleted by dropping whole daily indices,
+        by the delete phase of the lifecycle policy for ILM, or with a
+        delete by query otherwise. Records of audit versions other than
+        the latest ``keep_audit_versions`` ones are deleted with a
+        delete by query.
+
+        The client keeps a pool of persistent connections to each node,
+        so that the bulk API requests in flight reuse their sockets. The
+        client is closed by :meth:`done`, or by :meth:`close` if no
+        records are written, e.g., by ``--prune``.
 
         Arguments:
             host (str): Elasticsearch host
             port (int): Elasticsearch port
             index (str): Elasticsearch index
-            buffer_size (int): Maximum number of bytes of data to hold
-                in the in-memory buffer.
+            buffer_size (int): Maximum number of bytes of data to be
+                sent in a bulk API request.
+            chunk_size (int): Maximum number of records to be sent in a
+                bulk API request.
+            thread_count (int): Maximum number of bulk API requests in
+                flight.
+            max_retries (int): Maximum number of times a record rejected
+                with HTTP status 429 is retried.
+            initial_backoff (float): Number of seconds to wait before
+                the first retry. The wait doubles for every subsequent
+                retry.
+            max_backoff (float): Maximum number of seconds to wait
+                before a retry.
+            doc_id_mode (str): How document IDs are derived, either
+                ``version`` or ``latest``. Elasticsearch assigns random
+                IDs by default.
+            upsert (bool): Whether to skip rewriting documents whose
+                content has not changed. It requires a ``doc_id_mode``
+                and defaults it to ``latest``.
+            install_template (bool): Whether to install the index
+                template and, for ``ilm``, the lifecycle policy.
+            index_rollover (str): Either ``daily`` or ``ilm`` for time
+                based indices. A single index is used by default.
+            index_settings (dict): Additional index settings for the
+                index template, e.g., ``number_of_shards``.
+            ilm_rollover (dict): Rollover conditions of the lifecycle
+                policy. Defaults to a day or 50 GB per primary shard.
+            retention_days (int): Number of days records are kept for.
+            keep_audit_versions (int): Number of latest audit versions
+                whose records are kept.
+            prune_on_done (bool): Whether to prune old records when the
+                audit is done.
+            connections_per_node (int): Maximum number of connections
+                kept open to each node. Defaults to ``thread_count`` or
+                10, whichever is greater.
+            http_compress (bool): Whether to compress request bodies
+                with gzip. This saves bandwidth at the cost of some CPU
+                for the large bulk API requests.
+            request_timeout (float): Timeout of requests in seconds.
+            transport_max_retries (int): Maximum number of times a
+                request that failed with a connection error or timeout
+                is retried, possibly on another node.
+            retry_on_timeout (bool): Whether to retry requests that
+                timed out.
+            sniff (bool): Whether to discover the nodes of the cluster
+                on start and whenever a node fails, so that requests are
+                spread across all nodes.
 
         """
-
-        # _log.info('INIT INDEX ESSTORE')
+        client_options = {
+            'connections_per_node': connections_per_node or max(thread_count,
+                                                                 10),
+            'http_compress': http_compress,
+            'request_timeout': request_timeout,
+            'max_retries': transport_max_retries,
+            'retry_on_timeout': retry_on_timeout,
+        }
+        if sniff:
+            client_options.update({
+                'sniff_on_start': True,
+                'sniff_on_node_failure': True,
+            })
         if username and password:
-            self._es = Elasticsearch([{'host': host, 'port': port, 'scheme': scheme}], http_auth=(username, password))
-        else:
-            self._es = Elasticsearch([{'host': host, 'port': port, 'scheme': scheme}])
+            client_options['basic_auth'] = (username, password)
+        self._es = Elasticsearch([{'host': host, 'port': port, 'scheme': scheme}],
+                                 **client_options)
         self._index = index
         self._buffer_size = buffer_size
-        self._buffer = ''
+        self._chunk_size = chunk_size
+        self._thread_count = thread_count
+        self._max_retries = max_retries
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+
+        if doc_id_mode not in _DOC_ID_MODES:
+            _log.error('Invalid doc_id_mode: %s; expected one of: version, '
+                       'latest; falling back to random IDs', doc_id_mode)
+            doc_id_mode = None
+        if upsert and doc_id_mode is None:
+            _log.warning('Upserts require document IDs; '
+                         'using doc_id_mode: latest')
+            doc_id_mode = 'latest'
+        self._doc_id_mode = doc_id_mode
+        self._upsert = upsert
+
+        if index_rollover not in _INDEX_ROLLOVERS:
+            _log.error('Invalid index_rollover: %s; expected one of: daily, '
+                       'ilm; falling back to a single index', index_rollover)
+            index_rollover = None
+        self._index_rollover = index_rollover
+        self._index_settings = index_settings or {}
+        self._ilm_rollover = ilm_rollover or {'max_age': '1d',
+                                              'max_primary_shard_size': '50gb'}
+
+        self._retention_days = retention_days
+        self._keep_audit_versions = keep_audit_versions
+        self._prune_on_done = prune_on_done
+        # Unchanged documents must carry the timestamp and audit
+        # version of the latest audit, or pruning would delete them.
+        self._touch = retention_days is not None or bool(keep_audit_versions)
+        if install_template:
+            self._install_template()
+
+        self._buffer = []
         self._cur_buffer_size = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=thread_count)
+        self._futures = set()
+        self._indexed = 0
+        self._unchanged = 0
+        self._failed = 0
 
-    # TODO: Add method to create mapping for efficient indexing of data.
+    def _install_template(self):
+        """Install the index template, and the lifecycle policy for ILM.
 
-    # TODO: Add method to prune old data.
+        For ILM, the first index is also created along with the write
+        alias unless the alias exists already. Errors are logged, and
+        records are then indexed with whatever mappings the cluster
+        applies.
+        """
+        settings = dict(self._index_settings)
+        if self._index_rollover is None:
+            patterns = [self._index]
+        else:
+            patterns = [self._index_pattern()]
+        if self._index_rollover == 'ilm':
+            settings['index.lifecycle.name'] = self._index + '-policy'
+            settings['index.lifecycle.rollover_alias'] = self._index
+
+        try:
+            if self._index_rollover == 'ilm':
+                phases = {'hot': {'actions': {
+                    'rollover': self._ilm_rollover}}}
+                if self._retention_days is not None:
+                    phases['delete'] = {
+                        'min_age': '{}d'.format(self._retention_days),
+                        'actions': {'delete': {}}}
+                self._es.ilm.put_lifecycle(name=self._index + '-policy',
+                                           policy={'phases': phases})
 
-    # TODO: Add support for multiple indexes
+            self._es.indices.put_index_template(
+                name=self._index, index_patterns=patterns,
+                template={'settings': settings, 'mappings': _MAPPINGS})
 
-    def _doc_index_body(self, doc, doc_id=None):
-        """Create the body for a bulk insert API call to Elasticsearch.
+            if (self._index_rollover == 'ilm' and
+                    not self._es.indices.exists_alias(name=self._index)):
+                self._es.indices.create(
+                    index=self._index + '-000001',
+                    aliases={self._index: {'is_write_index': True}})
+        except Exception as e:
+            _log.error('Failed to install index template: %s; error: %s: %s',
+                       self._index, type(e).__name__, e)
+
+    def _index_pattern(self):
+        """Return the pattern of all indices written to.
+
+        Returns:
+            str: Name of the index, or a wildcard pattern of the time
+                based indices.
+
+        """
+        if self._index_rollover is None:
+            return self._index
+        return self._index + '-*'
+
+    def _index_name(self):
+        """Return the name of the index to write records to.
+
+        Returns:
+            str: Name of the index, or of the write alias for ILM.
+
+        """
+        if self._index_rollover == 'daily':
+            return (self._index + '-' +
+                    datetime.datetime.utcnow().strftime('%Y.%m.%d'))
+        return self._index
+
+    def _doc_id(self, name, audit_version):
+        """Return the document ID of a record.
 
         Arguments:
-            doc (dict): Document
-            doc_id: Document ID
+            name (str): Name of the recommendation in the record.
+            audit_version (str): Audit version of the record.
 
         Returns:
-            (str): Request body corresponding to the ``doc``.
+            str: Document ID, or ``None`` to let Elasticsearch assign
+                one.
 
         """
-        action_def = {
-            'index': {
-                '_index': self._index,
-                '_id': doc_id
-            }
-        }
-        src_def = doc
-        return json.dumps(action_def) + '\n' + json.dumps(src_def) + '\n'
+        if self._doc_id_mode is None or not name:
+            return None
+        key = name
+        if self._doc_id_mode == 'version':
+            key += '@' + str(audit_version)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _add(self, doc, doc_hash, name, audit_version):
+        """Add a serialized record to the buffer.
+
+        The buffer is flushed once it is full.
+
+        Arguments:
+            doc (bytes): JSON of the record.
+            doc_hash (str): Hash of the content of the record. See
+                :func:`_content_hash`. It is needed for upserts only.
+            name (str): Name of the recommendation in the record.
+            audit_version (str): Audit version of the record.
+
+        """
+        index = self._index_name()
+        doc_id = self._doc_id(name, audit_version)
+        if doc_id is None:
+            action = {'index': {'_index': index}}
+        elif not self._upsert:
+            action = {'index': {'_index': index, '_id': doc_id}}
+        else:
+            action = {'update': {'_index': index, '_id': doc_id}}
+            doc = (b'{"scripted_upsert": true, "upsert": {}, "script": '
+                   b'{"lang": "painless", "source": ' +
+                   json.dumps(_UPSERT_SCRIPT).encode() +
+                   b', "params": {"doc_hash": "' + doc_hash.encode() +
+                   b'", "touch": ' + json.dumps(self._touch).encode() +
+                   b', "doc": ' + doc + b'}}}')
+
+        self._buffer.append((action, doc))
+        self._cur_buffer_size += len(doc) + 1
+        if (len(self._buffer) >= self._chunk_size or
+                self._cur_buffer_size >= self._buffer_size):
+            self._flush()
 
     def _flush(self):
-        """Bulk insert buffered records into Elasticserach."""
-        try:
-            # print (f"=== {self._buffer} ===")
-            resp = self._es.bulk(
-                    index=self._index,
-                    operations=self._buffer
-                )
-        except ElasticsearchWarning as e:
-            # Handles exceptions of all types defined here.
-            # https://github.com/elastic/elasticsearch-py/blob/master/elasticsearch/exceptions.py
-            _log.error('Bulk Index Error: %s: %s', type(e).__name__, e)
-            print(self._buffer)
-            return
+        """Send buffered records to Elasticsearch in a background thread.
 
-        # Read and parse the response.
-        items = resp['items']
-        records_sent = len(items)
-        fail_count = 0
+        If ``thread_count`` bulk API requests are already in flight,
+        this method waits for at least one of them to complete first.
+        """
+        if not self._buffer:
+            return
 
-        # If response code for an item is not 2xx, increment the count of
-        # failed insertions.
-        if resp['errors']:
-            for item in items:
-                if not 199 < item['index']['status'] < 300:
-                    fail_count += 1
-                    _log.debug('Failed to insert record; ID: %s',
-                               item['index']['_id'])
-            _log.error('Failed to write %d records', fail_count)
+        if len(self._futures) >= self._thread_count:
+            done, self._futures = concurrent.futures.wait(
+                self._futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            self._collect(done)
 
-        _log.info('Indexed %d records', records_sent - fail_count)
+        self._futures.add(self._executor.submit(self._bulk, self._buffer))
 
         # Reset the buffer.
+        self._buffer = []
         self._cur_buffer_size = 0
-        self._buffer = ''
+
+    def _bulk(self, actions):
+        """Bulk insert records into Elasticsearch.
+
+        Arguments:
+            actions (list): Tuples of action and JSON of the records.
+
+        Returns:
+            tuple: Number of records indexed, left unchanged and failed.
+
+        """
+        indexed = unchanged = failed = 0
+        try:
+            for ok, item in helpers.streaming_bulk(
+                    self._es, actions,
+                    chunk_size=self._chunk_size,
+                    max_chunk_bytes=self._buffer_size,
+                    expand_action_callback=lambda action: action,
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                    max_retries=self._max_retries,
+                    initial_backoff=self._initial_backoff,
+                    max_backoff=self._max_backoff):
+                if ok:
+                    _, info = item.popitem()
+                    if info.get('result') == 'noop':
+                        unchanged += 1
+                    else:
+                        indexed += 1
+                else:
+                    failed += 1
+                    _, info = item.popitem()
+                    _log.debug('Failed to insert record; status: %s; '
+                               'error: %s', info.get('status'),
+                               info.get('error'))
+        except Exception as e:
+            # Handles connection errors and other errors raised before
+            # Elasticsearch could respond.
+            _log.error('Bulk Index Error: %s: %s', type(e).__name__, e)
+            failed = len(actions) - indexed - unchanged
+
+        if failed:
+            _log.error('Failed to write %d records', failed)
+        _log.info('Indexed %d records; unchanged: %d', indexed, unchanged)
+        return indexed, unchanged, failed
+
+    def _collect(self, futures):
+        """Add up the results of completed bulk API requests.
+
+        Arguments:
+            futures (iterable): Completed futures of :meth:`_bulk`.
+
+        """
+        for future in futures:
+            indexed, unchanged, failed = future.result()
+            self._indexed += indexed
+            self._unchanged += unchanged
+            self._failed += failed
 
     def write(self, record):
         """Write JSON records to the Elasticsearch index.
 
-        Flush the buffer by saving its content to Elasticsearch  when
-        the buffer size exceeds the configured size.
+        Flush the buffer by saving its content to Elasticsearch when
+        the buffer is full.
 
         Arguments:
             record (dict): Data to save to Elasticsearch.
@@ -119,20 +510,172 @@ class EsStore:
         """
         # Before writing data to ES add time stamp for indexing.
         # Note: For kibana to process timestamp, the field should be in ISO fmt
+        doc_hash = _content_hash(record) if self._upsert else None
+
         record.update({
             'timestamp': str(datetime.datetime.utcnow().isoformat())
         })
+        raw = record.get('raw')
+        self._add(json.dumps(record).encode(), doc_hash,
+                  raw.get('name') if isinstance(raw, dict) else None,
+                  record.get('com', {}).get('audit_version'))
 
-        es_record = self._doc_index_body(record)    # TODO: Send valid doc ID
-        es_record_bytes = len(es_record)
-        if (self._cur_buffer_size and
-                es_record_bytes + self._cur_buffer_size > self._buffer_size):
-            self._flush()
-        else:
-            self._buffer += es_record
-            self._cur_buffer_size += es_record_bytes
+    def write_raw(self, record):
+        """Write an already serialized record to the Elasticsearch index.
+
+        This is the fast path of :meth:`write` for records that arrive
+        as :class:`CureIAM.transport.EncodedRecord`. The timestamp is
+        spliced into the JSON of the record, which is then indexed
+        without being decoded and encoded again.
+
+        Arguments:
+            record (CureIAM.transport.EncodedRecord): Data to save to
+                Elasticsearch.
+
+        """
+        doc = record.to_json(
+            timestamp=str(datetime.datetime.utcnow().isoformat()))
+        doc_hash = None
+        if self._upsert:
+            doc_hash = _content_hash(json.loads(record.body))
+        self._add(doc, doc_hash, record.name,
+                  record.com.get('audit_version'))
+
+    def prune(self):
+        """Delete records as per the retention settings.
+
+        Records older than ``retention_days`` and records of all but
+        the latest ``keep_audit_versions`` audit versions are deleted.
+        Deletes by query are sliced automatically, so that they run in
+        parallel across the shards of the indices. Errors are logged.
+        """
+        if self._retention_days is None and not self._keep_audit_versions:
+            return
+
+        es = self._es.options(request_timeout=3600)
+        pattern = self._index_pattern()
+        try:
+            # Make the records written so far visible to the queries.
+            es.indices.refresh(index=pattern)
+
+            if self._retention_days is not None:
+                if self._index_rollover == 'daily':
+                    self._drop_daily_indices(es)
+                elif self._index_rollover is None:
+                    self._delete_by_query(es, {'range': {'timestamp': {
+                        'lt': 'now-{}d'.format(self._retention_days)}}})
+                # With ILM, the delete phase of the lifecycle policy
+                # deletes old indices.
+
+            if self._keep_audit_versions:
+                resp = es.search(index=pattern, size=0, aggs={'versions': {
+                    'terms': {'field': 'com.audit_version',
+                              'size': self._keep_audit_versions,
+                              'order': {'latest': 'desc'}},
+                    'aggs': {'latest': {'max': {'field': 'timestamp'}}},
+                }})
+                keep = [bucket['key'] for bucket in
+                        resp['aggregations']['versions']['buckets']]
+                if keep:
+                    _log.info('Keeping audit versions: %s', ', '.join(keep))
+                    self._delete_by_query(es, {'bool': {'must_not': [
+                        {'terms': {'com.audit_version': keep}}]}})
+        except Exception as e:
+            _log.error('Failed to prune index: %s; error: %s: %s',
+                       pattern, type(e).__name__, e)
+
+    def _drop_daily_indices(self, es):
+        """Delete daily indices older than ``retention_days``.
+
+        Arguments:
+            es (elasticsearch.Elasticsearch): Client to use.
+
+        """
+        today = datetime.datetime.utcnow().date()
+        cutoff = today - datetime.timedelta(days=self._retention_days)
+        for name in sorted(es.indices.get(index=self._index_pattern(),
+                                          expand_wildcards='all')):
+            suffix = name[len(self._index) + 1:]
+            try:
+                day = datetime.datetime.strptime(suffix, '%Y.%m.%d').date()
+            except ValueError:
+                continue
+            if day < cutoff:
+                es.indices.delete(index=name)
+                _log.info('Deleted index: %s', name)
+
+    def _delete_by_query(self, es, query):
+        """Delete the records matching a query in all indices.
+
+        Arguments:
+            es (elasticsearch.Elasticsearch): Client to use.
+            query (dict): Query matching the records to delete.
+
+        """
+        resp = es.delete_by_query(index=self._index_pattern(), query=query,
+                                  slices='auto', conflicts='proceed',
+                                  wait_for_completion=True)
+        _log.info('Deleted %d records from %s', resp.get('deleted', 0),
+                  self._index_pattern())
 
     def done(self):
-        """Flush pending records to Elasticsearch."""
-        if self._cur_buffer_size:
-            self._flush()
+        """Flush pending records to Elasticsearch and close the client.
+
+        Old records are pruned before closing the client if
+        ``prune_on_done`` is enabled. This is the only place pruning
+        runs on its own; the ``--prune`` command line option calls
+        :meth:`prune` and then :meth:`close` instead of this method.
+        """
+        self._flush()
+        self._collect(concurrent.futures.wait(self._futures).done)
+        self._futures = set()
+        _log.info('Indexed %d records in total; unchanged: %d; '
+                  'failed to write %d records',
+                  self._indexed, self._unchanged, self._failed)
+
+        if self._prune_on_done:
+            self.prune()
+
+        self.close()
+
+    def close(self):
+        """Shut down the bulk API threads and close the client.
+
+        Buffered records are not flushed; use :meth:`done` for that.
+        """
+        self._executor.shutdown()
+        self._es.close()
+
+
+def _content_hash(record):
+    """Return the hash of the stable content of a record.
+
+    The ``com`` and ``timestamp`` fields of the record and the
+    :data:`_VOLATILE_FIELDS` of the recommendation in its ``raw`` part
+    and of the insights joined to it are left out, so that the hash
+    changes only if the recommendation itself or its processing does.
+
+    Arguments:
+        record (dict): Record to hash. It is not modified.
+
+    Returns:
+        str: SHA-1 hex digest of the stable content.
+
+    """
+    content = {k: v for k, v in record.items()
+               if k not in ('com', 'timestamp')}
+    raw = content.get('raw')
+    if isinstance(raw, dict):
+        raw = _without_volatile_fields(raw)
+        if isinstance(raw.get('insights'), list):
+            raw['insights'] = [_without_volatile_fields(insight)
+                               if isinstance(insight, dict) else insight
+                               for insight in raw['insights']]
+        content['raw'] = raw
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def _without_volatile_fields(item):
+    """Return a shallow copy of a dictionary without volatile fields."""
+    return {k: v for k, v in item.items() if k not in _VOLATILE_FIELDS}
@@ -1,88 +1,393 @@
 """Filesystem store plugin."""
 
+import gzip
 import json
 import os
 import os.path
+import re
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from CureIAM.helpers import hlogging
+
+_log = hlogging.get_logger(__name__)
+
+# File extension of each output format.
+_FORMATS = {'json': '.json', 'ndjson': '.ndjson'}
+
+# File extension of each compression type.
+_COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+_MANIFEST_FILE_NAME = 'manifest.json'
+
+# Suffixes of the files written for an origin worker, after the worker
+# name, with or without sharding, in any format and compression.
+_OUTPUT_SUFFIX_RE = re.compile(
+    r'^\.(\d{5}\.)?(tmp|(json|ndjson)(\.gz|\.zst)?)$')
 
 
 class FileStore:
     """A plugin to store records on the filesystem."""
 
-    def __init__(self, path='/tmp/CureIAM'):
+    def __init__(self, path='/tmp/CureIAM', format='json', flush_interval=1,
+                 buffer_size=1048576, compression=None,
+                 compression_level=None, shard_max_bytes=None,
+                 shard_max_records=None):
         """Create an instance of :class:`FileStore` plugin.
 
+        Two output formats are supported. With ``json``, the records of
+        each origin worker are written as one indented JSON array. With
+        ``ndjson``, they are written as compact JSON objects, one per
+        line, so that the output can be read as a stream.
+
+        The output may be compressed with ``gzip``, or with ``zstd`` if
+        the ``zstandard`` package is installed. Otherwise ``zstd`` falls
+        back to ``gzip``.
+
+        If ``shard_max_bytes`` or ``shard_max_records`` is specified,
+        the output of each origin worker is split into shards named
+        like ``<origin_worker>.00001.ndjson.zst``. Each shard is a
+        complete file in the chosen format, so shards can be read in
+        parallel. When sharding or compression is enabled, a
+        ``manifest.json`` file listing the shards and their record
+        counts is written too.
+
+        The files written for an origin worker by earlier runs, e.g.,
+        shards beyond the number written by this run or files of
+        another format or compression, are deleted when the first file
+        of the worker is created, and their manifest entries are
+        dropped.
+
         Arguments:
             path (str): Path of directory where files are written to.
+            format (str): Output format, either ``json`` or ``ndjson``.
+            flush_interval (float): Maximum number of seconds written
+                records are held in the write buffers of the files. For
+                compressed files, only the data already emitted by the
+                compressor is written out, so that flushing does not
+                worsen the compression ratio. The compressed stream is
+                finished when the file is closed.
+            buffer_size (int): Size of the write buffer of each file in
+                bytes.
+            compression (str): Compression type, either ``gzip`` or
+                ``zstd``. No compression by default.
+            compression_level (int): Compression level. Defaults to 6
+                for ``gzip`` and 3 for ``zstd``.
+            shard_max_bytes (int): Maximum number of uncompressed bytes
+                of records in a shard.
+            shard_max_records (int): Maximum number of records in a
+                shard.
 
         """
+        if format not in _FORMATS:
+            _log.error('Invalid format: %s; expected one of: %s; '
+                       'falling back to: json',
+                       format, ', '.join(_FORMATS))
+            format = 'json'
+
+        if compression not in _COMPRESSIONS:
+            _log.error('Invalid compression: %s; expected one of: gzip, '
+                       'zstd; falling back to: gzip', compression)
+            compression = 'gzip'
+        if compression == 'zstd' and zstandard is None:
+            _log.warning('Package zstandard not installed; '
+                         'falling back to compression: gzip')
+            compression = 'gzip'
+
         self._path = os.path.expanduser(path)
-        self._worker_names = set()
+        self._format = format
+        self._flush_interval = flush_interval
+        self._buffer_size = buffer_size
+        self._compression = compression
+        self._compression_level = compression_level
+        self._shard_max_bytes = shard_max_bytes
+        self._shard_max_records = shard_max_records
+        self._sharded = bool(shard_max_bytes or shard_max_records)
+        self._extension = _FORMATS[format] + _COMPRESSIONS[compression]
+
+        self._files = {}
+        self._workers = set()
+        self._shard_counts = {}
+        self._shards = []
+        self._last_flush = time.monotonic()
         os.makedirs(self._path, exist_ok=True)
 
+    def _file(self, worker_name):
+        """Return the open output file of an origin worker.
+
+        The file is created the first time a worker name is seen, or
+        when the previous shard of the worker is full, and is kept open
+        until :meth:`done` is called.
+
+        Arguments:
+            worker_name (str): Origin worker name.
+
+        Returns:
+            _OutputFile: The file to write records to.
+
+        """
+        f = self._files.get(worker_name)
+        if f is not None and self._sharded and (
+                self._shard_max_records and
+                f.records >= self._shard_max_records or
+                self._shard_max_bytes and
+                f.size >= self._shard_max_bytes):
+            self._close(f)
+            f = None
+
+        if f is None:
+            if worker_name not in self._workers:
+                self._workers.add(worker_name)
+                self._remove_stale_files(worker_name)
+            stem = worker_name
+            if self._sharded:
+                shard = self._shard_counts.get(worker_name, 0) + 1
+                self._shard_counts[worker_name] = shard
+                stem += '.{:05d}'.format(shard)
+            f = _OutputFile(os.path.join(self._path, stem),
+                            self._extension, self._format, self._compression,
+                            self._compression_level, self._buffer_size)
+            f.worker_name = worker_name
+            self._files[worker_name] = f
+        return f
+
+    def _remove_stale_files(self, worker_name):
+        """Delete the files written for an origin worker by earlier runs.
+
+        Arguments:
+            worker_name (str): Origin worker name.
+
+        """
+        # Without sharding, the complete output of the previous run is
+        # kept until the new file replaces it on close.
+        keep = None if self._sharded else worker_name + self._extension
+        prefix = worker_name + '.'
+        for name in os.listdir(self._path):
+            if (name.startswith(prefix) and name != keep and
+                    _OUTPUT_SUFFIX_RE.match(name[len(worker_name):])):
+                try:
+                    os.remove(os.path.join(self._path, name))
+                    _log.info('Deleted stale file: %s', name)
+                except OSError as e:
+                    _log.error('Failed to delete stale file: %s; '
+                               'error: %s: %s', name, type(e).__name__, e)
+
     def write(self, record):
         """Write JSON records to the file system.
 
         This method is called once for every ``record`` read from a
-        cloud. In this example implementation of a store, we simply
-        write the ``record`` in JSON format to a file. The list of
-        records is maintained as JSON array in the file. The origin
-        worker name in ``record['com']['origin_worker']`` is used to
-        determine the filename.
+        cloud. The origin worker name in
+        ``record['com']['origin_worker']`` is used to determine the
+        filename.
 
         The records are written to a ``.tmp`` file because we don't want
-        to delete the existing complete and useful ``.json`` file
-        prematurely.
-
-        Note that other implementations of a store may choose to buffer
-        the records in memory instead of writing each record to the
-        store immediately. They may then flush the buffer to the store
-        based on certain conditions such as buffer size, time interval,
-        etc.
+        to delete the existing complete and useful output file
+        prematurely. The file is kept open and written through a buffer
+        that is flushed at least every ``flush_interval`` seconds.
 
         Arguments:
             record (dict): Data to write to the file system.
 
         """
         worker_name = record.get('com', {}).get('origin_worker', 'no_worker')
-
-        tmp_file_path = os.path.join(self._path, worker_name) + '.tmp'
-        if worker_name not in self._worker_names:
-            # If this is the first time we have encountered this
-            # worker_name, we create a new file for it and write an
-            # opening bracket to start a JSON array.
-            with open(tmp_file_path, 'w') as f:
-                f.write('[\n')
-            delim = ''
+        if self._format == 'json':
+            self._write(worker_name, json.dumps(record, indent=2).encode())
         else:
-            # If this is not the first record of its record type, then
-            # we need to separate this record from the previous record
-            # with a comma to form a valid JSON array.
-            delim = ',\n'
+            self._write(worker_name, json.dumps(record).encode())
+
+    def write_raw(self, record):
+        """Write an already serialized record to the file system.
+
+        This is the fast path of :meth:`write` for records that arrive
+        as :class:`CureIAM.transport.EncodedRecord`. In ``ndjson``
+        format, the JSON of the record is written as is.
+
+        Arguments:
+            record (CureIAM.transport.EncodedRecord): Data to write to the
+                file system.
+
+        """
+        if self._format == 'json':
+            self.write(record.decode())
+            return
+        worker_name = record.com.get('origin_worker', 'no_worker')
+        self._write(worker_name, record.to_json())
+
+    def _write(self, worker_name, data):
+        """Write the JSON of a record to the file of an origin worker.
+
+        Arguments:
+            worker_name (str): Origin worker name.
+            data (bytes): JSON of the record.
+
+        """
+        self._file(worker_name).write(data)
+
+        now = time.monotonic()
+        if now - self._last_flush >= self._flush_interval:
+            for f in self._files.values():
+                f.flush()
+            self._last_flush = now
+
+    def _close(self, f):
+        """Close an output file and give it its final name.
+
+        Arguments:
+            f (_OutputFile): The file to close.
 
-        # Write the record dictionary as JSON object literal.
-        self._worker_names.add(worker_name)
-        with open(tmp_file_path, 'a') as f:
-            f.write(delim + json.dumps(record, indent=2))
+        """
+        f.close()
+        self._shards.append({
+            'file': os.path.basename(f.path),
+            'origin_worker': f.worker_name,
+            'records': f.records,
+            'bytes': f.size,
+        })
 
     def done(self):
         """Perform final cleanup tasks.
 
         This method is called after all records have been written. In
-        this example implementation, we properly terminate the JSON
-        array in the .tmp file. Then we rename the .tmp file to .json
-        file.
+        ``json`` format, we properly terminate the JSON array in each
+        ``.tmp`` file. Then we close each ``.tmp`` file and rename it to
+        its final name, e.g., a ``.json`` or ``.ndjson`` file. Finally
+        the manifest is written if sharding or compression is enabled.
+
+        """
+        for f in self._files.values():
+            self._close(f)
+        self._files = {}
+
+        if not (self._sharded or self._compression):
+            return
+
+        manifest_path = os.path.join(self._path, _MANIFEST_FILE_NAME)
+        manifest = {
+            'format': self._format,
+            'compression': self._compression,
+            'shards': self._earlier_shards(manifest_path) + self._shards,
+        }
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        _log.info('Wrote %d records in %d files to %s',
+                  sum(s['records'] for s in self._shards), len(self._shards),
+                  self._path)
 
-        Note that other implementations of a store may perform tasks
-        like closing a connection to a remote store or flushing any
-        remaining records in a buffer.
+
+    def _earlier_shards(self, manifest_path):
+        """Return the manifest entries of earlier runs still valid.
+
+        Entries of the origin workers written by this run, and entries
+        whose files no longer exist, are dropped.
+
+        Arguments:
+            manifest_path (str): Path of the existing manifest.
+
+        Returns:
+            list: Manifest entries of the shards of other workers.
 
         """
-        for worker_name in self._worker_names:
-            # End the JSON array by writing a closing bracket.
-            tmp_file_path = os.path.join(self._path, worker_name) + '.tmp'
-            with open(tmp_file_path, 'a') as f:
-                f.write('\n]\n')
+        try:
+            with open(manifest_path) as f:
+                shards = json.load(f).get('shards', [])
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, AttributeError) as e:
+            _log.error('Failed to read manifest: %s; error: %s: %s',
+                       manifest_path, type(e).__name__, e)
+            return []
+
+        return [shard for shard in shards
+                if isinstance(shard, dict) and
+                shard.get('origin_worker') not in self._workers and
+                os.path.exists(os.path.join(self._path,
+                                            str(shard.get('file'))))]
+
+
+class _OutputFile:
+    """An output file of :class:`FileStore` written through a buffer.
+
+    Records are written to ``<stem>.tmp``, which is renamed to
+    ``<stem><extension>`` when the file is closed.
+    """
 
-            # Rename the temporary file to a JSON file.
-            json_file_path = os.path.join(self._path, worker_name) + '.json'
-            os.replace(tmp_file_path, json_file_path)
+    def __init__(self, stem, extension, format, compression,
+                 compression_level, buffer_size):
+        """Create an instance of :class:`_OutputFile`.
+
+        Arguments:
+            stem (str): Path of the file without extension.
+            extension (str): Extension of the final file.
+            format (str): Output format, either ``json`` or ``ndjson``.
+            compression (str): Compression type, if any.
+            compression_level (int): Compression level, if any.
+            buffer_size (int): Size of the write buffer in bytes.
+
+        """
+        self.path = stem + extension
+        self.records = 0
+        self.size = 0
+        self.worker_name = None
+        self._tmp_path = stem + '.tmp'
+        self._format = format
+
+        self._raw = open(self._tmp_path, 'wb', buffering=buffer_size)
+        if compression == 'gzip':
+            level = 6 if compression_level is None else compression_level
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb',
+                                         compresslevel=level)
+        elif compression == 'zstd':
+            level = 3 if compression_level is None else compression_level
+            self._stream = (zstandard.ZstdCompressor(level=level)
+                            .stream_writer(self._raw, closefd=False))
+        else:
+            self._stream = self._raw
+
+        if format == 'json':
+            # Start a JSON array.
+            self._write(b'[\n')
+
+    def _write(self, data):
+        self._stream.write(data)
+        self.size += len(data)
+
+    def write(self, data):
+        """Write the JSON of a record.
+
+        Arguments:
+            data (bytes): JSON of the record.
+
+        """
+        if self._format == 'json':
+            if self.records:
+                # Separate this record from the previous record with a
+                # comma to form a valid JSON array.
+                self._write(b',\n')
+            self._write(data)
+        else:
+            self._write(data)
+            self._write(b'\n')
+        self.records += 1
+
+    def flush(self):
+        """Flush the write buffer of the file.
+
+        The compressor, if any, is not flushed, since that would end
+        its current block early.
+        """
+        self._raw.flush()
+
+    def close(self):
+        """Close the file and rename it to its final name."""
+        if self._format == 'json':
+            # End the JSON array by writing a closing bracket.
+            self._write(b'\n]\n')
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+        os.replace(self._tmp_path, self.path)
@@ -0,0 +1,285 @@
+"""Columnar Parquet and Arrow IPC store plugin."""
+
+import json
+import os
+import os.path
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+from CureIAM.helpers import hlogging
+
+_log = hlogging.get_logger(__name__)
+
+# File extension of each output format.
+_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+_TIMESTAMP = pa.timestamp('us', tz='UTC')
+
+# Columns of the output files, along with the path of the value of each
+# column in a record yielded by
+# :class:`CureIAM.plugins.gcp.gcpcloudiam.GCPIAMRecommendationProcessor`.
+_COLUMNS = [
+    ('recommendation_id', pa.string(), ('processor', 'recommendation_id')),
+    ('project', pa.string(), ('processor', 'project')),
+    ('account_type', pa.string(), ('processor', 'account_type')),
+    ('account_id', pa.string(), ('processor', 'account_id')),
+    ('recommender_subtype', pa.string(),
+     ('processor', 'recommendetion_recommender_subtype')),
+    ('recommendation_description', pa.string(),
+     ('processor', 'recommendation_description')),
+    ('account_total_permissions', pa.int64(),
+     ('processor', 'account_total_permissions')),
+    ('account_used_permissions', pa.int64(),
+     ('processor', 'account_used_permissions')),
+    ('account_permission_insights_category', pa.string(),
+     ('processor', 'account_permission_insights_category')),
+    ('risk_score', pa.int64(), ('score', 'risk_score')),
+    ('over_privilege_score', pa.int64(), ('score', 'over_privilege_score')),
+    ('safe_to_apply_recommendation_score', pa.int64(),
+     ('score', 'safe_to_apply_recommendation_score')),
+    ('recommendation_state', pa.string(),
+     ('apply_recommendation', 'recommendation_state')),
+    ('recommendation_applied_time', _TIMESTAMP,
+     ('apply_recommendation', 'recommendation_applied_time')),
+    ('state', pa.string(), ('raw', 'stateInfo', 'state')),
+    ('priority', pa.string(), ('raw', 'priority')),
+    ('last_refresh_time', _TIMESTAMP, ('raw', 'lastRefreshTime')),
+    ('etag', pa.string(), ('raw', 'etag')),
+    ('recommendation_actions', pa.string(),
+     ('processor', 'recommendation_actions')),
+    ('audit_key', pa.string(), ('com', 'audit_key')),
+    ('audit_version', pa.string(), ('com', 'audit_version')),
+    ('origin_worker', pa.string(), ('com', 'origin_worker')),
+]
+
+_SCHEMA = pa.schema([(name, type_) for name, type_, _ in _COLUMNS])
+
+# Errors raised by values that cannot be converted to a column type.
+_CONVERSION_ERRORS = (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError)
+
+# Maximum number of record names logged for values that could not be
+# converted.
+_MAX_LOGGED_NAMES = 10
+
+
+class ParquetStore:
+    """A plugin to store processed records in columnar files.
+
+    The records yielded by
+    :class:`CureIAM.plugins.gcp.gcpcloudiam.GCPIAMRecommendationProcessor`
+    are flattened into typed columns, e.g., ``account_type``,
+    ``account_used_permissions`` and ``risk_score``, and written in row
+    groups to a Parquet or Arrow IPC file per origin worker. Analytics
+    queries can then read only the columns they need without parsing
+    any JSON. The ``recommendation_actions`` column holds the actions
+    of a recommendation as a JSON string.
+    """
+
+    def __init__(self, path='/tmp/CureIAM', format='parquet',
+                 row_group_size=100000, compression='zstd'):
+        """Create an instance of :class:`ParquetStore` plugin.
+
+        Arguments:
+            path (str): Path of directory where files are written to.
+            format (str): Output format, either ``parquet`` or ``arrow``
+                for the Arrow IPC file format.
+            row_group_size (int): Number of records buffered in memory
+                and written together as a row group, or as a record
+                batch in the Arrow IPC format.
+            compression (str): Compression codec of the columns, e.g.,
+                ``zstd``, ``lz4`` or ``snappy``. The Arrow IPC format
+                supports ``zstd`` and ``lz4`` only.
+
+        """
+        if format not in _FORMATS:
+            _log.error('Invalid format: %s; expected one of: %s; '
+                       'falling back to: parquet',
+                       format, ', '.join(_FORMATS))
+            format = 'parquet'
+
+        self._path = os.path.expanduser(path)
+        self._format = format
+        self._row_group_size = row_group_size
+        self._compression = compression
+        self._writers = {}
+        self._buffers = {}
+        self._record_names = {}
+        os.makedirs(self._path, exist_ok=True)
+
+    def write(self, record):
+        """Buffer a record and write a row group once enough are buffered.
+
+        The origin worker name in ``record['com']['origin_worker']`` is
+        used to determine the filename.
+
+        Arguments:
+            record (dict): Processed record to store.
+
+        """
+        worker_name = record.get('com', {}).get('origin_worker', 'no_worker')
+        buffer = self._buffers.get(worker_name)
+        if buffer is None:
+            buffer = self._buffers[worker_name] = [[] for _ in _COLUMNS]
+            self._record_names[worker_name] = []
+
+        for column, (_, _, keys) in zip(buffer, _COLUMNS):
+            value = record
+            for key in keys:
+                value = value.get(key) if isinstance(value, dict) else None
+            column.append(value)
+
+        # Names of the recommendations, to log the records whose values
+        # could not be converted.
+        raw = record.get('raw')
+        self._record_names[worker_name].append(
+            raw.get('name') if isinstance(raw, dict) else None)
+
+        if len(buffer[0]) >= self._row_group_size:
+            self._flush(worker_name)
+
+    def _flush(self, worker_name):
+        """Write the buffered records of an origin worker as a row group.
+
+        Arguments:
+            worker_name (str): Origin worker name.
+
+        """
+        buffer = self._buffers.pop(worker_name, None)
+        record_names = self._record_names.pop(worker_name, None)
+        if not buffer or not buffer[0]:
+            return
+
+        arrays = []
+        for values, (name, type_, _) in zip(buffer, _COLUMNS):
+            arrays.append(_to_array(name, type_, values, record_names))
+        batch = pa.RecordBatch.from_arrays(arrays, schema=_SCHEMA)
+
+        writer = self._writers.get(worker_name)
+        if writer is None:
+            writer = self._writers[worker_name] = self._open(worker_name)
+        if self._format == 'parquet':
+            writer.write_batch(batch, row_group_size=self._row_group_size)
+        else:
+            writer.write_batch(batch)
+        _log.info('Wrote %d records for %s', batch.num_rows, worker_name)
+
+    def _open(self, worker_name):
+        """Open the ``.tmp`` output file of an origin worker.
+
+        Arguments:
+            worker_name (str): Origin worker name.
+
+        Returns:
+            object: A Parquet or Arrow IPC writer.
+
+        """
+        tmp_file_path = os.path.join(self._path, worker_name) + '.tmp'
+        if self._format == 'parquet':
+            return pq.ParquetWriter(tmp_file_path, _SCHEMA,
+                                    compression=self._compression)
+        options = ipc.IpcWriteOptions(compression=self._compression)
+        return ipc.new_file(tmp_file_path, _SCHEMA, options=options)
+
+    def done(self):
+        """Write the remaining records and close the output files.
+
+        Each ``.tmp`` file is renamed to a ``.parquet`` or ``.arrow``
+        file once it is complete.
+        """
+        for worker_name in list(self._buffers):
+            self._flush(worker_name)
+
+        extension = _FORMATS[self._format]
+        for worker_name, writer in self._writers.items():
+            writer.close()
+            tmp_file_path = os.path.join(self._path, worker_name) + '.tmp'
+            final_file_path = os.path.join(self._path, worker_name) + extension
+            os.replace(tmp_file_path, final_file_path)
+        self._writers = {}
+
+
+def _to_array(name, type_, values, record_names):
+    """Convert the values of a column to an Arrow array.
+
+    Lists and dictionaries are stored as JSON strings and other values
+    of string columns are converted to strings. Timestamps are
+    parsed from RFC 3339 strings, which are taken to be in UTC if they
+    have no zone offset. If the column cannot be converted as a whole,
+    its values are converted one by one, and the values that cannot be
+    converted to the type of the column are stored as nulls. The names
+    of the records of those values are logged.
+
+    Arguments:
+        name (str): Column name.
+        type_ (pyarrow.DataType): Column type.
+        values (list): Column values.
+        record_names (list): Names of the recommendations in the
+            records the values were taken from.
+
+    Returns:
+        pyarrow.Array: Array of the column values.
+
+    """
+    try:
+        return _convert(type_, values)
+    except _CONVERSION_ERRORS:
+        pass
+
+    arrays = []
+    failed_names = []
+    last_error = None
+    for value, record_name in zip(values, record_names):
+        try:
+            arrays.append(_convert(type_, [value]))
+        except _CONVERSION_ERRORS as e:
+            arrays.append(pa.nulls(1, type_))
+            failed_names.append(record_name)
+            last_error = e
+
+    if failed_names:
+        _log.error('Failed to convert %d values of column: %s; stored as '
+                   'nulls; records: %s%s; error: %s: %s',
+                   len(failed_names), name,
+                   ', '.join(str(n) for n in
+                             failed_names[:_MAX_LOGGED_NAMES]),
+                   ', ...' if len(failed_names) > _MAX_LOGGED_NAMES else '',
+                   type(last_error).__name__, last_error)
+    return pa.concat_arrays(arrays)
+
+
+def _convert(type_, values):
+    """Convert values to an Arrow array of a column type.
+
+    Arguments:
+        type_ (pyarrow.DataType): Column type.
+        values (list): Column values.
+
+    Returns:
+        pyarrow.Array: Array of the values.
+
+    Raises:
+        pyarrow.ArrowInvalid: If a value cannot be converted.
+        pyarrow.ArrowTypeError: If a value is of an unexpected type.
+        OverflowError: If an integer is out of range.
+
+    """
+    if type_ == _TIMESTAMP:
+        strings = pa.array(values, pa.string())
+        try:
+            # Parse with nanosecond precision first, because GCP times
+            # may carry nine fractional digits.
+            parsed = strings.cast(pa.timestamp('ns', tz='UTC'))
+        except pa.ArrowInvalid:
+            # Times without a zone offset, e.g., the ones recorded by
+            # the processor, are in UTC.
+            parsed = strings.cast(pa.timestamp('ns')).cast(
+                pa.timestamp('ns', tz='UTC'))
+        return parsed.cast(type_, safe=False)
+
+    if type_ == pa.string():
+        values = [v if v is None or isinstance(v, str) else
+                  json.dumps(v) if isinstance(v, (list, dict)) else str(v)
+                  for v in values]
+    return pa.array(values, type_)
@@ -0,0 +1,337 @@
+"""Asynchronous fetch engine for the GCP IAM recommendation plugin.
+
+This module lets :class:`CureIAM.plugins.gcp.gcpcloud.GCPCloudIAMRecommendations`
+drive project listing, recommendation paging and insight fetching from
+a single asyncio event loop. It talks to the REST endpoints of the
+Google APIs over :mod:`aiohttp` instead of the synchronous
+``googleapiclient`` resources, so a single thread can keep many
+requests in flight.
+"""
+
+import asyncio
+import queue
+import threading
+import urllib.parse
+
+import aiohttp
+from google.auth.transport.requests import Request
+from google.oauth2 import service_account
+
+from CureIAM import ioworkers
+from CureIAM.helpers import hlogging, hratelimit
+
+_log = hlogging.get_logger(__name__)
+
+"""OAuth 2.0 scopes requested for the access token."""
+_GCP_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+CLOUDRESOURCEMANAGER_URL = 'https://cloudresourcemanager.googleapis.com/v1/'
+CLOUDRESOURCEMANAGER_V2_URL = 'https://cloudresourcemanager.googleapis.com/v2/'
+RECOMMENDER_URL = 'https://recommender.googleapis.com/v1/'
+
+# HTTP status codes of responses worth retrying, as in util_gcp.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+
+
+class AsyncGCPClient:
+    """Minimal asynchronous client for the Google REST APIs.
+
+    The client must be used as an asynchronous context manager, so that
+    its HTTP session is opened and closed within the running event loop.
+    """
+
+    def __init__(self, key_file_path, concurrency=100, limiters=None,
+                 max_retries=5):
+        """Create an instance of :class:`AsyncGCPClient`.
+
+        Arguments:
+            key_file_path (str): Path of the service account key file.
+            concurrency (int): Maximum number of HTTP requests in flight.
+            limiters (dict): Rate limiters keyed by API name. The API
+                name of a request is the first label of its host name,
+                e.g., ``recommender``.
+            max_retries (int): Maximum number of retries of a request
+                that failed with a quota, server or connection error.
+
+        """
+        self._credentials = (service_account.Credentials
+                             .from_service_account_file(key_file_path,
+                                                        scopes=_GCP_SCOPES))
+        self._concurrency = concurrency
+        self._limiters = limiters or {}
+        self._max_retries = max_retries
+        self._session = None
+        self._semaphore = None
+        self._token_lock = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        self._token_lock = asyncio.Lock()
+        connector = aiohttp.TCPConnector(limit=self._concurrency)
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              raise_for_status=True)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._session.close()
+
+    async def _authorization(self):
+        """Return the ``Authorization`` header value.
+
+        The access token is refreshed in the default executor when it
+        has expired, because the google-auth transport is synchronous.
+        """
+        async with self._token_lock:
+            if not self._credentials.valid:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._credentials.refresh,
+                                           Request())
+        return 'Bearer ' + self._credentials.token
+
+    async def get(self, url, **params):
+        """Send a GET request and return the decoded JSON response.
+
+        Requests are rate limited and retried like
+        :func:`CureIAM.plugins.gcp.util_gcp.execute_request` does,
+        except that waiting never blocks the event loop.
+
+        Arguments:
+            url (str): URL of the REST resource.
+            params (dict): Query parameters.
+
+        Returns:
+            dict: Decoded JSON response.
+
+        """
+        api = urllib.parse.urlsplit(url).hostname.split('.')[0]
+        limiter = self._limiters.get(api)
+
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await asyncio.sleep(limiter.reserve())
+            try:
+                response = await self._get(url, params)
+            except aiohttp.ClientResponseError as e:
+                if limiter is not None and e.status in THROTTLE_STATUSES:
+                    limiter.throttled()
+                if e.status not in RETRY_STATUSES or attempt >= self._max_retries:
+                    raise
+                error = '{}: {}'.format(e.status, e.message)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self._max_retries:
+                    raise
+                error = '{}: {}'.format(type(e).__name__, e)
+            else:
+                if limiter is not None:
+                    limiter.succeeded()
+                return response
+
+            delay = hratelimit.backoff_delay(attempt)
+            attempt += 1
+            _log.warning('Retrying request in %.1f s; attempt: %d; url: %s; '
+                         'error: %s', delay, attempt, url, error)
+            await asyncio.sleep(delay)
+
+    async def _get(self, url, params):
+        """Send a single GET request within the concurrency limit."""
+        async with self._semaphore:
+            headers = {'Authorization': await self._authorization()}
+            async with self._session.get(url, params=params,
+                                         headers=headers) as response:
+                return await response.json()
+
+    async def list(self, url, key, **params):
+        """Generate resources across all pages of a list call.
+
+        Arguments:
+            url (str): URL of the REST collection.
+            key (str): The key that we need to look up in the response
+                JSON to find the list of resources. If ``None``, whole
+                responses are generated instead.
+            params (dict): Query parameters.
+
+        Yields:
+            dict: A resource, or a whole response if ``key`` is ``None``.
+
+        """
+        while True:
+            response = await self.get(url, **params)
+            if key is None:
+                yield response
+            else:
+                for item in response.get(key, []):
+                    yield item
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+            params['pageToken'] = page_token
+
+
+async def map_unordered(func, items, concurrency, log_tag=''):
+    """Apply an asynchronous generator function to items concurrently.
+
+    This is the asyncio counterpart of :func:`CureIAM.ioworkers.run`.
+    At most ``concurrency`` items are worked on at a time and the
+    outputs are generated in the order they are produced.
+
+    Arguments:
+        func (callable): An asynchronous generator function that
+            accepts a single item.
+        items (AsyncIterable): Items to work on.
+        concurrency (int): Number of items to work on concurrently.
+        log_tag (str): String to include in every log message.
+
+    Yields:
+        Each output value generated by ``func``.
+
+    Raises:
+        CureIAM.ioworkers.IOWorkerError: If ``items`` or any call of
+            ``func`` failed. This is raised only after the output
+            values of the other items have been yielded.
+
+    """
+    if log_tag != '':
+        log_tag += ': '
+
+    done = object()
+    failures = {'input': False, 'items': 0}
+    in_q = asyncio.Queue(maxsize=concurrency)
+    out_q = asyncio.Queue(maxsize=concurrency)
+
+    async def feed():
+        try:
+            async for item in items:
+                await in_q.put(item)
+        except Exception as e:
+            _log.exception('%sFailed to get input; error: %s: %s',
+                           log_tag, type(e).__name__, e)
+            failures['input'] = True
+        for _ in range(concurrency):
+            await in_q.put(done)
+
+    async def work():
+        while True:
+            item = await in_q.get()
+            if item is done:
+                break
+            try:
+                async for output in func(item):
+                    await out_q.put(output)
+            except Exception as e:
+                _log.exception('task_worker: %sFailed; error: %s: %s',
+                               log_tag, type(e).__name__, e)
+                failures['items'] += 1
+        await out_q.put(done)
+
+    tasks = [asyncio.create_task(feed())]
+    tasks.extend(asyncio.create_task(work()) for _ in range(concurrency))
+
+    try:
+        stopped_workers = 0
+        while stopped_workers < concurrency:
+            output = await out_q.get()
+            if output is done:
+                stopped_workers += 1
+                continue
+            yield output
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if failures['input'] or failures['items']:
+        raise ioworkers.IOWorkerError(
+            '{}Input failed: {}; failed work items: {}'
+            .format(log_tag, failures['input'], failures['items']))
+
+
+async def from_iterable(iterable):
+    """Generate the items of a plain iterable asynchronously.
+
+    Arguments:
+        iterable (Iterable): Items to generate.
+
+    Yields:
+        Each item of ``iterable``.
+
+    """
+    for item in iterable:
+        yield item
+
+
+def iterate(async_iterator, max_pending=1000):
+    """Generate the items of an asynchronous iterator synchronously.
+
+    The iterator is consumed by a new event loop run in a dedicated
+    thread, which puts the items into a bounded queue. The requests in
+    flight thus keep making progress while the caller is busy with the
+    items already generated, and the caller can consume an asynchronous
+    pipeline like a plain generator. Once ``max_pending`` items are
+    waiting in the queue, the event loop waits for the caller to catch
+    up.
+
+    An exception raised by the asynchronous iterator is raised again in
+    the caller. If the caller stops early, the event loop is stopped and
+    the asynchronous iterator is closed.
+
+    Arguments:
+        async_iterator (AsyncIterator): Asynchronous iterator to consume.
+        max_pending (int): Maximum number of items generated but not
+            yet consumed.
+
+    Yields:
+        Each item of ``async_iterator``.
+
+    """
+    items = queue.Queue(max_pending)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        # Block the calling executor thread rather than the event loop,
+        # and give up once the caller has stopped.
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def send(value):
+        try:
+            items.put_nowait(value)
+            return True
+        except queue.Full:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, put, value)
+
+    async def pump():
+        try:
+            async for item in async_iterator:
+                if not await send((item, None)):
+                    break
+        except Exception as e:
+            await send((done, e))
+        else:
+            await send((done, None))
+        finally:
+            await async_iterator.aclose()
+
+    thread = threading.Thread(target=asyncio.run, args=(pump(),),
+                              name='gcpasync', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                break
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
@@ -0,0 +1,242 @@
+"""Persistent cache of IAM recommendations for incremental scans.
+
+The cache maps a recommendation name to the ``etag`` and
+``lastRefreshTime`` of the recommendation seen in an earlier run,
+along with the insights fetched for it. A recommendation whose
+``etag`` has not changed since then does not need its insights fetched
+again.
+
+Recommendations read by a scan are staged first and become visible to
+lookups only once :meth:`RecommendationCache.promote` is called after
+the audit has succeeded. A failed audit thus never marks the
+recommendations it read as unchanged for later incremental scans.
+Cached recommendations of a scanned project that the scan did not see,
+e.g., because they were dismissed or have expired, are pruned by
+:meth:`RecommendationCache.promote` as well.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+from CureIAM.helpers import hlogging
+
+_log = hlogging.get_logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recommendations (
+    name TEXT PRIMARY KEY,
+    project TEXT,
+    etag TEXT,
+    last_refresh_time TEXT,
+    insights TEXT
+);
+CREATE INDEX IF NOT EXISTS recommendations_project
+    ON recommendations (project);
+CREATE TABLE IF NOT EXISTS staged_recommendations (
+    name TEXT PRIMARY KEY,
+    project TEXT,
+    etag TEXT,
+    last_refresh_time TEXT,
+    insights TEXT
+);
+CREATE TABLE IF NOT EXISTS staged_projects (
+    project TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS staged_names (
+    name TEXT PRIMARY KEY
+);
+"""
+
+_STAGE = """
+INSERT OR REPLACE INTO staged_recommendations
+    (name, project, etag, last_refresh_time, insights)
+VALUES (?, ?, ?, ?, ?)
+"""
+
+# Rows are written whenever the etag changes, so rows of unchanged
+# recommendations are left alone. The WHERE clause of the SELECT is
+# needed by SQLite to parse the ON CONFLICT clause.
+_PROMOTE = """
+INSERT INTO recommendations
+    (name, project, etag, last_refresh_time, insights)
+SELECT name, project, etag, last_refresh_time, insights
+FROM staged_recommendations WHERE true
+ON CONFLICT (name) DO UPDATE SET
+    project = excluded.project,
+    etag = excluded.etag,
+    last_refresh_time = excluded.last_refresh_time,
+    insights = excluded.insights
+WHERE etag IS NOT excluded.etag
+"""
+
+# Only projects whose recommendations were listed completely are
+# staged, so a project that failed to list keeps its rows.
+_PRUNE = """
+DELETE FROM recommendations
+WHERE project IN (SELECT project FROM staged_projects)
+AND name NOT IN (SELECT name FROM staged_names)
+"""
+
+_STAGED_TABLES = ('staged_recommendations', 'staged_projects',
+                  'staged_names')
+
+# Stay well below the limit on the number of SQL variables.
+_LOOKUP_CHUNK_SIZE = 500
+
+
+class RecommendationCache:
+    """SQLite backed cache of recommendations.
+
+    Lookups may be done from any thread of any process. Each thread
+    opens its own connection, and the database runs in write-ahead
+    logging mode, so readers do not block each other or the writer.
+    Writes are meant to be done from a single thread, e.g., the one
+    consuming the records of all worker processes.
+
+    Stored recommendations are staged until :meth:`promote` is called,
+    which may be done from another process, e.g., by the manager once
+    the audit has succeeded.
+    """
+
+    def __init__(self, path, commit_interval=500):
+        """Create an instance of :class:`RecommendationCache`.
+
+        Arguments:
+            path (str): Path of the SQLite database file. It is created
+                along with its directory if it does not exist.
+            commit_interval (int): Number of stored recommendations
+                after which they are committed to the staging table.
+
+        """
+        self._path = os.path.expanduser(path)
+        self._commit_interval = commit_interval
+        self._local = threading.local()
+        self._pending = 0
+
+        os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+        conn.commit()
+
+    def _connection(self):
+        """Return the connection of the calling thread.
+
+        A connection inherited from a parent process through fork is
+        never reused.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=30)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def lookup(self, names):
+        """Look up cached recommendations by their names.
+
+        Arguments:
+            names (list): Recommendation names.
+
+        Returns:
+            dict: A dictionary that maps each cached name to a tuple of
+                its etag, last refresh time and list of insights.
+
+        """
+        conn = self._connection()
+        cached = {}
+        for start in range(0, len(names), _LOOKUP_CHUNK_SIZE):
+            chunk = names[start:start + _LOOKUP_CHUNK_SIZE]
+            rows = conn.execute(
+                'SELECT name, etag, last_refresh_time, insights '
+                'FROM recommendations WHERE name IN ({})'
+                .format(', '.join('?' * len(chunk))), chunk)
+            for name, etag, last_refresh_time, insights in rows:
+                cached[name] = (etag, last_refresh_time, json.loads(insights))
+        return cached
+
+    def store(self, recommendation):
+        """Stage a recommendation along with its insights.
+
+        Arguments:
+            recommendation (dict): Recommendation record with its
+                insights under the ``insights`` key.
+
+        """
+        conn = self._connection()
+        conn.execute(_STAGE, (recommendation['name'],
+                              recommendation.get('project'),
+                              recommendation.get('etag'),
+                              recommendation.get('lastRefreshTime'),
+                              json.dumps(recommendation.get('insights', []))))
+        self._pending += 1
+        if self._pending >= self._commit_interval:
+            self.commit()
+
+    def store_scanned(self, project, names):
+        """Stage the names of all recommendations listed for a project.
+
+        This must be called only once all recommendations of the
+        project have been listed, including those not stored because
+        they are unchanged. Cached recommendations of the project whose
+        names are not among ``names`` are pruned by :meth:`promote`.
+
+        Arguments:
+            project (str): Project ID.
+            names (list): Names of the recommendations of the project.
+
+        """
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO staged_projects (project) '
+                     'VALUES (?)', (project,))
+        conn.executemany('INSERT OR REPLACE INTO staged_names (name) '
+                         'VALUES (?)', ((name,) for name in names))
+
+    def commit(self):
+        """Commit the recommendations staged so far.
+
+        They are not visible to :meth:`lookup` until :meth:`promote`
+        is called.
+        """
+        self._connection().commit()
+        self._pending = 0
+
+    def promote(self):
+        """Make the staged recommendations visible to lookups.
+
+        The staged recommendations are moved into the cache and the
+        cached recommendations of the scanned projects that were not
+        listed again are pruned, all in a single transaction.
+
+        Returns:
+            tuple: Number of staged recommendations and number of
+                pruned recommendations.
+
+        """
+        conn = self._connection()
+        with conn:
+            count = conn.execute(
+                'SELECT COUNT(*) FROM staged_recommendations').fetchone()[0]
+            conn.execute(_PROMOTE)
+            pruned = conn.execute(_PRUNE).rowcount
+            for table in _STAGED_TABLES:
+                conn.execute('DELETE FROM ' + table)
+        return count, pruned
+
+    def discard(self):
+        """Drop the recommendations staged by an earlier scan.
+
+        Returns:
+            int: Number of staged recommendations dropped.
+
+        """
+        conn = self._connection()
+        with conn:
+            count = conn.execute(
+                'DELETE FROM staged_recommendations').rowcount
+            for table in _STAGED_TABLES[1:]:
+                conn.execute('DELETE FROM ' + table)
+        self._pending = 0
+        return count
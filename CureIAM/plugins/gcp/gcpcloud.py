@@ -1,20 +1,18 @@
 """Plugin to read the data from the GCP IAM recommendation API
 """
 
+import asyncio
+import concurrent.futures
+import functools
 import json
-import logging
-from CureIAM.helpers import hlogging
-from CureIAM.helpers.hconfigs import Config
-
-# logging.config.dictConfig()
-
-# _log = logging.getLogger(__name__)
+from CureIAM.helpers import hlogging, hratelimit
 
 _log = hlogging.get_logger(__name__)
 
 # from google.oauth2 import service_account #reducing the library call
 
 from CureIAM import ioworkers
+from . import gcpcache
 from . import util_gcp #call function from same folder
 
 """OAuth 2.0 scopes for Google APIs required by this plugin.
@@ -24,22 +22,133 @@ more details on OAuth 2.0 scopes for Google APIs."""
 # TODO: Redefine scopes
 _GCP_SCOPES = ['https://www.googleapis.com/*']
 
+"""Supported ways of fetching the insights associated with recommendations.
+
+- ``get``: One ``insights().get()`` call per associated insight.
+- ``batch``: The insights of a page of recommendations are fetched
+  together through HTTP batch requests.
+- ``list``: All IAM policy insights of a project are listed once and
+  joined onto its recommendations by name."""
+_INSIGHTS_MODES = ('get', 'batch', 'list')
+
+"""Supported fetch engines.
+
+- ``threads``: Projects are fetched by :func:`CureIAM.ioworkers.run` in
+  ``processes * threads`` worker threads.
+- ``async``: Projects are fetched from a single asyncio event loop by
+  :mod:`CureIAM.plugins.gcp.gcpasync`."""
+_MODES = ('threads', 'async')
+
 class GCPCloudIAMRecommendations:
     """GCP cloud IAM recomendation plugin."""
 
-    def __init__(self, key_file_path, projects='*', processes=4, threads=10):
+    def __init__(self, key_file_path, projects='*', processes=4, threads=10,
+                 insights_mode='get', insights_batch_size=100,
+                 insights_num_retries=3, mode='threads', concurrency=100,
+                 api_qps=None, max_retries=5, cache_path=None,
+                 incremental=False, lifecycle_state='ACTIVE', labels=None,
+                 parents=None, recursive=True, exclude_projects=None,
+                 discovery_threads=4):
         """Create an instance of :class:`GCPCloudIAMRecommendations` plugin.
 
         Arguments:
             key_file_path (str): Path of the service account key file for a project.
+            projects (list): IDs of the projects to scan, or ``'*'`` to
+                discover and scan all projects matching the discovery
+                filters below.
             processes (int): Number of processes to launch.
             threads (int): Number of threads to launch in each process.
+            insights_mode (str): How the insights associated with the
+                recommendations are fetched. See :data:`_INSIGHTS_MODES`.
+            insights_batch_size (int): Maximum number of insight requests
+                in a single HTTP batch request in ``batch`` mode.
+            insights_num_retries (int): Number of retries for an insight
+                request that failed inside a batch in ``batch`` mode.
+            mode (str): Fetch engine to use. See :data:`_MODES`.
+            concurrency (int): Maximum number of projects worked on and
+                HTTP requests in flight at a time in ``async`` mode.
+            api_qps (dict): Maximum calls per second keyed by API name,
+                i.e., ``recommender`` and ``cloudresourcemanager``. The
+                limits are shared by all worker processes and threads,
+                and adapt downwards while the API throttles. APIs not
+                listed here are not rate limited.
+            max_retries (int): Maximum number of retries of a call that
+                failed with a quota, server or connection error.
+            cache_path (str): Path of the SQLite database that caches
+                the recommendations of earlier runs. The insights of a
+                recommendation whose etag has not changed since are
+                taken from the cache instead of the API. No cache is
+                used if unspecified. The recommendations read are
+                staged and added to the cache by the manager once the
+                audit has succeeded, and only if all of their
+                associated insights were fetched.
+            incremental (bool): Read only the recommendations that are
+                new or changed since the earlier runs, i.e., the delta.
+                Requires ``cache_path``.
+            lifecycle_state (str): Lifecycle state that discovered
+                projects must be in. Projects in any state are
+                discovered if ``None``.
+            labels (dict): Labels that discovered projects must have,
+                keyed by label name.
+            parents (list): Folders and organizations to discover
+                projects in, e.g., ``folders/123`` or
+                ``organizations/456``. All projects visible to the
+                service account are discovered if unspecified.
+            recursive (bool): Discover projects in all folders nested
+                under ``parents`` as well.
+            exclude_projects (list): IDs of projects to never scan.
+            discovery_threads (int): Number of threads listing folders
+                and projects concurrently when ``parents`` are given.
 
         """
         self._key_file_path = key_file_path
         self._projects = projects
         self._processes = processes
         self._threads = threads
+
+        if insights_mode not in _INSIGHTS_MODES:
+            _log.error('Invalid insights_mode: %s; expected one of: %s; '
+                       'falling back to get', insights_mode,
+                       ', '.join(_INSIGHTS_MODES))
+            insights_mode = 'get'
+        self._insights_mode = insights_mode
+        self._insights_batch_size = insights_batch_size
+        self._insights_num_retries = insights_num_retries
+
+        if mode not in _MODES:
+            _log.error('Invalid mode: %s; expected one of: %s; '
+                       'falling back to threads', mode, ', '.join(_MODES))
+            mode = 'threads'
+        self._mode = mode
+        self._concurrency = concurrency
+
+        # The buckets are created before ioworkers forks the worker
+        # processes, so that all of them draw from the same buckets.
+        self._limiters = {api: hratelimit.TokenBucket(qps)
+                          for api, qps in (api_qps or {}).items()}
+        self._max_retries = max_retries
+
+        self._cache = None
+        if cache_path:
+            self._cache = gcpcache.RecommendationCache(cache_path)
+        elif incremental:
+            _log.error('incremental requires cache_path; reading all '
+                       'recommendations')
+        self._incremental = incremental and self._cache is not None
+
+        self._lifecycle_state = lifecycle_state
+        self._labels = labels or {}
+        self._parents = parents or []
+        self._recursive = recursive
+        self._exclude_projects = set(exclude_projects or [])
+        self._discovery_threads = discovery_threads
+
+        # The async engine fetches insights concurrently with plain GET
+        # requests, so HTTP batch requests have nothing to add there.
+        if self._mode == 'async' and self._insights_mode == 'batch':
+            _log.info('insights_mode batch is not used in async mode; '
+                      'using get')
+            self._insights_mode = 'get'
         
         # Create credentials for python client from service account key file 
         # credentials = service_account.Credentials.from_service_account_file(
@@ -53,22 +162,19 @@ class GCPCloudIAMRecommendations:
         # testing the use case, will remove it later if it's not work #
 
         # Scan needs to be done for list of projects or all the projects
-        # projects='*' indicates all projects
+        # projects='*' indicates all projects. They are discovered while
+        # the projects found so far are already being scanned, see
+        # :meth:`_get_projects`.
         if self._projects == '*':
-            _log.info('Plugin started in Scan-All-Projects-Mode')
-            # Get the list of all the projects available
-            self._projects = []
-            cloudresourcemanager_service = util_gcp.build_resource(
-                                            'cloudresourcemanager',
-                                            self._key_file_path,
-                                            'v1')
-            for project in util_gcp.get_resource_iterator(
-                cloudresourcemanager_service.projects(),
-                'projects'):
-                self._projects.append(project['projectId'])
-
-        _log.info('Projects %s', len(self._projects))
-        
+            _log.info('Plugin started in Scan-All-Projects-Mode; '
+                      'lifecycle_state: %s; labels: %s; parents: %s; '
+                      'recursive: %s', self._lifecycle_state, self._labels,
+                      self._parents, self._recursive)
+
+        _projects_count = ('all' if self._projects == '*'
+                           else len(self._projects))
+        _log.info('Projects %s', _projects_count)
+
         # Service account key file also has the client email under the key
         # client_email. We will use this key file to get the client email for
         # this request.
@@ -81,11 +187,11 @@ class GCPCloudIAMRecommendations:
                        'error: %s: %s', self._key_file_path,
                        type(e).__name__, e)
 
-        _log.info('Initialized; key_file_path: %s; processes: %s; threads: %s;' 
-                  'projects to scan: %d',
-                  self._key_file_path, 
-                  self._processes, self._threads, 
-                  len(self._projects))
+        _log.info('Initialized; key_file_path: %s; mode: %s; processes: %s; '
+                  'threads: %s; concurrency: %s; projects to scan: %s',
+                  self._key_file_path, self._mode,
+                  self._processes, self._threads, self._concurrency,
+                  _projects_count)
         
     def read(self):
         """Return a GCP cloud infrastructure configuration record.
@@ -94,11 +200,52 @@ class GCPCloudIAMRecommendations:
             dict: A GCP cloud infrastructure configuration record.
 
         """
-        yield from ioworkers.run(self._get_projects,
-                                 self._get_recommendations,
-                                 self._processes,
-                                 self._threads,
-                                 __name__)
+        if self._mode == 'async':
+            # Imported here, so that aiohttp is needed only in async mode.
+            from . import gcpasync
+            records = gcpasync.iterate(self._read_async())
+        else:
+            records = ioworkers.run(self._get_projects,
+                                    self._get_recommendations,
+                                    self._processes,
+                                    self._threads,
+                                    __name__)
+
+        if self._cache is not None:
+            # Recommendations staged by an earlier audit that did not
+            # succeed must not be committed along with this one.
+            discarded = self._cache.discard()
+            if discarded:
+                _log.warning('Discarded %d recommendations staged by an '
+                             'unsuccessful audit', discarded)
+
+        # All records pass through this process, so the cache is
+        # written from here only while the workers merely read it.
+        # Recommendations with missing insights are not cached, so
+        # that their insights are fetched again by the next audit.
+        incomplete = 0
+        try:
+            for record in records:
+                if 'scanned_project' in record:
+                    self._cache.store_scanned(record['scanned_project'],
+                                              record['recommendation_names'])
+                    continue
+                if self._cache is not None:
+                    if _insights_complete(record['raw']):
+                        self._cache.store(record['raw'])
+                    else:
+                        incomplete += 1
+                yield record
+
+        finally:
+            # Staged recommendations are committed even if the read
+            # fails, so that no write lock is left behind. They are
+            # discarded by the next read since the audit fails.
+            if self._cache is not None:
+                self._cache.commit()
+                if incomplete:
+                    _log.warning('Recommendations not cached due to '
+                                 'missing insights: %d', incomplete)
 
     def _get_projects(self):
         """Generate tuples of record types and projects.
@@ -113,15 +260,121 @@ class GCPCloudIAMRecommendations:
                 :meth:`_get_recommendations`.
 
         """
+        project_count = 0
         try:
+            if self._projects == '*':
+                projects = self._discover_projects()
+            else:
+                projects = iter(self._projects)
 
-            for project in self._projects:
-                yield ('project_record', '', project, 'global')
+            for project in projects:
+                if project in self._exclude_projects:
+                    continue
+                project_count += 1
+                yield ('project_record', project_count, project, 'global')
 
         except Exception as e:
+            # Raised again, so that ioworkers fails the read once the
+            # projects scheduled so far have been worked on.
             _log.error('Failed to fetch projects; key_file_path: %s; '
                        'error: %s: %s', self._key_file_path,
                        type(e).__name__, e)
+            raise
+
+        finally:
+            _log.info('Projects scheduled: %d', project_count)
+
+    def _discover_projects(self):
+        """Generate IDs of the projects matching the discovery filters.
+
+        Project IDs are generated as soon as their page is listed, so
+        that the recommendations of the first projects are fetched while
+        the rest are still being listed. With ``parents``, every parent
+        and, if ``recursive``, every folder under it is listed in a pool
+        of ``discovery_threads`` threads.
+
+        Yields:
+            str: Project ID.
+
+        """
+        if not self._parents:
+            yield from self._list_projects(None)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(
+                self._discovery_threads,
+                thread_name_prefix='discovery') as executor:
+            # Futures of lists of projects map to False and futures of
+            # lists of child folders map to True.
+            pending = {}
+
+            def submit(parent):
+                future = executor.submit(list, self._list_projects(parent))
+                pending[future] = False
+                if self._recursive:
+                    future = executor.submit(self._list_folders, parent)
+                    pending[future] = True
+
+            for parent in self._parents:
+                submit(parent)
+
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    is_folders = pending.pop(future)
+                    if is_folders:
+                        for folder in future.result():
+                            submit(folder)
+                    else:
+                        yield from future.result()
+
+    def _list_projects(self, parent):
+        """Generate IDs of the matching projects directly under a parent.
+
+        Arguments:
+            parent (str): Folder or organization name, e.g.,
+                ``folders/123``. If ``None``, all projects visible to
+                the service account are listed.
+
+        Yields:
+            str: Project ID.
+
+        """
+        cloudresourcemanager_service = util_gcp.get_resource(
+                                        'cloudresourcemanager',
+                                        self._key_file_path,
+                                        'v1')
+        project_filter = util_gcp.project_filter(self._lifecycle_state,
+                                                 self._labels, parent)
+        for project in util_gcp.get_resource_iterator(
+            cloudresourcemanager_service.projects(),
+            'projects',
+            self._limiters.get('cloudresourcemanager'),
+            self._max_retries,
+            filter=project_filter):
+            yield project['projectId']
+
+    def _list_folders(self, parent):
+        """List the active folders directly under a parent.
+
+        Arguments:
+            parent (str): Folder or organization name.
+
+        Returns:
+            list: Folder names, e.g., ``folders/123``.
+
+        """
+        cloudresourcemanager_service = util_gcp.get_resource(
+                                        'cloudresourcemanager',
+                                        self._key_file_path,
+                                        'v2')
+        return [folder['name'] for folder in util_gcp.get_resource_iterator(
+            cloudresourcemanager_service.folders(),
+            'folders',
+            self._limiters.get('cloudresourcemanager'),
+            self._max_retries,
+            parent=parent)]
 
     def _get_recommendations(self, record_type, project_index, project, zone=None):
         """Generate tuples of record as recommendation for a specific project.
@@ -135,50 +388,423 @@ class GCPCloudIAMRecommendations:
         """
         _log.info('Fetching recommendations for project : %s ...', hlogging.obfuscated(project))
 
-        parent_string = 'projects/{project}/locations/{location}/recommenders/{recommenders}'.format(
-            project=project,
-            location='global',
-            recommenders='google.iam.policy.Recommender'
-        )
+        parent_string = _recommender_parent(project)
 
-        recommendations_service = util_gcp.build_resource('recommender',
-                                                      self._key_file_path,
-                                                      'v1')
+        recommendations_service = util_gcp.get_resource('recommender',
+                                                        self._key_file_path,
+                                                        'v1')
 
-        recommendations_iterator = util_gcp.get_resource_iterator((recommendations_service
+        # Iterate over whole pages, so that the insights of a page of
+        # recommendations can be fetched together.
+        pages = util_gcp.get_resource_iterator((recommendations_service
                             .projects()
                             .locations()
                             .recommenders()
-                            .recommendations()), 'recommendations', parent=parent_string)
-        
-        for _, recommendation in enumerate(recommendations_iterator):
-            recommendation.update({'project': project})
+                            .recommendations()), None,
+                            self._limiters.get('recommender'),
+                            self._max_retries, parent=parent_string)
+
+        # In list mode, the insights of the project are listed lazily
+        # when the first insight is needed, so that projects without
+        # new or changed recommendations cost no extra API call.
+        insight_index = None
+        reused_count = 0
+        names = []
+
+        for page in pages:
+            recommendations = page.get('recommendations', [])
+            names.extend(r['name'] for r in recommendations)
+            stale, cached_insights = self._split_cached(recommendations)
+            reused_count += len(cached_insights)
+
+            insight_names = _insight_names(stale)
+            if (self._insights_mode == 'list' and insight_index is None
+                    and insight_names):
+                try:
+                    insight_index = self._list_insights(
+                        recommendations_service, project)
+                except Exception as e:
+                    # The insights are fetched by name instead.
+                    _log.error('Failed to list insights for project: %s; '
+                               'error: %s: %s', hlogging.obfuscated(project),
+                               type(e).__name__, e)
+                    insight_index = {}
+
+            insights = self._get_insights(recommendations_service,
+                                          insight_names,
+                                          insight_index)
+
+            if self._incremental:
+                recommendations = stale
+            yield from _join_insights(project, recommendations, insights,
+                                      cached_insights)
+
+        yield from self._scanned_marker(project, names)
+
+        cache_stats = util_gcp.client_cache_stats()
+        _log.info('Fetched recommendations for project: %s; '
+                  'unchanged recommendations: %d; '
+                  'client cache hits: %d; client builds: %d',
+                  hlogging.obfuscated(project), reused_count,
+                  cache_stats['hits'], cache_stats['builds'])
+
+    def _split_cached(self, recommendations):
+        """Split recommendations by whether their insights must be fetched.
+
+        Arguments:
+            recommendations (list): A page of recommendations.
+
+        Returns:
+            tuple: A list of the recommendations that are new or whose
+                etag has changed since they were cached, and a
+                dictionary of the cached lists of insights of the other
+                recommendations keyed by recommendation name.
+
+        """
+        if self._cache is None:
+            return recommendations, {}
+
+        cached = self._cache.lookup([r['name'] for r in recommendations])
+        stale = []
+        cached_insights = {}
+        for recommendation in recommendations:
+            name = recommendation['name']
+            if name in cached and cached[name][0] == recommendation.get('etag'):
+                cached_insights[name] = cached[name][2]
+            else:
+                stale.append(recommendation)
+        return stale, cached_insights
+
+    def _scanned_marker(self, project, names):
+        """Generate a marker of a project whose listing has completed.
+
+        The marker is consumed by :meth:`read`, which stages it in the
+        cache, so that cached recommendations of the project that were
+        not listed again are pruned. Nothing is generated without a
+        cache.
+
+        Arguments:
+            project (str): Project ID.
+            names (list): Names of all recommendations listed for the
+                project.
+
+        Yields:
+            dict: The marker.
+
+        """
+        if self._cache is not None:
+            yield {'scanned_project': project,
+                   'recommendation_names': names}
+
+
+    def _list_insights(self, recommendations_service, project):
+        """List all IAM policy insights of a project.
+
+        Arguments:
+            recommendations_service (Resource): Recommender resource object.
+            project (str): Project ID.
 
-            # Fetch the insights for each recommendation
-            _insights = []
+        Returns:
+            dict: Insights of the project keyed by their names.
 
-            for insight in recommendation.get('associatedInsights', None):
-                _pattern = insight.get('insight', None)
-                if _pattern:
-                    i = (recommendations_service
-                                .projects()
-                                .locations()
-                                .insightTypes()
-                                .insights().get(name=_pattern).execute())
-                    _insights.append(i)
+        """
+        parent_string = _insight_type_parent(project)
+
+        insights_iterator = util_gcp.get_resource_iterator((recommendations_service
+                            .projects()
+                            .locations()
+                            .insightTypes()
+                            .insights()), 'insights',
+                            self._limiters.get('recommender'),
+                            self._max_retries, parent=parent_string)
+
+        return {insight['name']: insight for insight in insights_iterator}
+
+    def _get_insights(self, recommendations_service, insight_names,
+                      insight_index=None):
+        """Fetch insights by their names.
 
-            recommendation.update(
-                { 'insights': _insights }
-            )
+        Arguments:
+            recommendations_service (Resource): Recommender resource object.
+            insight_names (list): Names of the insights to fetch.
+            insight_index (dict): Insights already listed for the project,
+                keyed by their names. Insights found here are not
+                fetched again.
+
+        Returns:
+            dict: Insights keyed by their names.
 
-            yield {
-                'raw': recommendation
-            }
+        """
+        insights = {}
+        if insight_index is not None:
+            insights = {name: insight_index[name] for name in insight_names
+                        if name in insight_index}
+            # Anything the listing did not return, e.g., because it
+            # failed, is still fetched by name below.
+            insight_names = [name for name in insight_names
+                             if name not in insights]
+
+        insights_resource = (recommendations_service
+                             .projects()
+                             .locations()
+                             .insightTypes()
+                             .insights())
+
+        limiter = self._limiters.get('recommender')
+
+        if self._insights_mode == 'batch':
+            requests = {name: insights_resource.get(name=name)
+                        for name in insight_names}
+            insights.update(util_gcp.execute_batch(recommendations_service,
+                                                   requests,
+                                                   self._insights_batch_size,
+                                                   self._insights_num_retries,
+                                                   limiter))
+        else:
+            insights.update({name: util_gcp.execute_request(
+                                 insights_resource.get(name=name),
+                                 limiter, self._max_retries)
+                             for name in insight_names})
+
+        return insights
+
+    async def _read_async(self):
+        """Generate records of all projects from the running event loop.
 
-        _log.info('Fetched recommendations for project: %s', hlogging.obfuscated(project))
+        Yields:
+            dict: A GCP cloud infrastructure configuration record.
 
+        """
+        from . import gcpasync
+
+        async with gcpasync.AsyncGCPClient(self._key_file_path,
+                                           self._concurrency,
+                                           self._limiters,
+                                           self._max_retries) as client:
+
+            async def get_parents():
+                # Breadth-first traversal of the folder tree; the
+                # folders of a level are listed concurrently.
+                level = list(self._parents)
+                while level:
+                    for parent in level:
+                        yield parent
+                    if not self._recursive:
+                        break
+                    children = await asyncio.gather(
+                        *(list_folders(parent) for parent in level))
+                    level = [folder for folders in children
+                             for folder in folders]
+
+            async def list_folders(parent):
+                folders_iterator = client.list(
+                    gcpasync.CLOUDRESOURCEMANAGER_V2_URL + 'folders',
+                    'folders', parent=parent)
+                return [folder['name'] async for folder in folders_iterator]
+
+            async def list_projects(parent):
+                project_filter = util_gcp.project_filter(
+                    self._lifecycle_state, self._labels, parent)
+                params = {'filter': project_filter} if project_filter else {}
+                projects_iterator = client.list(
+                    gcpasync.CLOUDRESOURCEMANAGER_URL + 'projects',
+                    'projects', **params)
+                async for project in projects_iterator:
+                    yield project['projectId']
+
+            async def get_projects():
+                if self._projects != '*':
+                    projects = gcpasync.from_iterable(self._projects)
+                elif not self._parents:
+                    projects = list_projects(None)
+                else:
+                    projects = gcpasync.map_unordered(
+                        list_projects, get_parents(),
+                        self._discovery_threads, __name__)
+
+                project_count = 0
+                async for project in projects:
+                    if project in self._exclude_projects:
+                        continue
+                    project_count += 1
+                    yield project
+                _log.info('Projects scheduled: %d', project_count)
+
+            get_recommendations = functools.partial(
+                self._get_recommendations_async, client)
+
+            records = gcpasync.map_unordered(get_recommendations,
+                                             get_projects(),
+                                             self._concurrency,
+                                             __name__)
+            async for record in records:
+                yield record
+
+    async def _get_recommendations_async(self, client, project):
+        """Generate recommendation records of a project asynchronously.
+
+        This is the ``async`` mode counterpart of
+        :meth:`_get_recommendations`.
+
+        Arguments:
+            client (AsyncGCPClient): Client to send requests with.
+            project (str): Project ID.
+
+        Yields:
+            dict: A GCP cloud infrastructure configuration record.
+
+        """
+        from . import gcpasync
+
+        _log.info('Fetching recommendations for project : %s ...', hlogging.obfuscated(project))
+
+        pages = client.list(gcpasync.RECOMMENDER_URL
+                            + _recommender_parent(project)
+                            + '/recommendations', None)
+
+        insight_index = None
+        reused_count = 0
+
+        names = []
+
+        async for page in pages:
+            recommendations = page.get('recommendations', [])
+            names.extend(r['name'] for r in recommendations)
+            stale, cached_insights = self._split_cached(recommendations)
+            reused_count += len(cached_insights)
+
+            insight_names = _insight_names(stale)
+            if (self._insights_mode == 'list' and insight_index is None
+                    and insight_names):
+                insights_iterator = client.list(gcpasync.RECOMMENDER_URL
+                                                + _insight_type_parent(project)
+                                                + '/insights', 'insights')
+                try:
+                    insight_index = {insight['name']: insight
+                                     async for insight in insights_iterator}
+                except Exception as e:
+                    # The insights are fetched by name instead.
+                    _log.error('Failed to list insights for project: %s; '
+                               'error: %s: %s', hlogging.obfuscated(project),
+                               type(e).__name__, e)
+                    insight_index = {}
+
+            insights = {}
+            if insight_index is not None:
+                insights = {name: insight_index[name] for name in insight_names
+                            if name in insight_index}
+                insight_names = [name for name in insight_names
+                                 if name not in insights]
+
+            responses = await asyncio.gather(
+                *(client.get(gcpasync.RECOMMENDER_URL + name)
+                  for name in insight_names))
+            insights.update(zip(insight_names, responses))
+
+            if self._incremental:
+                recommendations = stale
+            for record in _join_insights(project, recommendations, insights,
+                                         cached_insights):
+                yield record
+
+        for record in self._scanned_marker(project, names):
+            yield record
+
+        _log.info('Fetched recommendations for project: %s; '
+                  'unchanged recommendations: %d',
+                  hlogging.obfuscated(project), reused_count)
 
     def done(self):
         """Log a message that this plugin is done."""
         _log.info('GCP IAM Audit done')
- 
\ No newline at end of file
+ 
+
+
+def _recommender_parent(project):
+    """Return the parent resource name of the IAM recommendations of a project."""
+    return 'projects/{project}/locations/{location}/recommenders/{recommenders}'.format(
+        project=project,
+        location='global',
+        recommenders='google.iam.policy.Recommender'
+    )
+
+
+def _insight_type_parent(project):
+    """Return the parent resource name of the IAM policy insights of a project."""
+    return 'projects/{project}/locations/{location}/insightTypes/{insight_type}'.format(
+        project=project,
+        location='global',
+        insight_type='google.iam.policy.Insight'
+    )
+
+
+def _join_insights(project, recommendations, insights, cached_insights=None):
+    """Generate records of recommendations joined with their insights.
+
+    Arguments:
+        project (str): Project ID.
+        recommendations (list): Recommendations of the project.
+        insights (dict): Insights keyed by their names.
+        cached_insights (dict): Cached lists of insights keyed by
+            recommendation name. These take precedence over
+            ``insights``.
+
+    Yields:
+        dict: A GCP cloud infrastructure configuration record.
+
+    """
+    cached_insights = cached_insights or {}
+
+    for recommendation in recommendations:
+        recommendation.update({'project': project})
+
+        if recommendation['name'] in cached_insights:
+            _insights = cached_insights[recommendation['name']]
+        else:
+            _insights = [insights[name]
+                         for name in _insight_names([recommendation])
+                         if name in insights]
+
+        recommendation.update(
+            { 'insights': _insights }
+        )
+
+        yield {
+            'raw': recommendation
+        }
+
+
+def _insights_complete(recommendation):
+    """Return whether all insights of a recommendation were fetched.
+
+    Arguments:
+        recommendation (dict): Recommendation joined with its insights
+            under the ``insights`` key.
+
+    Returns:
+        bool: ``True`` if every associated insight is present.
+
+    """
+    fetched = {insight.get('name')
+               for insight in recommendation.get('insights', [])
+               if isinstance(insight, dict)}
+    return all(name in fetched for name in _insight_names([recommendation]))
+
+
+def _insight_names(recommendations):
+    """Return the names of the insights associated with recommendations.
+
+    Arguments:
+        recommendations (list): Recommendation records.
+
+    Returns:
+        list: Insight names in order of appearance without duplicates.
+
+    """
+    names = {}
+    for recommendation in recommendations:
+        for insight in recommendation.get('associatedInsights', []):
+            name = insight.get('insight', None)
+            if name:
+                names[name] = None
+    return list(names)
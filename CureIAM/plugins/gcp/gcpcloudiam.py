@@ -1,12 +1,15 @@
 """Plugin to process the data retrieved from `gcpcloud.CureIAM` plugin
 """
 
-import json
 import datetime
+import time
+from concurrent import futures
 
 """ . = CureIAM which is the current module, for now it changes, to remove any depedency name incase if there is any changes folder name in the future
 """
 
+from googleapiclient import errors
+
 from CureIAM.models.iamriskscore import IAMRiskScoreModel
 from CureIAM.models.applyrecommendationmodel import IAMApplyRecommendationModel
 from CureIAM.helpers import hlogging
@@ -15,6 +18,14 @@ from . import util_gcp #call function from same folder
 # Define module-level logger.
 _log = hlogging.get_logger(__name__)
 
+# HTTP status codes of setIamPolicy responses when the policy has been
+# changed since it was read, i.e., its etag no longer matches.
+_POLICY_CONFLICT_STATUSES = (409, 412)
+
+# Number of times the IAM policy of a project is read and updated again
+# after a conflict.
+_POLICY_CONFLICT_RETRIES = 3
+
 class GCPIAMRecommendationProcessor:
     """SimpleProcessor plugin to perform processing on 
         gcpcloud.CureIAM IAMRecommendation_record."""
@@ -28,6 +39,20 @@ class GCPIAMRecommendationProcessor:
         """
         self._recommendation_applied = 0
         self._recommendation_applied_today = 0
+        self._records_failed = 0
+
+        # Pending and reconciled markSucceeded calls, see
+        # init_mark_succeeded.
+        self._mark_executor = None
+        self._mark_futures = set()
+        self._recommendation_marked = 0
+        self._recommendation_mark_failed = 0
+
+        # Records of the recommendations approved for enforcement, keyed
+        # by project, held back until the group of the project is full
+        # or old enough, see init_enforce_groups.
+        self._pending_enforcement = {}
+        self._pending_since = {}
 
         # Checking the mode, if scan mode is on, then run the scan. If mode enforce is on, then enforce the change according to the recommendation
         self._mode_scan = mode_scan
@@ -48,6 +73,12 @@ class GCPIAMRecommendationProcessor:
 
             # init cloud resources
             self.init_cloud_resource(self._enforcer)
+
+            # init markSucceeded thread pool
+            self.init_mark_succeeded(self._enforcer)
+
+            # init grouping of enforced recommendations per project
+            self.init_enforce_groups(self._enforcer)
     
     def init_blocklist(self, enforcer=None):
         # Don't perform operations on these projects
@@ -84,11 +115,29 @@ class GCPIAMRecommendationProcessor:
             service_name='cloudresourcemanager',
             key_file_path=self._apply_recommendations_svc_acc_key_file
         )
-        self._recommender_resource = util_gcp.build_resource(
-            service_name='recommender',
-            key_file_path=self._apply_recommendations_svc_acc_key_file
+
+    def init_mark_succeeded(self, enforcer=None):
+        # Recommendations are marked succeeded by a pool of threads, so
+        # that evaluation of the next records does not wait for them.
+        # At most mark_succeeded_threads calls run at once, and each is
+        # retried up to mark_succeeded_retries times.
+        self._mark_succeeded_threads = enforcer.get('mark_succeeded_threads', 8)
+        self._mark_succeeded_retries = enforcer.get('mark_succeeded_retries', 5)
+
+        self._mark_executor = futures.ThreadPoolExecutor(
+            max_workers=self._mark_succeeded_threads,
+            thread_name_prefix='mark_succeeded'
         )
 
+    def init_enforce_groups(self, enforcer=None):
+        # The approved recommendations of a project are applied together
+        # with one IAM policy update once enforce_group_size of them are
+        # held back, or once the oldest of them has waited for
+        # enforce_group_wait seconds. The age is checked whenever records
+        # are evaluated.
+        self._enforce_group_size = enforcer.get('enforce_group_size', 50)
+        self._enforce_group_wait = enforcer.get('enforce_group_wait', 30)
+
     """
         SECTION for initiation that has been done only once to generate the list of value
     """
@@ -96,6 +145,16 @@ class GCPIAMRecommendationProcessor:
     def eval(self, record):
         """Function to perform data processing.
 
+        Records of recommendations approved for enforcement are held
+        back per project, so that the recommendations of a project are
+        applied together with one IAM policy update. A project's group
+        is applied, and its records yielded, once it holds
+        ``enforce_group_size`` records or its oldest record has waited
+        for ``enforce_group_wait`` seconds. This is checked by ``eval``
+        and :meth:`eval_batch` alike, so records of a project evaluated
+        one at a time are grouped too. The groups left at the end of the
+        input are applied by :meth:`eval_flush`.
+
         Arguments:
             record (dict): Record to evaluate.
                 {
@@ -165,158 +224,355 @@ class GCPIAMRecommendationProcessor:
         # from the gcpcloud.GCPCloudIAMRecommendations
 
         iam_raw_record = record.get('raw', {})
-        recommendation_dict = dict()
 
         if iam_raw_record is not None:
+            try:
+                recommendation_dict = self._recommendation_dict(iam_raw_record)
+                score = IAMRiskScoreModel(recommendation_dict).score()
+                _res = self._result(iam_raw_record, recommendation_dict, score)
+            except Exception as e:
+                _log.error('Failed to process recommendation: %s; '
+                           'error: %s: %s', iam_raw_record.get('name'),
+                           type(e).__name__, e)
+                self._records_failed += 1
+                return
+            yield from self._hold_approved([_res])
+
+    def eval_batch(self, records):
+        """Function to perform data processing on a batch of records.
+
+        This is equivalent to calling :meth:`eval` for each record, but
+        the scores of the batch are computed together with
+        :meth:`IAMRiskScoreModel.score_batch`. If batch scoring fails,
+        the records are scored one at a time instead. Like with
+        :meth:`eval`, the records of recommendations approved for
+        enforcement are held back per project until their group is
+        applied.
+
+        Arguments:
+            records (list): Records to evaluate. See :meth:`eval`.
+
+        Yields:
+            dict: Processed record.
+
+        """
+        processed = []
+        for record in records:
+            iam_raw_record = record.get('raw', {})
+            if iam_raw_record is None:
+                continue
+            try:
+                processed.append(
+                    (iam_raw_record, self._recommendation_dict(iam_raw_record)))
+            except Exception as e:
+                _log.error('Failed to process recommendation: %s; '
+                           'error: %s: %s', iam_raw_record.get('name'),
+                           type(e).__name__, e)
+                self._records_failed += 1
+
+        try:
+            scores = IAMRiskScoreModel.score_batch(
+                [recommendation_dict for _, recommendation_dict in processed])
+        except Exception as e:
+            _log.error('Failed to score batch of %d recommendations; '
+                       'scoring one at a time; error: %s: %s',
+                       len(processed), type(e).__name__, e)
+            scores = None
+
+        results = []
+        for i, (iam_raw_record, recommendation_dict) in enumerate(processed):
+            try:
+                if scores is None:
+                    score = IAMRiskScoreModel(recommendation_dict).score()
+                else:
+                    score = scores[i]
+                results.append(
+                    self._result(iam_raw_record, recommendation_dict, score))
+            except Exception as e:
+                _log.error('Failed to process recommendation: %s; '
+                           'error: %s: %s', iam_raw_record.get('name'),
+                           type(e).__name__, e)
+                self._records_failed += 1
+
+        yield from self._hold_approved(results)
+
+    def _recommendation_dict(self, iam_raw_record):
+        """Extract the processor fields of a raw recommendation record.
+
+        Arguments:
+            iam_raw_record (dict): Recommendation joined with its
+                insights by the GCP cloud plugin.
+
+        Returns:
+            dict: Processor fields of the recommendation.
+
+        """
+        recommendation_dict = dict()
+
+        recommendation_dict.update(
+            {
+                'project' : iam_raw_record['project'],
+                'recommendation_id': iam_raw_record['name'],
+                'recommendation_description': iam_raw_record['description'],
+                'recommendation_actions' : iam_raw_record['content']['operationGroups'][0]['operations'],
+                'recommendetion_recommender_subtype': iam_raw_record['recommenderSubtype'],
+                'recommendation_insights': [ i.get('insights') for i in iam_raw_record['associatedInsights']]
+            }
+        )
+        # Identify the account type on which recommendation is fetched
+        # If iam_raw_record['recommenderSubtype'] is REPLACE_ROLE, then user 
+        # info will be present as iam_raw_record['content']['operationGroups']['operations'] list
+        _actor = ''
+        _actor_total_permissions = 0
+        _actor_exercised_permissions = 0
+        _actor_exercised_permissions_category = ''
+
+        for op_grp in iam_raw_record['content']['operationGroups']:
+            for op in op_grp['operations']:
+                if op['action'] == 'remove':
+                    _actor = op['pathFilters']['/iamPolicy/bindings/*/members/*']
+            # After above parsing _actor would contain something like
+            # <account_type>:<account_id>
+            _actor_type, _actor = _actor.split(':')
             recommendation_dict.update(
                 {
-                    'project' : iam_raw_record['project'],
-                    'recommendation_id': iam_raw_record['name'],
-                    'recommendation_description': iam_raw_record['description'],
-                    'recommendation_actions' : iam_raw_record['content']['operationGroups'][0]['operations'],
-                    'recommendetion_recommender_subtype': iam_raw_record['recommenderSubtype'],
-                    'recommendation_insights': [ i.get('insights') for i in iam_raw_record['associatedInsights']]
+                'account_type': _actor_type,
+                'account_id': _actor
                 }
             )
-            # Identify the account type on which recommendation is fetched
-            # If iam_raw_record['recommenderSubtype'] is REPLACE_ROLE, then user 
-            # info will be present as iam_raw_record['content']['operationGroups']['operations'] list
-            _actor = ''
-            _actor_total_permissions = 0
-            _actor_exercised_permissions = 0
-            _actor_exercised_permissions_category = ''
-
-            for op_grp in iam_raw_record['content']['operationGroups']:
-                for op in op_grp['operations']:
-                    if op['action'] == 'remove':
-                        _actor = op['pathFilters']['/iamPolicy/bindings/*/members/*']
-                # After above parsing _actor would contain something like
-                # <account_type>:<account_id>
-                _actor_type, _actor = _actor.split(':')
-                recommendation_dict.update(
-                    {
-                    'account_type': _actor_type,
-                    'account_id': _actor
-                    }
-                )
 
-            # Get all the Permissions the current actor have
-            # insights is a list, in case of multiple insights
-            # all insights will have same `currentTotalPermissionsCount`
-            # So we are good to include the results from the first one
-            # only.
-            insights = iam_raw_record.get('insights', None)
-            if insights:
-                _content = insights[0].get('content', None)
-                if _content:
-                    _actor_exercised_permissions = len(_content.get(
-                        'exercisedPermissions',
+        # Get all the Permissions the current actor have
+        # insights is a list, in case of multiple insights
+        # all insights will have same `currentTotalPermissionsCount`
+        # So we are good to include the results from the first one
+        # only.
+        insights = iam_raw_record.get('insights', None)
+        if insights:
+            _content = insights[0].get('content', None)
+            if _content:
+                _actor_exercised_permissions = len(_content.get(
+                    'exercisedPermissions',
+                    []
+                )) + len(
+                    _content.get(
+                        'inferredPermissions',
                         []
-                    )) + len(
-                        _content.get(
-                            'inferredPermissions',
-                            []
-                        )
-                    )
-                    _actor_total_permissions = _content.get(
-                        'currentTotalPermissionsCount',
-                        '0'
-                    )
-                    _actor_exercised_permissions_category = insights[0].get(
-                        'category',
-                        ''
                     )
+                )
+                _actor_total_permissions = _content.get(
+                    'currentTotalPermissionsCount',
+                    '0'
+                )
+                _actor_exercised_permissions_category = insights[0].get(
+                    'category',
+                    ''
+                )
 
-            recommendation_dict.update(
-                {
-                    'account_total_permissions': int(_actor_total_permissions),
-                    'account_used_permissions': _actor_exercised_permissions,
-                    'account_permission_insights_category': _actor_exercised_permissions_category
-                }
-            )   
+        recommendation_dict.update(
+            {
+                'account_total_permissions': int(_actor_total_permissions),
+                'account_used_permissions': _actor_exercised_permissions,
+                'account_permission_insights_category': _actor_exercised_permissions_category
+            }
+        )   
+
+        return recommendation_dict
+
+    def _result(self, iam_raw_record, recommendation_dict, score):
+        """Build the processed record of a recommendation.
 
-            _res =  { 
-                'raw': iam_raw_record,
-                'processor':  recommendation_dict ,
-                'score': IAMRiskScoreModel(recommendation_dict).score(),
-                'apply_recommendation': IAMApplyRecommendationModel(recommendation_dict).model()
+        Arguments:
+            iam_raw_record (dict): Recommendation joined with its
+                insights by the GCP cloud plugin.
+            recommendation_dict (dict): Processor fields of the
+                recommendation.
+            score (dict): Scores of the recommendation.
+
+        Returns:
+            dict: Processed record.
+
+        """
+        _res =  { 
+            'raw': iam_raw_record,
+            'processor':  recommendation_dict ,
+            'score': score,
+            'apply_recommendation': IAMApplyRecommendationModel(recommendation_dict).model()
+        }
+
+        _res['apply_recommendation'].update(
+            {
+                'safe_to_apply_score': _res['score']['safe_to_apply_recommendation_score']
             }
+        )
 
-            _res['apply_recommendation'].update(
-                {
-                    'safe_to_apply_score': _res['score']['safe_to_apply_recommendation_score']
-                }
-            )
+        # To shorten the logging mechanism
+        recommendation_info = recommendation_dict['recommendation_id'].split("/")
+        # print ("{}".format(hlogging.obfuscated(recommendation_info[1])))
+        # print ("{}".format(hlogging.obfuscated(recommendation_info[7])))
+
+        # If recommendation was applied in past
+        # update the risk score and safe_to_apply_
+        # _score to 0
+
+        if _res['raw']['stateInfo']['state']=='SUCCEEDED':
+            _res['score'].update(
+                    {
+                        'risk_score': 0,
+                        'over_privilege_score': 0
+                    }
+                )
+            
+            self._recommendation_applied += 1
+            # _log.info('APPLIED in the past, setting score to 0#Project:%s,Recommendations:%s', recommendation_info[1], recommendation_info[7])
+        
+        return _res
+
+    def _hold_approved(self, results):
+        """Hold back the records of recommendations to be enforced.
+
+        Active recommendations approved by :meth:`_enforce_recommendation`
+        are grouped per project. The groups that are full or old enough
+        are applied, and their records returned along with the records
+        not held back. A record whose approval fails with an error is
+        logged as not applied and returned like the rest.
 
-            # To shorten the logging mechanism
-            recommendation_info = recommendation_dict['recommendation_id'].split("/")
-            # print ("{}".format(hlogging.obfuscated(recommendation_info[1])))
-            # print ("{}".format(hlogging.obfuscated(recommendation_info[7])))
+        Arguments:
+            results (list): Processed records.
+
+        Returns:
+            list: Processed records to yield now.
+
+        """
+        if not self._enforcer:
+            return results
+
+        # enforce the recommendation before saving it in DB.
+        # Also dont re-apply the recommendation is it is already applied
+        emitted = []
+        for _res in results:
+            if _res['raw']['stateInfo']['state'] != 'ACTIVE':
+                emitted.append(_res)
+                continue
+
+            recommendation_info = _res['processor']['recommendation_id'].split("/")
+            _log.info('ENFORCING#Project:%s,Recommendations:%s', hlogging.obfuscated(recommendation_info[1]), hlogging.obfuscated(recommendation_info[7]))
+            try:
+                approved = self._enforce_recommendation(_res)
+            except Exception as e:
+                _log.error('Failed to validate recommendation: %s; '
+                           'error: %s: %s',
+                           hlogging.obfuscated(recommendation_info[7]),
+                           type(e).__name__, e)
+                approved = False
+
+            if approved:
+                _project = _res['processor']['project']
+                group = self._pending_enforcement.setdefault(_project, [])
+                if not group:
+                    self._pending_since[_project] = time.monotonic()
+                group.append(_res)
+                if len(group) >= self._enforce_group_size:
+                    emitted.extend(self._enforce_group(_project))
+            else:
+                _log.info('NOT-APPLIED#Project:%s,Recommendations:%s', hlogging.obfuscated(recommendation_info[1]), hlogging.obfuscated(recommendation_info[7]))
+                emitted.append(_res)
+
+        now = time.monotonic()
+        for _project, since in list(self._pending_since.items()):
+            if now - since >= self._enforce_group_wait:
+                emitted.extend(self._enforce_group(_project))
+
+        return emitted
+
+    def eval_flush(self):
+        """Enforce the remaining held back recommendations.
+
+        This is called once after the last record has been evaluated,
+        for the groups that were neither full nor old enough to be
+        applied by then.
+
+        Processor replicas should partition records by project, as
+        they do by default, so that each project is updated by a single
+        replica.
+
+        Yields:
+            dict: Processed record of each held back recommendation.
+
+        """
+        for _project in list(self._pending_enforcement):
+            yield from self._enforce_group(_project)
 
-            # If recommendation was applied in past
-            # update the risk score and safe_to_apply_
-            # _score to 0
+    def _enforce_group(self, _project):
+        """Apply the held back recommendations of a project.
 
-            if _res['raw']['stateInfo']['state']=='SUCCEEDED':
+        The recommendations are applied with one IAM policy update by
+        :meth:`_execute_recommendations`. If that fails, only the
+        recommendations of this group are not applied.
+
+        Arguments:
+            _project (str): Project ID.
+
+        Returns:
+            list: Processed records of the recommendations.
+
+        """
+        project_results = self._pending_enforcement.pop(_project, [])
+        self._pending_since.pop(_project, None)
+        if not project_results:
+            return []
+
+        try:
+            _recomemndation_applied = self._execute_recommendations(_project, project_results)
+        except Exception as e:
+            _log.error('Failed to enforce recommendations of project: %s; '
+                       'error: %s: %s', hlogging.obfuscated(_project),
+                       type(e).__name__, e)
+            _recomemndation_applied = False
+
+        for _res in project_results:
+            recommendation_info = _res['processor']['recommendation_id'].split("/")
+            if _recomemndation_applied:
+                _res['raw']['stateInfo']['state'] = 'SUCCEEDED'
+                _res['apply_recommendation'].update(
+                    {
+                        'recommendation_state': 'Applied',
+                        'recommendation_applied_time': str(datetime.datetime.utcnow().isoformat())
+                    }
+                )
                 _res['score'].update(
-                        {
-                            'risk_score': 0,
-                            'over_privilege_score': 0
-                        }
-                    )
-                
-                self._recommendation_applied += 1
-                # _log.info('APPLIED in the past, setting score to 0#Project:%s,Recommendations:%s', recommendation_info[1], recommendation_info[7])
-            
-            # enforce the recommendation before saving it in DB.
-            # Also dont re-apply the recommendation is it is already applied
-            if self._enforcer and _res['raw']['stateInfo']['state']=='ACTIVE':
-                _log.info('ENFORCING#Project:%s,Recommendations:%s', hlogging.obfuscated(recommendation_info[1]), hlogging.obfuscated(recommendation_info[7]))
-                _recomemndation_applied = self._enforce_recommendation(_res)
-
-                if _recomemndation_applied:
-                    _res['raw']['stateInfo']['state'] = 'SUCCEEDED'
-                    _res['apply_recommendation'].update(
-                        {
-                            'recommendation_state': 'Applied',
-                            'recommendation_applied_time': str(datetime.datetime.utcnow().isoformat())
-                        }
-                    )
-                    _res['score'].update(
-                        {
-                            'risk_score': 0,
-                            'over_privilege_score': 0
-                        }
-                    )
-                    self._recommendation_applied_today += 1
-                    _log.info('APPLIED#Project:%s,Recommendations:%s', hlogging.obfuscated(recommendation_info[1]), hlogging.obfuscated(recommendation_info[7]))
-                
-                else:
-                    _log.info('NOT-APPLIED#Project:%s,Recommendations:%s', hlogging.obfuscated(recommendation_info[1]), hlogging.obfuscated(recommendation_info[7]))
-            
-            yield _res
-            
+                    {
+                        'risk_score': 0,
+                        'over_privilege_score': 0
+                    }
+                )
+                self._recommendation_applied_today += 1
+                _log.info('APPLIED#Project:%s,Recommendations:%s', hlogging.obfuscated(recommendation_info[1]), hlogging.obfuscated(recommendation_info[7]))
+
+            else:
+                _log.info('NOT-APPLIED#Project:%s,Recommendations:%s', hlogging.obfuscated(recommendation_info[1]), hlogging.obfuscated(recommendation_info[7]))
+
+        return project_results
 
     def _enforce_recommendation(self, record):
-        """Method to perform Recommendation enforcement
+        """Method to decide on Recommendation enforcement
         
         IAM recommendation doesn't have API to apply the recommendation
-        directly rather we will have to create IAM resource which will
-        perform the policy enforcement. This method does the same.
+        directly rather we will have to update the IAM policy of the
+        project ourselves. This method decides whether we should, and
+        :meth:`_execute_recommendations` does it.
 
         Arguments:
             record(dict): dict record contaning raw + processor record
 
         Returns:
-            bool: Indicating if the we were able to successfully apply
-            recommendation or not.
+            bool: Indicating if the recommendation should be applied in
+            enforcing mode.
         """
 
         """
         Flow:
-        Apply IAM policy from recommender
-            - success
-                - mark recommendation as succeeded
+        Validate recommendation against the enforcer config
+            - approved and enforcing mode
                 - return True
             - no
                 - dont change the recommendation status
@@ -325,16 +581,11 @@ class GCPIAMRecommendationProcessor:
         if not self._mode_scan:
             return
         
-        cloud_resource = self._cloud_resource
-        recommender_resource = self._recommender_resource
-
         _processor_record = record.get('processor', None)
         _score_record = record.get('score', None)
 
         if _processor_record and _score_record:
             _project = _processor_record.get('project', None)
-            _recommendation_actions = _processor_record.get('recommendation_actions', None)
-            _recommendation_id = _processor_record.get('recommendation_id', None)
             _account_id = _processor_record.get('account_id')
             _account_type = _processor_record.get('account_type')
             _safety_score = _score_record.get('safe_to_apply_recommendation_score', None)
@@ -373,12 +624,11 @@ class GCPIAMRecommendationProcessor:
                           _account_type)
                 if self._mode_enforce:
                     _log.info('XXX# END of enforcing mode #XXX\n\n')            
-                    _status = self._execute_recommendation(cloud_resource=cloud_resource, _project=_project)
                 else:
                     _log.info('XXX# END of scan only mode #XXX\n\n')
                     return False
             
-                # So we have applied recommendation and we are good.
+                # So we should apply recommendation and we are good.
                 return True
         
         return False
@@ -389,15 +639,15 @@ class GCPIAMRecommendationProcessor:
     """
 
     def _validate_blacklist(self, _project, _account_id, _account_type): # will do the cleanup code later
-        if (_project in self._apply_recommendation_blocklist_projects):
+        if (_project in (self._apply_recommendation_blocklist_projects or [])):
             _log.warn("Project %s is in excluded list", hlogging.obfuscated(_project))
             return False
 
-        if (_account_id in self._apply_recommendation_blocklist_accounts):
+        if (_account_id in (self._apply_recommendation_blocklist_accounts or [])):
             _log.warn("Account %s is in excluded list", hlogging.obfuscated(_account_id))
             return False
 
-        if (_account_type in self._apply_recommendation_blocklist_account_types):
+        if (_account_type in (self._apply_recommendation_blocklist_account_types or [])):
             _log.warn("Account type %s is in excluded list", _account_type)
             return False
 
@@ -425,18 +675,82 @@ class GCPIAMRecommendationProcessor:
     """
         SECTION for execute in GCP
     """
-    def _execute_recommendation(self,cloud_resource, _project): #will do more cleanup
-
-        _policies = (
-            cloud_resource.projects()
-            .getIamPolicy(
-                resource=_project,
-                body={"options": {"requestedPolicyVersion": "1"}}
-            ).execute()
-        )
+    def _execute_recommendations(self, _project, results):
+        """Apply the recommendations of a project in one policy update.
+
+        The IAM policy of the project is read once, the add and remove
+        operations of all the recommendations are applied to it in
+        memory, and it is written back with a single ``setIamPolicy``
+        call. The policy carries the etag it was read with, so the write
+        fails with a conflict if the policy has changed in the meantime.
+        In that case the policy is read and updated again, up to
+        ``_POLICY_CONFLICT_RETRIES`` times. Once the policy is written,
+        each recommendation is marked succeeded.
 
-        _updated_policies = _policies
+        Arguments:
+            _project (str): Project ID.
+            results (list): Processed records of the recommendations.
 
+        Returns:
+            bool: Whether the recommendations have been applied.
+
+        """
+        projects = self._cloud_resource.projects()
+
+        attempt = 0
+        while True:
+            try:
+                # Version 3 keeps conditional role bindings intact.
+                _policy = util_gcp.execute_request(projects.getIamPolicy(
+                    resource=_project,
+                    body={'options': {'requestedPolicyVersion': 3}}
+                ))
+
+                for _res in results:
+                    self._apply_recommendation_actions(
+                        _policy, _res['processor']['recommendation_actions'])
+
+                util_gcp.execute_request(projects.setIamPolicy(
+                    resource=_project, body={'policy': _policy}
+                ))
+                break
+
+            except errors.HttpError as e:
+                if (e.resp.status in _POLICY_CONFLICT_STATUSES
+                        and attempt < _POLICY_CONFLICT_RETRIES):
+                    attempt += 1
+                    _log.warning('IAM policy of project %s changed while '
+                                 'updating it; retrying; attempt: %d',
+                                 hlogging.obfuscated(_project), attempt)
+                    continue
+                _log.error('Failed to update IAM policy of project: %s; '
+                           'error: %s: %s', hlogging.obfuscated(_project),
+                           type(e).__name__, e)
+                return False
+
+            except Exception as e:
+                _log.error('Failed to update IAM policy of project: %s; '
+                           'error: %s: %s', hlogging.obfuscated(_project),
+                           type(e).__name__, e)
+                return False
+
+        _log.info('Updated IAM policy of project %s with %d recommendations',
+                  hlogging.obfuscated(_project), len(results))
+
+        for _res in results:
+            self._mark_recommendation_succeeded(_res)
+
+        return True
+
+    def _apply_recommendation_actions(self, policy, _recommendation_actions):
+        """Apply the operations of a recommendation to an IAM policy.
+
+        Arguments:
+            policy (dict): IAM policy to modify in place.
+            _recommendation_actions (list): Operations of the
+                recommendation.
+
+        """
         for _recommendation_action in _recommendation_actions:
             if _recommendation_action.get('action') == 'remove':
                 member = (
@@ -447,35 +761,58 @@ class GCPIAMRecommendationProcessor:
                     _recommendation_action.get('pathFilters')
                     .get('/iamPolicy/bindings/*/role')
                 )
-                _updated_policies = self.modify_policy_remove_member(
-                    _updated_policies,
-                    role,
-                    member
-                )
-                
+                self.modify_policy_remove_member(policy, role, member)
+
             elif _recommendation_action.get('action') == 'add':
                 member = _recommendation_action.get('value')
                 role = (
                     _recommendation_action.get('pathFilters')
                     .get('/iamPolicy/bindings/*/role')
                 )
-                _updated_policies = self.modify_policy_add_member(
-                    _updated_policies,
-                    role,
-                    member
-                )
-                
+                self.modify_policy_add_member(policy, role, member)
 
-        #Apply the policies present in recommendations
-        policy = (
-            cloud_resource.projects()
-            .setIamPolicy(resource=_project, body={'policy': _updated_policies})
-            .execute()
+    def _mark_recommendation_succeeded(self, record):
+        """Mark an applied recommendation succeeded in the recommender.
+
+        The call is submitted to the markSucceeded thread pool. If more
+        than ``mark_succeeded_threads`` calls per thread are pending,
+        this waits for some of them to complete first, so that pending
+        calls do not pile up in memory. The results are reconciled by
+        :meth:`_reconcile_mark_succeeded`.
+
+        Arguments:
+            record (dict): Processed record of the recommendation.
+
+        """
+        self._reconcile_mark_succeeded(
+            max_pending=self._mark_succeeded_threads ** 2)
+        future = self._mark_executor.submit(
+            self._mark_succeeded,
+            record['processor']['recommendation_id'],
+            record['raw']['etag']
         )
-        # print(policy)
+        future.recommendation_id = record['processor']['recommendation_id']
+        self._mark_futures.add(future)
 
-        # Update the recommendation status.
-        status = (
+    def _mark_succeeded(self, _recommendation_id, etag):
+        """Call the recommender markSucceeded API in a pool thread.
+
+        Every thread uses its own recommender client, because clients
+        are not thread-safe.
+
+        Arguments:
+            _recommendation_id (str): Recommendation name.
+            etag (str): Etag of the recommendation.
+
+        Returns:
+            dict: The updated recommendation.
+
+        """
+        recommender_resource = util_gcp.get_resource(
+            service_name='recommender',
+            key_file_path=self._apply_recommendations_svc_acc_key_file
+        )
+        request = (
             recommender_resource
             .projects()
             .locations()
@@ -483,40 +820,114 @@ class GCPIAMRecommendationProcessor:
             .recommendations()
             .markSucceeded(
                 body={
-                    'etag': record.get('raw').get('etag'),
+                    'etag': etag,
                     'stateMetadata': {
                         'reviewed-by': 'cureiam',
                         'owned-by': 'security'
                     }
                 },
                 name=_recommendation_id)
-            .execute()
         )
+        return util_gcp.execute_request(
+            request, max_retries=self._mark_succeeded_retries)
+
+    def _reconcile_mark_succeeded(self, max_pending=0):
+        """Collect the results of completed markSucceeded calls.
 
-        return _status
+        Arguments:
+            max_pending (int): Wait until at most this many calls are
+                pending. With the default of 0, wait for all of them.
+
+        """
+        pending = self._mark_futures
+        while pending:
+            done, pending = futures.wait(
+                pending,
+                timeout=None if len(pending) > max_pending else 0,
+                return_when=futures.FIRST_COMPLETED
+            )
+            for future in done:
+                try:
+                    future.result()
+                    self._recommendation_marked += 1
+                except Exception as e:
+                    self._recommendation_mark_failed += 1
+                    _log.error('Failed to mark recommendation succeeded: %s; '
+                               'error: %s: %s',
+                               hlogging.obfuscated(future.recommendation_id),
+                               type(e).__name__, e)
+            if len(pending) <= max_pending:
+                break
+        self._mark_futures = pending
 
     def modify_policy_remove_member(self, policy, role, member):
-        """Removes a  member from a role binding."""
-        try:
-            binding = next(b for b in policy["bindings"] if b["role"] == role)
-            if "members" in binding and member in binding["members"]:
+        """Removes a member from the unconditional bindings of a role.
+
+        Recommendations only cover bindings without a condition, i.e.,
+        their ``condition/expression`` path filter is empty, so
+        conditional bindings of the role are left alone. Bindings left
+        without members, e.g., by an earlier recommendation applied to
+        the same policy, are dropped, because the members of a binding
+        must not be empty.
+        """
+        for binding in policy.get("bindings", []):
+            if (binding["role"] == role and "condition" not in binding
+                    and member in binding.get("members", [])):
                 binding["members"].remove(member)
-        except StopIteration:
-            # Policy removed in previous iterations
-            pass
+
+        # Drop the bindings left without members, e.g., by the removal
+        # of another recommendation of the project.
+        policy["bindings"] = [b for b in policy.get("bindings", [])
+                              if b.get("members")]
         return policy
 
     def modify_policy_add_member(self, policy, role, member):
-        """Adds a new role binding to a policy."""
+        """Adds a member to the unconditional binding of a role.
+
+        The member joins the existing unconditional binding of the role,
+        if any, so that several recommendations adding the same role do
+        not create duplicate bindings.
+        """
+        bindings = policy.setdefault("bindings", [])
+        for binding in bindings:
+            if binding["role"] == role and "condition" not in binding:
+                if member not in binding.setdefault("members", []):
+                    binding["members"].append(member)
+                return policy
+
         binding = {"role": role, "members": [member]}
-        policy["bindings"].append(binding)
+        bindings.append(binding)
         return policy
-            
+
     def done(self):
         """Perform cleanup work.
-        Since this is a mock plugin, this method does nothing. However,
-        a typical event plugin may or may not need to perform cleanup
-        work in this method depending on its nature of work.
+
+        Waits for the pending markSucceeded calls and reconciles their
+        results.
+
+        Returns:
+            dict: Statistics of this processor, so that they can be
+                aggregated across processor replicas.
+
         """
+        if self._pending_enforcement:
+            _log.warning('Recommendations held back for enforcement were '
+                         'never applied; projects: %d',
+                         len(self._pending_enforcement))
+
+        if self._mark_executor is not None:
+            self._reconcile_mark_succeeded()
+            self._mark_executor.shutdown()
+            _log.info('Recommendations marked succeeded: %s; failed: %s',
+                      self._recommendation_marked,
+                      self._recommendation_mark_failed)
+
         _log.info('Recommendation applied: %s; Recommendations applied today: %s',
-                  self._recommendation_applied, self._recommendation_applied_today)
\ No newline at end of file
+                  self._recommendation_applied, self._recommendation_applied_today)
+        return {
+            'recommendations_applied': self._recommendation_applied,
+            'recommendations_applied_today': self._recommendation_applied_today,
+            'recommendations_marked_succeeded': self._recommendation_marked,
+            'recommendations_mark_failed': self._recommendation_mark_failed,
+            'records_failed': self._records_failed,
+        }
@@ -0,0 +1,419 @@
+"""Offline cloud plugin that replays or synthesizes IAM recommendations.
+
+This plugin yields records shaped like the ones of
+:class:`CureIAM.plugins.gcp.gcpcloud.GCPCloudIAMRecommendations` without
+calling any GCP API, so that whole audits can be run on a laptop to
+measure and regression-test the performance of the workers,
+processors and stores.
+"""
+
+import glob
+import gzip
+import io
+import itertools
+import json
+import os
+import random
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from CureIAM.helpers import hlogging
+
+_log = hlogging.get_logger(__name__)
+
+_RECOMMENDER = 'google.iam.policy.Recommender'
+_INSIGHT_TYPE = 'google.iam.policy.Insight'
+
+# Relative frequencies of the synthesized recommender subtypes and
+# account types.
+_SUBTYPES = {'REMOVE_ROLE': 5, 'REPLACE_ROLE': 4,
+             'REPLACE_ROLE_CUSTOMIZABLE': 1}
+_ACCOUNT_TYPES = {'user': 5, 'group': 1, 'serviceAccount': 4}
+
+_BROAD_ROLES = ['roles/owner', 'roles/editor', 'roles/viewer',
+                'roles/storage.admin', 'roles/bigquery.admin',
+                'roles/compute.admin', 'roles/iam.serviceAccountUser']
+_NARROW_ROLES = ['roles/storage.objectViewer', 'roles/storage.objectCreator',
+                 'roles/bigquery.dataViewer', 'roles/bigquery.jobUser',
+                 'roles/compute.viewer', 'roles/logging.viewer',
+                 'roles/monitoring.viewer', 'roles/pubsub.subscriber']
+_SERVICES = ['storage', 'bigquery', 'compute', 'logging', 'monitoring',
+             'pubsub', 'iam', 'resourcemanager']
+_VERBS = ['get', 'list', 'create', 'update', 'delete', 'setIamPolicy']
+
+# Number of characters read at once from a file holding a JSON array.
+_CHUNK_SIZE = 1 << 20
+
+
+class GCPReplayRecommendations:
+    """Cloud plugin that yields recorded or synthetic recommendations."""
+
+    def __init__(self, path=None, count=None, projects=100, rate=None,
+                 seed=0, max_added_roles=5, max_permissions=3000):
+        """Create an instance of :class:`GCPReplayRecommendations`.
+
+        If ``path`` is specified, records are replayed from the JSON
+        files there. Each file may hold a JSON array or newline
+        delimited JSON, optionally gzip or zstd compressed, e.g., the
+        output of
+        :class:`CureIAM.plugins.files.filestore.FileStore`. Each item
+        may be a record with the recommendation under its ``raw`` key
+        or a bare recommendation. The files are decompressed and parsed
+        as streams, so memory use does not grow with their size.
+        Otherwise, records of synthetic recommendations are generated.
+
+        Arguments:
+            path (str): Path of a file or directory of files to replay.
+            count (int): Number of records to yield. When replaying,
+                the recorded records are cycled through until ``count``
+                records are yielded, or yielded once by default. When
+                synthesizing, it defaults to 1000.
+            projects (int): Number of synthetic projects the synthetic
+                recommendations are spread across.
+            rate (float): Maximum number of records yielded per second.
+                There is no limit by default.
+            seed (int): Seed of the random generator, so that the same
+                synthetic records are generated by every run.
+            max_added_roles (int): Maximum number of roles added by a
+                synthetic ``REPLACE_ROLE`` recommendation. This
+                controls the size of the operation groups.
+            max_permissions (int): Maximum number of permissions
+                granted by the roles in a synthetic recommendation.
+
+        """
+        self._path = os.path.expanduser(path) if path else None
+        self._count = count
+        self._projects = projects
+        self._rate = rate
+        self._seed = seed
+        self._max_added_roles = max_added_roles
+        self._max_permissions = max_permissions
+        self._yielded = 0
+
+    def read(self):
+        """Yield recorded or synthetic recommendation records.
+
+        Yields:
+            dict: A GCP cloud infrastructure configuration record.
+
+        """
+        if self._path:
+            records = self._replay()
+            if self._count is not None:
+                records = itertools.islice(_cycle(self._replay), self._count)
+        else:
+            records = self._synthesize(1000 if self._count is None
+                                       else self._count)
+
+        start = time.monotonic()
+        for record in records:
+            if self._rate:
+                # Keep to the schedule of the configured rate instead of
+                # sleeping a fixed interval, so that slow consumers do
+                # not lower the rate further.
+                delay = start + self._yielded / self._rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._yielded += 1
+            yield record
+
+    def _replay(self):
+        """Yield the records of the files in ``path``.
+
+        Yields:
+            dict: A GCP cloud infrastructure configuration record.
+
+        """
+        if os.path.isdir(self._path):
+            # Skip the manifest written by FileStore along with the
+            # records.
+            paths = sorted(p for p in glob.glob(os.path.join(self._path, '*'))
+                           if _is_json_file(os.path.basename(p)) and
+                           os.path.basename(p) != 'manifest.json')
+        else:
+            paths = [self._path]
+
+        for path in paths:
+            if path.endswith('.zst') and zstandard is None:
+                _log.error('Package zstandard not installed; '
+                           'skipping file: %s', path)
+                continue
+
+            # Files are decompressed and parsed as a stream, so that
+            # large recordings are never held in memory as a whole.
+            with _open(path) as f:
+                for item in _items(f):
+                    if 'raw' in item:
+                        yield {'raw': item['raw']}
+                    else:
+                        yield {'raw': item}
+
+    def _synthesize(self, count):
+        """Yield records of synthetic recommendations.
+
+        Arguments:
+            count (int): Number of records to yield.
+
+        Yields:
+            dict: A GCP cloud infrastructure configuration record.
+
+        """
+        rng = random.Random(self._seed)
+        subtypes = list(_SUBTYPES)
+        subtype_weights = list(_SUBTYPES.values())
+        account_types = list(_ACCOUNT_TYPES)
+        account_type_weights = list(_ACCOUNT_TYPES.values())
+
+        for i in range(count):
+            project = 'project-{:05d}'.format(i % self._projects)
+            subtype = rng.choices(subtypes, subtype_weights)[0]
+            account_type = rng.choices(account_types, account_type_weights)[0]
+            yield {'raw': self._recommendation(rng, i, project, subtype,
+                                               account_type)}
+
+    def _recommendation(self, rng, i, project, subtype, account_type):
+        """Return a synthetic recommendation joined with its insight.
+
+        Arguments:
+            rng (random.Random): Random generator.
+            i (int): Sequence number of the recommendation.
+            project (str): Project ID.
+            subtype (str): Recommender subtype.
+            account_type (str): Type of the account in the binding.
+
+        Returns:
+            dict: Recommendation with ``project`` and ``insights`` keys
+                as added by the GCP cloud plugin.
+
+        """
+        if account_type == 'serviceAccount':
+            member = 'serviceAccount:sa-{}@{}.iam.gserviceaccount.com'.format(
+                i, project)
+        else:
+            member = '{}:{}-{}@example.com'.format(account_type,
+                                                   account_type, i)
+        resource = '//cloudresourcemanager.googleapis.com/projects/' + project
+        role = rng.choice(_BROAD_ROLES)
+
+        operations = []
+        if subtype != 'REMOVE_ROLE':
+            added_roles = rng.sample(
+                _NARROW_ROLES,
+                rng.randint(1, min(self._max_added_roles, len(_NARROW_ROLES))))
+            for added_role in added_roles:
+                operations.append({
+                    'action': 'add',
+                    'resourceType': 'cloudresourcemanager.googleapis.com/Project',
+                    'resource': resource,
+                    'path': '/iamPolicy/bindings/*/members/-',
+                    'value': member,
+                    'pathFilters': {
+                        '/iamPolicy/bindings/*/condition/expression': '',
+                        '/iamPolicy/bindings/*/role': added_role,
+                    },
+                })
+        operations.append({
+            'action': 'remove',
+            'resourceType': 'cloudresourcemanager.googleapis.com/Project',
+            'resource': resource,
+            'path': '/iamPolicy/bindings/*/members/*',
+            'pathFilters': {
+                '/iamPolicy/bindings/*/condition/expression': '',
+                '/iamPolicy/bindings/*/members/*': member,
+                '/iamPolicy/bindings/*/role': role,
+            },
+        })
+
+        total_permissions = rng.randint(10, self._max_permissions)
+        used_permissions = ([] if subtype == 'REMOVE_ROLE' else
+                            [_permission(rng) for _ in range(
+                                rng.randint(1, min(50, total_permissions)))])
+        inferred_permissions = [_permission(rng)
+                                for _ in range(rng.randint(0, 5))]
+        insight_name = ('projects/{}/locations/global/insightTypes/{}/'
+                        'insights/{:08x}'.format(project, _INSIGHT_TYPE, i))
+        insight = {
+            'name': insight_name,
+            'description': '{} of the permissions in this role binding were '
+                           'used in the past 90 days.'.format(
+                               len(used_permissions)),
+            'content': {
+                'role': role,
+                'member': member,
+                'condition': {'expression': '', 'title': '',
+                              'description': '', 'location': ''},
+                'exercisedPermissions': [{'permission': p}
+                                         for p in used_permissions],
+                'inferredPermissions': [{'permission': p}
+                                        for p in inferred_permissions],
+                'currentTotalPermissionsCount': str(total_permissions),
+            },
+            'lastRefreshTime': '2023-05-01T07:00:00Z',
+            'observationPeriod': '7776000s',
+            'stateInfo': {'state': 'ACTIVE'},
+            'category': 'SECURITY',
+            'etag': '"{:016x}"'.format(rng.getrandbits(64)),
+            'insightSubtype': 'PERMISSIONS_USAGE',
+        }
+
+        return {
+            'name': 'projects/{}/locations/global/recommenders/{}/'
+                    'recommendations/{:08x}'.format(project, _RECOMMENDER, i),
+            'description': ('This role has not been used during the '
+                            'observation window.' if subtype == 'REMOVE_ROLE'
+                            else 'Replace the current role with a smaller '
+                                 'role to cover the permissions needed.'),
+            'lastRefreshTime': '2023-05-01T07:00:00Z',
+            'primaryImpact': {
+                'category': 'SECURITY',
+                'securityProjection': {'details': {
+                    'revokedIamPermissionsCount': total_permissions -
+                                                  len(used_permissions)}},
+            },
+            'content': {'operationGroups': [{'operations': operations}]},
+            'stateInfo': {'state': 'SUCCEEDED' if rng.random() < 0.05
+                          else 'ACTIVE'},
+            'etag': '"{:016x}"'.format(rng.getrandbits(64)),
+            'recommenderSubtype': subtype,
+            'associatedInsights': [{'insight': insight_name}],
+            'priority': 'P4',
+            'project': project,
+            'insights': [insight],
+        }
+
+    def done(self):
+        """Log a message that this plugin is done."""
+        _log.info('Replay done; records: %d', self._yielded)
+
+
+def _is_json_file(name):
+    """Return whether a file name is that of a possibly compressed JSON file.
+
+    Arguments:
+        name (str): File name.
+
+    Returns:
+        bool: ``True`` for ``.json`` and ``.ndjson`` files.
+
+    """
+    for extension in ('.gz', '.zst'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name.endswith(('.json', '.ndjson'))
+
+
+def _open(path):
+    """Open a file, possibly gzip or zstd compressed, for reading text.
+
+    Arguments:
+        path (str): Path of the file.
+
+    Returns:
+        io.TextIOBase: Text stream of the decompressed file.
+
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.zst'):
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def _items(f):
+    """Yield the items of a JSON array or newline delimited JSON.
+
+    The format is told apart by the first non-whitespace character.
+
+    Arguments:
+        f (io.TextIOBase): Text stream to parse.
+
+    Yields:
+        Each item in the stream.
+
+    """
+    first = f.read(1)
+    while first.isspace():
+        first = f.read(1)
+    if not first:
+        return
+    if first == '[':
+        yield from _array_items(f)
+        return
+
+    for line in itertools.chain([first + f.readline()], f):
+        if line.strip():
+            yield json.loads(line)
+
+
+def _array_items(f):
+    """Yield the items of a JSON array, reading the stream in chunks.
+
+    Arguments:
+        f (io.TextIOBase): Text stream positioned after the opening
+            bracket of the array.
+
+    Yields:
+        Each item of the array.
+
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf):
+            if buf[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+                yield item
+                continue
+            except json.JSONDecodeError:
+                # The item may continue in the next chunk.
+                if eof:
+                    raise
+        elif eof:
+            return
+
+        # Read at least as much as is buffered, so that an item larger
+        # than a chunk is not parsed again for every chunk.
+        chunk = f.read(max(_CHUNK_SIZE, len(buf) - pos))
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def _cycle(iterable_func):
+    """Yield the items of an iterable over and over again.
+
+    Arguments:
+        iterable_func (callable): Function that returns a new iterable
+            for every cycle.
+
+    Yields:
+        Each item of the iterables.
+
+    """
+    while True:
+        empty = True
+        for item in iterable_func():
+            empty = False
+            yield item
+        if empty:
+            return
+
+
+def _permission(rng):
+    """Return a random IAM permission name."""
+    service = rng.choice(_SERVICES)
+    return '{}.{}s.{}'.format(service, rng.choice(['bucket', 'object',
+                                                   'dataset', 'instance',
+                                                   'topic', 'job']),
+                              rng.choice(_VERBS))
@@ -1,9 +1,25 @@
+import threading
+import time
+
 from google.oauth2 import service_account
-from googleapiclient import discovery
-from CureIAM.helpers import hlogging
+from googleapiclient import discovery, errors
+from CureIAM.helpers import hlogging, hratelimit
 
 _log = hlogging.get_logger(__name__)
 
+# Resource objects cached per thread. The httplib2.Http object behind a
+# Resource is not thread-safe, so every ioworkers thread keeps its own
+# clients rather than sharing them across the process.
+_thread_local = threading.local()
+
+_client_cache_lock = threading.Lock()
+_client_cache_stats = {'hits': 0, 'builds': 0}
+
+# HTTP status codes of responses worth retrying. 429 and 503 are also
+# what the Google APIs return when a quota is exhausted.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+
 def set_service_account(key_file_path=None, scopes=[]):
 
 	return service_account.Credentials.from_service_account_file(
@@ -36,7 +52,111 @@ def build_resource(service_name, key_file_path, version='v1'):
                                credentials=credential,
                                cache_discovery=False)
 
-def get_resource_iterator(resource, key, **list_kwargs):
+def get_resource(service_name, key_file_path, version='v1'):
+    """Return a cached ``Resource`` object for the calling thread.
+
+    The first call for a given ``(service_name, version, key_file_path)``
+    in a thread builds the resource with :func:`build_resource`. Later
+    calls in the same thread return that resource, so the key file,
+    the discovery document and the access token are reused across
+    projects until the token expires.
+
+    Arguments:
+        service_name (str): Name of the service of resource object.
+        key_file_path (str): Path of the service account key file.
+        version (str): Version of the API for resource object.
+
+    Returns:
+        googleapiclient.discovery.Resource: Resource object for
+            interacting with Google APIs.
+
+    """
+    clients = getattr(_thread_local, 'clients', None)
+    if clients is None:
+        clients = _thread_local.clients = {}
+
+    cache_key = (service_name, version, key_file_path)
+    resource = clients.get(cache_key)
+
+    with _client_cache_lock:
+        if resource is None:
+            _client_cache_stats['builds'] += 1
+        else:
+            _client_cache_stats['hits'] += 1
+
+    if resource is None:
+        _log.debug('Building client; service: %s; version: %s; '
+                   'thread: %s', service_name, version,
+                   threading.current_thread().name)
+        resource = build_resource(service_name, key_file_path, version)
+        clients[cache_key] = resource
+
+    return resource
+
+def client_cache_stats():
+    """Return the client cache counters of the current process.
+
+    Returns:
+        dict: Number of cache ``hits`` and client ``builds`` done by
+            :func:`get_resource` in this process so far.
+
+    """
+    with _client_cache_lock:
+        return dict(_client_cache_stats)
+
+def execute_request(request, limiter=None, max_retries=5):
+    """Execute a request with rate limiting and backoff.
+
+    If a ``limiter`` is given, a token is taken from it before every
+    attempt, and the outcome of the attempt is reported back to it so
+    that it can adapt its rate. Attempts that fail with one of
+    :data:`RETRY_STATUSES` or with a connection error are retried after
+    a randomized exponential backoff.
+
+    Arguments:
+        request (HttpRequest): Request to execute.
+        limiter (CureIAM.helpers.hratelimit.TokenBucket): Rate limiter
+            of the API the request belongs to.
+        max_retries (int): Maximum number of retries.
+
+    Returns:
+        dict: Response of the request.
+
+    Raises:
+        googleapiclient.errors.HttpError: If the request failed with a
+            status that is not retried, or failed in every attempt.
+
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = request.execute()
+        except errors.HttpError as e:
+            status = e.resp.status
+            if limiter is not None and status in THROTTLE_STATUSES:
+                limiter.throttled()
+            if status not in RETRY_STATUSES or attempt >= max_retries:
+                raise
+            error = '{}: {}'.format(status, e.reason)
+        except (ConnectionError, TimeoutError) as e:
+            if attempt >= max_retries:
+                raise
+            error = '{}: {}'.format(type(e).__name__, e)
+        else:
+            if limiter is not None:
+                limiter.succeeded()
+            return response
+
+        delay = hratelimit.backoff_delay(attempt)
+        attempt += 1
+        _log.warning('Retrying request in %.1f s; attempt: %d; uri: %s; '
+                     'error: %s', delay, attempt, request.uri, error)
+        time.sleep(delay)
+
+def get_resource_iterator(resource, key, limiter=None, max_retries=5,
+                          **list_kwargs):
     """Generate resources for specific record types. This function is useful to when API returns
     pageToken and there is need to make subsequent calls.
 
@@ -44,17 +164,24 @@ def get_resource_iterator(resource, key, **list_kwargs):
         resource (Resource): GCP resource object.
         key (str): The key that we need to look up in the GCP
             response JSON to find the list of resources.
-        key_file_path (str): Path to key file (for logging only).
+        limiter (CureIAM.helpers.hratelimit.TokenBucket): Rate limiter
+            of the API the resource belongs to.
+        max_retries (int): Maximum number of retries of every page
+            request. See :func:`execute_request`.
         list_kwargs (dict): Keyword arguments for
             ``resource.list()`` call.
     Yields:
         dict: A GCP configuration record.
+    Raises:
+        googleapiclient.errors.HttpError: If a page request failed. See
+            :func:`execute_request`. The error is raised, so that a
+            listing is never mistaken for complete.
     """
     try:
         request = resource.list(**list_kwargs)
 
         while request is not None:
-            response = request.execute()
+            response = execute_request(request, limiter, max_retries)
             if key is None:
                 yield response
             else:
@@ -67,6 +194,112 @@ def get_resource_iterator(resource, key, **list_kwargs):
                    'list_kwargs: %s; '
                    'error: %s: %s', key, list_kwargs,
                     type(e).__name__, e)
+        raise
+
+def execute_batch(service, requests, batch_size=100, num_retries=3,
+                  limiter=None):
+    """Execute requests through HTTP batch requests.
+
+    The requests are sent in batches of at most ``batch_size`` requests
+    with :meth:`new_batch_http_request` of the ``service``. Every request
+    that fails inside a batch, or belongs to a batch that failed as a
+    whole, is retried on its own with ``num_retries`` retries.
+
+    Arguments:
+        service (Resource): GCP resource object of the service root,
+            i.e., the object returned by :func:`build_resource`.
+        requests (dict): A dictionary of ``HttpRequest`` objects keyed by
+            an arbitrary hashable key, e.g., the resource name.
+        batch_size (int): Maximum number of requests in a single batch.
+            The Google APIs accept at most 1000 requests per batch.
+        num_retries (int): Number of retries for every request that
+            failed inside a batch.
+        limiter (CureIAM.helpers.hratelimit.TokenBucket): Rate limiter
+            of the API the requests belong to. A batch takes one token
+            per request in it.
+
+    Returns:
+        dict: A dictionary of responses keyed by the same keys as in
+            ``requests``. Requests that failed even after the retries
+            are left out.
+
+    """
+    keys = list(requests)
+    responses = {}
+    failed = []
+
+    def callback(request_id, response, exception):
+        key = keys[int(request_id)]
+        if exception is None:
+            responses[key] = response
+            if limiter is not None:
+                limiter.succeeded()
+            return
+
+        failed.append(key)
+        if (limiter is not None and isinstance(exception, errors.HttpError)
+                and exception.resp.status in THROTTLE_STATUSES):
+            limiter.throttled()
+
+    for start in range(0, len(keys), batch_size):
+        chunk = range(start, min(start + batch_size, len(keys)))
+        batch = service.new_batch_http_request(callback=callback)
+        for index in chunk:
+            batch.add(requests[keys[index]], request_id=str(index))
+        if limiter is not None:
+            limiter.acquire(len(chunk))
+        try:
+            batch.execute()
+        except Exception as e:
+            _log.warning('Failed to execute batch of %d requests; '
+                         'error: %s: %s', len(chunk), type(e).__name__, e)
+            failed.extend(keys[index] for index in chunk
+                          if keys[index] not in responses
+                          and keys[index] not in failed)
+
+    for key in failed:
+        try:
+            responses[key] = execute_request(requests[key], limiter,
+                                             num_retries)
+        except Exception as e:
+            _log.error('Failed to execute request after batch failure; '
+                       'key: %s; error: %s: %s', key, type(e).__name__, e)
+
+    return responses
+
+def project_filter(lifecycle_state=None, labels=None, parent=None):
+    """Return a filter expression for the v1 ``projects.list`` call.
+
+    Example:
+        >>> from CureIAM.plugins.gcp import util_gcp
+        >>> util_gcp.project_filter('ACTIVE', {'env': 'prod'}, 'folders/12')
+        'lifecycleState:ACTIVE labels.env:prod parent.type:folder parent.id:12'
+        >>> util_gcp.project_filter() is None
+        True
+
+    Arguments:
+        lifecycle_state (str): Lifecycle state, e.g., ``ACTIVE``.
+        labels (dict): Label values keyed by label name.
+        parent (str): Folder or organization name, e.g., ``folders/12``
+            or ``organizations/34``.
+
+    Returns:
+        str: Filter expression that matches projects meeting all the
+            given conditions, or ``None`` if no condition is given.
+
+    """
+    terms = []
+    if lifecycle_state:
+        terms.append('lifecycleState:{}'.format(lifecycle_state))
+    for key, value in (labels or {}).items():
+        terms.append('labels.{}:{}'.format(key, value))
+    if parent:
+        # Parent names are plural, e.g., folders/12, while the parent
+        # types in the filter are singular, e.g., folder.
+        parent_type, parent_id = parent.split('/', 1)
+        terms.append('parent.type:{} parent.id:{}'
+                     .format(parent_type.rstrip('s'), parent_id))
+    return ' '.join(terms) or None
 
 def outline_gcp_project(project_index, project, zone, key_file_path):
     """Return a summary of a GCP project for logging purpose.
@@ -0,0 +1,321 @@
+"""Batched transport of records between worker processes.
+"""
+
+import collections
+import json
+import multiprocessing as mp
+import os
+import threading
+import time
+import zlib
+
+
+def _update_pid():
+    """Update the cached ID of the current process."""
+    global _pid
+    _pid = os.getpid()
+
+
+# ID of the current process, kept up to date across forks, so that a
+# BatchQueue notices a new process without a system call on every put.
+_pid = os.getpid()
+os.register_at_fork(after_in_child=_update_pid)
+
+
+class BatchQueue:
+    """A multiprocessing queue that moves records in batches.
+
+    Records put into this queue are buffered in the putting process and
+    sent over the underlying :class:`multiprocessing.Queue` as a single
+    list once ``batch_size`` records are buffered or ``linger`` seconds
+    have passed since the oldest buffered record was put. Thus records
+    are pickled and handed to the queue feeder thread once per batch
+    instead of once per record. The getting process receives whole
+    batches and hands out their records one at a time.
+
+    As with a plain queue, ``None`` marks the end of the input. Putting
+    ``None`` flushes the buffered records first and then sends ``None``
+    on its own, so every record put before it is received before it.
+
+    The buffers live in each process separately, so a producer must
+    call :meth:`flush` before it stops producing, and a single queue
+    can be shared by several producer and consumer processes. Each
+    producing process runs a daemon thread per queue that sends the
+    buffered records once they have lingered long enough, so that
+    records are not held back while the producer is idle.
+    """
+
+    def __init__(self, batch_size=100, linger=1.0):
+        """Create an instance of :class:`BatchQueue`.
+
+        Arguments:
+            batch_size (int): Maximum number of records sent together.
+            linger (float): Maximum number of seconds a record is held
+                back waiting for more records.
+
+        """
+        self._queue = mp.Queue()
+        self._batch_size = batch_size
+        self._linger = linger
+        self._get_buffer = collections.deque()
+        self._reset_put_state()
+
+    def __getstate__(self):
+        """Return the state to pickle, without the put buffer."""
+        state = self.__dict__.copy()
+        for name in ('_put_buffer', '_put_buffer_time', '_put_lock',
+                     '_put_wakeup', '_put_pid'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        """Restore the pickled state with an empty put buffer."""
+        self.__dict__.update(state)
+        self._reset_put_state()
+
+    def _reset_put_state(self):
+        """Start with an empty put buffer in the current process.
+
+        The lingering records are sent by a thread started on the first
+        :meth:`put` in the process. A buffer and lock inherited from a
+        parent process through fork are never reused.
+        """
+        self._put_buffer = []
+        self._put_buffer_time = 0
+        self._put_lock = threading.Lock()
+        self._put_wakeup = threading.Event()
+        self._put_pid = None
+
+    def _start_flusher(self):
+        """Start the thread that sends lingering records."""
+        self._reset_put_state()
+        self._put_pid = _pid
+        threading.Thread(target=self._flusher, name='BatchQueue',
+                         daemon=True).start()
+
+    def _flusher(self):
+        """Send the buffered records once the oldest has lingered."""
+        while True:
+            self._put_wakeup.wait()
+            self._put_wakeup.clear()
+            while True:
+                with self._put_lock:
+                    if not self._put_buffer:
+                        break
+                    remaining = (self._put_buffer_time + self._linger
+                                 - time.monotonic())
+                    if remaining <= 0:
+                        self._send()
+                        break
+                time.sleep(remaining)
+
+    def _send(self):
+        """Send the buffered records, if any. The lock must be held."""
+        if self._put_buffer:
+            self._queue.put(self._put_buffer)
+            self._put_buffer = []
+
+    def put(self, record):
+        """Put a record into the queue.
+
+        Arguments:
+            record (object): Record to put, or ``None`` to mark the end
+                of the input.
+
+        """
+        if record is None:
+            self.flush()
+            self._queue.put(None)
+            return
+
+        if self._put_pid != _pid:
+            self._start_flusher()
+
+        new_batch = False
+        with self._put_lock:
+            if not self._put_buffer:
+                self._put_buffer_time = time.monotonic()
+                new_batch = True
+            self._put_buffer.append(record)
+            if len(self._put_buffer) >= self._batch_size:
+                self._send()
+
+        # Let the flusher wait for the linger of the new batch.
+        if new_batch:
+            self._put_wakeup.set()
+
+    def flush(self):
+        """Send the buffered records, if any, as one batch."""
+        if self._put_pid != _pid:
+            return
+        with self._put_lock:
+            self._send()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return a record from the queue.
+
+        Arguments:
+            block (bool): Whether to wait for a batch to arrive if no
+                received record is pending.
+            timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+            object: The next record, or ``None`` if the end of the input
+                has been reached.
+
+        Raises:
+            queue.Empty: If no record is available in time.
+
+        """
+        if not self._get_buffer:
+            batch = self._queue.get(block, timeout)
+            if batch is None:
+                return None
+            self._get_buffer.extend(batch)
+        return self._get_buffer.popleft()
+
+
+class EncodedRecord:
+    """A record serialized to JSON once for every queue it is put into.
+
+    Putting the same record dictionary into several queues pickles it
+    once per queue. An :class:`EncodedRecord` holds the record as JSON
+    bytes instead, and pickling bytes is little more than a memory copy,
+    so the record is encoded only once no matter how many queues it
+    goes through. Store plugins that implement ``write_raw`` receive
+    the :class:`EncodedRecord` and may write the JSON as is.
+
+    The ``com`` dictionary is kept apart from the JSON bytes, so that
+    every worker on the way can still add its own metadata to it
+    cheaply.
+
+    Note that the record goes through a JSON round trip, so tuples in
+    it come out as lists and non-string dictionary keys as strings.
+    Records that cannot be serialized to JSON at all, e.g., ones that
+    hold a ``datetime`` or a ``set``, raise :class:`TypeError` and
+    must be put into queues as dictionaries instead.
+
+    Attributes:
+        body (bytes): JSON of the record without its ``com`` key.
+        com (dict): The ``com`` dictionary of the record.
+        name (str): The ``name`` in the ``raw`` part of the record, if
+            any. It lets stores identify the record without decoding.
+
+    """
+
+    __slots__ = ('body', 'com', 'name')
+
+    def __init__(self, record):
+        """Create an instance of :class:`EncodedRecord`.
+
+        Arguments:
+            record (dict): Record to encode. It must be serializable
+                to JSON.
+
+        Raises:
+            TypeError: If a value is not serializable to JSON.
+            ValueError: If the record contains a circular reference.
+
+        """
+        fields = {k: v for k, v in record.items() if k != 'com'}
+        raw = fields.get('raw')
+        self.body = json.dumps(fields).encode()
+        self.com = record.get('com', {})
+        self.name = raw.get('name') if isinstance(raw, dict) else None
+
+    def decode(self):
+        """Return the record as a dictionary.
+
+        Returns:
+            dict: A new record dictionary equal to the encoded one, but
+                with lists in place of tuples.
+
+        """
+        record = json.loads(self.body)
+        record['com'] = self.com
+        return record
+
+    def to_json(self, **fields):
+        """Return the JSON of the whole record.
+
+        The ``com`` dictionary and the given ``fields`` are spliced into
+        the encoded JSON without decoding it, in the same order as if
+        they had been added to the record dictionary, e.g.,
+        ``json.dumps(record)`` after ``record.update(fields)``.
+
+        Example:
+            >>> from CureIAM import transport
+            >>> record = {'raw': {'name': 'a'}, 'com': {'x': 1}}
+            >>> encoded = transport.EncodedRecord(record)
+            >>> encoded.to_json(timestamp='t')
+            b'{"raw": {"name": "a"}, "com": {"x": 1}, "timestamp": "t"}'
+
+        Arguments:
+            fields (dict): Additional top-level fields to include.
+
+        Returns:
+            bytes: JSON of the record.
+
+        """
+        tail = b''.join(b', ' + json.dumps(key).encode() + b': ' +
+                        json.dumps(value).encode()
+                        for key, value in (('com', self.com),) +
+                        tuple(fields.items()))
+        if self.body == b'{}':
+            return b'{' + tail[2:] + b'}'
+        return self.body[:-1] + tail + b'}'
+
+
+class PartitionedQueue:
+    """A queue that routes records to one of several queues by project.
+
+    Records of the same GCP project always go to the same queue, so
+    that the processor worker reading that queue sees them in the order
+    they were put. The project is taken from the recommendation name in
+    the ``raw`` part of a record, e.g., ``projects/<project>/locations/
+    ...``, which is available without decoding an
+    :class:`EncodedRecord` too. Records without a name go to the first
+    queue.
+
+    Putting ``None`` puts ``None`` into every queue.
+    """
+
+    def __init__(self, queues):
+        """Create an instance of :class:`PartitionedQueue`.
+
+        Arguments:
+            queues (list): List of :class:`BatchQueue` objects to route
+                records to.
+
+        """
+        self._queues = queues
+
+    def put(self, record):
+        """Put a record into the queue of its project.
+
+        Arguments:
+            record (object): Record to put, or ``None`` to mark the end
+                of the input in every queue.
+
+        """
+        if record is None:
+            for q in self._queues:
+                q.put(None)
+            return
+
+        if isinstance(record, EncodedRecord):
+            name = record.name
+        else:
+            raw = record.get('raw')
+            name = raw.get('name') if isinstance(raw, dict) else None
+
+        index = 0
+        if name:
+            key = name.split('/')[1] if name.startswith('projects/') else name
+            index = zlib.crc32(key.encode()) % len(self._queues)
+        self._queues[index].put(record)
+
+    def flush(self):
+        """Send the buffered records of every queue."""
+        for q in self._queues:
+            q.flush()
@@ -1,14 +1,63 @@
 """Worker functions.
 """
 
+import queue
+import sys
+import time
 
-from CureIAM.helpers import util
+from CureIAM import transport
 from CureIAM.plugins import util_plugins
 
 from CureIAM.helpers import hlogging
 
 _log = hlogging.get_logger(__name__)
 
+
+def _update_com(record, com):
+    """Add worker metadata to the ``com`` dictionary of a record.
+
+    The ``com`` dictionary of a record holds flat string values only,
+    so a shallow in-place update gives the same result as merging with
+    :func:`CureIAM.helpers.util.merge_dicts` without copying the record
+    metadata at every stage.
+
+    Arguments:
+        record (dict): Record to update.
+        com (dict): Metadata of the worker handling the record.
+
+    """
+    record_com = record.get('com')
+    if record_com is None:
+        record['com'] = dict(com)
+    else:
+        record_com.update(com)
+
+
+def _put_all(record, output_queues):
+    """Put a record into each queue in ``output_queues``.
+
+    When there is more than one queue, the record is put as a
+    :class:`CureIAM.transport.EncodedRecord`, so that it is serialized
+    once instead of being pickled again for every queue. A record that
+    cannot be serialized to JSON, e.g., because it holds a ``datetime``,
+    is put as a dictionary instead.
+
+    Arguments:
+        record (dict): Record to put.
+        output_queues (list): List of :class:`CureIAM.transport.BatchQueue`
+            objects to write the record to.
+
+    """
+    if len(output_queues) > 1:
+        try:
+            record = transport.EncodedRecord(record)
+        except (TypeError, ValueError) as e:
+            _log.debug('Failed to encode record; putting it as is; '
+                       'error: %s: %s', type(e).__name__, e)
+    for q in output_queues:
+        q.put(record)
+
+
 def cloud_worker(audit_key, audit_version, plugin_key, plugin_config,
                  output_queues):
     """Worker function for cloud plugins.
@@ -19,43 +68,55 @@ def cloud_worker(audit_key, audit_version, plugin_key, plugin_config,
     function calls this ``read`` method to retrieve records and puts
     each record into each queue in ``output_queues``.
 
+    Like all workers, it exits with a non-zero exit code if the plugin
+    fails, so that the audit is known not to have succeeded.
+
     Arguments:
         audit_key (str): Audit key name in configuration.
         audit_version (str): Audit version string.
         plugin_key (str): Plugin key name in configuration.
         plugin_config (dict): Cloud plugin config dictionary.
-        output_queues (list): List of :class:`multiprocessing.Queue`
+        output_queues (list): List of :class:`CureIAM.transport.BatchQueue`
             objects to write records to.
 
     """
     worker_name = audit_key + '_' + plugin_key
     _log.info('cloud_worker: %s: Started', worker_name)
 
+    failed = False
     try:
         plugin = util_plugins.load(plugin_config)
+        com = {
+            'audit_key': audit_key,
+            'audit_version': audit_version,
+            'origin_key': plugin_key,
+            'origin_class': type(plugin).__name__,
+            'origin_worker': worker_name,
+            'origin_type': 'cloud',
+        }
         for record in plugin.read():
-            record['com'] = util.merge_dicts(record.get('com', {}), {
-                'audit_key': audit_key,
-                'audit_version': audit_version,
-                'origin_key': plugin_key,
-                'origin_class': type(plugin).__name__,
-                'origin_worker': worker_name,
-                'origin_type': 'cloud',
-            })
-            for q in output_queues:
-                q.put(record)
+            _update_com(record, com)
+            _put_all(record, output_queues)
 
         plugin.done()
 
     except Exception as e:
         _log.exception('cloud_worker: %s: Failed; error: %s: %s',
                        worker_name, type(e).__name__, e)
+        failed = True
+
+    # Send the records still buffered in this process.
+    for q in output_queues:
+        q.flush()
 
     _log.info('cloud_worker: %s: Stopped', worker_name)
+    if failed:
+        sys.exit(1)
 
 
 def processor_worker(audit_key, audit_version, plugin_key, plugin_config,
-                 input_queue, output_queues):
+                 input_queue, output_queues, eval_batch_size=1,
+                 eval_batch_wait=0, stats_queue=None):
     """Worker function for processor plugins.
 
     This function instantiates a plugin object from the
@@ -69,19 +130,49 @@ def processor_worker(audit_key, audit_version, plugin_key, plugin_config,
     each record yielded by the ``eval`` method into each queue in
     ``output_queues``.
 
+    If the plugin object also implements an ``eval_batch`` method that
+    accepts a list of records and yields the processed records, records
+    are collected from ``input_queue`` until ``eval_batch_size`` records
+    are collected or ``eval_batch_wait`` seconds have passed since the
+    first of them was received, and passed together to ``eval_batch``.
+    This lets the plugin amortize work, e.g., scoring, across records.
+
+    A plugin may hold back records across calls of ``eval`` or
+    ``eval_batch``, e.g., to act on all the records of a project at
+    once. If it implements an ``eval_flush`` method, that method is
+    called without arguments once the input ends and the records it
+    yields are put into ``output_queues`` too.
+
     When there are no more records in the ``input_queue``, i.e., once
     ``None`` is found in the ``input_queue``, this function calls the
     ``done`` method of the plugin object to indicate that record
-    processing is over.
+    processing is over. If ``stats_queue`` is specified, the plugin key
+    and the statistics are put into ``stats_queue``, so that the
+    statistics of several replicas of the plugin can be aggregated.
+    The statistics are those returned by ``done``, if it returns a
+    dictionary, along with ``records_failed``.
+
+    A record that fails to be evaluated is logged, counted in
+    ``records_failed`` and skipped. If ``eval`` or ``eval_batch`` raises
+    an exception, all the records passed to that call are counted as
+    failed. The audit fails only if the plugin fails to load or its
+    ``eval_flush`` or ``done`` method fails.
 
     Arguments:
         audit_key (str): Audit key name in configuration.
         audit_version (str): Audit version string.
         plugin_key (str): Plugin key name in configuration.
         plugin_config (dict): processor plugin config dictionary.
-        input_queue (multiprocessing.Queue): Queue to read records from.
-        output_queues (list): List of :class:`multiprocessing.Queue`
+        input_queue (CureIAM.transport.BatchQueue): Queue to read
+            records from.
+        output_queues (list): List of :class:`CureIAM.transport.BatchQueue`
             objects to write records to.
+        eval_batch_size (int): Maximum number of records passed to
+            ``eval_batch`` at once.
+        eval_batch_wait (float): Maximum number of seconds a record
+            waits for more records to be passed to ``eval_batch`` with.
+        stats_queue (multiprocessing.Queue): Queue to put the
+            statistics into.
 
     """
     worker_name = audit_key + '_' + plugin_key
@@ -93,35 +184,115 @@ def processor_worker(audit_key, audit_version, plugin_key, plugin_config,
         _log.exception('processor_worker: %s: Failed; error: %s: %s',
                        worker_name, type(e).__name__, e)
         _log.info('processor_worker: %s: Stopped', worker_name)
-        return
-
+        sys.exit(1)
+
+    com = {
+        'audit_key': audit_key,
+        'audit_version': audit_version,
+        'origin_key': plugin_key,
+        'origin_class': type(plugin).__name__,
+        'origin_worker': worker_name,
+        'origin_type': 'processor',
+    }
+
+    if not hasattr(plugin, 'eval_batch'):
+        eval_batch_size = 1
+
+    def put(processor_records):
+        """Put the processed records into the output queues."""
+        for processor_record in processor_records:
+            _update_com(processor_record, com)
+            _put_all(processor_record, output_queues)
+
+    records_failed = 0
+
+    def process(records):
+        """Evaluate records and put the processed records."""
+        nonlocal records_failed
+        try:
+            if eval_batch_size > 1:
+                put(plugin.eval_batch(records))
+            else:
+                put(plugin.eval(records[0]))
+        except Exception as e:
+            _log.exception('processor_worker: %s: Failed to evaluate %d '
+                           'records; error: %s: %s', worker_name,
+                           len(records), type(e).__name__, e)
+            records_failed += len(records)
+
+    failed = False
+    records = []
+    deadline = 0
     while True:
         try:
-            record = input_queue.get()
+            # The output queues send lingering records on their own,
+            # so only a pending batch needs a timeout here.
+            timeout = None
+            if records:
+                timeout = max(deadline - time.monotonic(), 0)
+
+            try:
+                record = input_queue.get(timeout=timeout)
+            except queue.Empty:
+                # The batch has waited long enough.
+                batch, records = records, []
+                process(batch)
+                continue
+
             if record is None:
-                _log.info('processor_worker: %s: Stopping', worker_name)
-                plugin.done()
                 break
 
-            for processor_record in plugin.eval(record):
-                processor_record['com'] = \
-                    util.merge_dicts(processor_record.get('com', {}), {
-                        'audit_key': audit_key,
-                        'audit_version': audit_version,
-                        'origin_key': plugin_key,
-                        'origin_class': type(plugin).__name__,
-                        'origin_worker': worker_name,
-                        'origin_type': 'processor',
-                    })
+            if isinstance(record, transport.EncodedRecord):
+                record = record.decode()
 
-                for q in output_queues:
-                    q.put(processor_record)
+            if not records:
+                deadline = time.monotonic() + eval_batch_wait
+            records.append(record)
+            if len(records) >= eval_batch_size:
+                batch, records = records, []
+                process(batch)
 
         except Exception as e:
-            _log.exception('processor_worker: %s: Failed; error: %s: %s',
-                           worker_name, type(e).__name__, e)
+            _log.exception('processor_worker: %s: Failed to get record; '
+                           'error: %s: %s', worker_name, type(e).__name__, e)
+            records_failed += 1
+
+    # The input has ended. Each step below runs even if an earlier one
+    # fails, so that the worker always stops.
+    _log.info('processor_worker: %s: Stopping', worker_name)
+    try:
+        if records:
+            process(records)
+        if hasattr(plugin, 'eval_flush'):
+            put(plugin.eval_flush())
+    except Exception as e:
+        _log.exception('processor_worker: %s: Failed; error: %s: %s',
+                       worker_name, type(e).__name__, e)
+        failed = True
+
+    stats = None
+    try:
+        stats = plugin.done()
+    except Exception as e:
+        _log.exception('processor_worker: %s: Failed; error: %s: %s',
+                       worker_name, type(e).__name__, e)
+        failed = True
+
+    if records_failed:
+        _log.warning('processor_worker: %s: Records failed: %d',
+                     worker_name, records_failed)
+
+    for q in output_queues:
+        q.flush()
+    if stats_queue is not None:
+        stats = dict(stats) if isinstance(stats, dict) else {}
+        stats['records_failed'] = (stats.get('records_failed', 0)
+                                   + records_failed)
+        stats_queue.put((plugin_key, stats))
 
     _log.info('processor_worker: %s: Stopped', worker_name)
+    if failed:
+        sys.exit(1)
 
 
 def store_worker(audit_key, audit_version, plugin_key, plugin_config,
@@ -135,7 +306,11 @@ def store_worker(audit_key, audit_version, plugin_key, plugin_config,
     end.
 
     This function gets records from ``input_queue`` and passes each
-    record to the ``write`` method of the plugin object.
+    record to the ``write`` method of the plugin object. A record that
+    arrives as a :class:`CureIAM.transport.EncodedRecord` is passed as
+    is to the ``write_raw`` method of the plugin object if it has one,
+    so that the plugin can use the already serialized JSON. Otherwise
+    it is decoded and passed to ``write``.
 
     When there are no more records in the ``input_queue``, i.e., once
     ``None`` is found in the ``input_queue``, this function calls the
@@ -147,7 +322,8 @@ def store_worker(audit_key, audit_version, plugin_key, plugin_config,
         audit_version (str): Audit version string.
         plugin_key (str): Plugin key name in configuration.
         plugin_config (dict): Store plugin config dictionary.
-        input_queue (multiprocessing.Queue): Queue to read records from.
+        input_queue (CureIAM.transport.BatchQueue): Queue to read
+            records from.
 
     """
     _write_worker(audit_key, audit_version, plugin_key, plugin_config,
@@ -166,7 +342,8 @@ def alert_worker(audit_key, audit_version, plugin_key, plugin_config,
         audit_version (str): Audit version string.
         plugin_key (str): Plugin key name in configuration.
         plugin_config (dict): Alert plugin config dictionary.
-        input_queue (multiprocessing.Queue): Queue to read records from.
+        input_queue (CureIAM.transport.BatchQueue): Queue to read
+            records from.
 
     """
     _write_worker(audit_key, audit_version, plugin_key, plugin_config,
@@ -182,7 +359,8 @@ def _write_worker(audit_key, audit_version, plugin_key, plugin_config,
         audit_version (str): Audit version string.
         plugin_key (str): Plugin key name in configuration.
         plugin_config (dict): Store or alert plugin config dictionary.
-        input_queue (multiprocessing.Queue): Queue to read records from.
+        input_queue (CureIAM.transport.BatchQueue): Queue to read
+            records from.
         worker_type (str): Either ``'store'`` or ``'alert'``.
 
     """
@@ -195,8 +373,18 @@ def _write_worker(audit_key, audit_version, plugin_key, plugin_config,
         _log.exception('%s_worker: %s: Failed; error: %s: %s',
                        worker_type, worker_name, type(e).__name__, e)
         _log.info('%s_worker: %s: Stopped', worker_type, worker_name)
-        return
-
+        sys.exit(1)
+
+    com = {
+        'audit_key': audit_key,
+        'audit_version': audit_version,
+        'target_key': plugin_key,
+        'target_class': type(plugin).__name__,
+        'target_worker': worker_name,
+        'target_type': worker_type,
+    }
+
+    failed = False
     while plugin is not None:
         try:
             record = input_queue.get()
@@ -206,19 +394,21 @@ def _write_worker(audit_key, audit_version, plugin_key, plugin_config,
                 plugin.done()
                 break
 
-            record['com'] = util.merge_dicts(record.get('com', {}), {
-                'audit_key': audit_key,
-                'audit_version': audit_version,
-                'target_key': plugin_key,
-                'target_class': type(plugin).__name__,
-                'target_worker': worker_name,
-                'target_type': worker_type,
-            })
+            if isinstance(record, transport.EncodedRecord):
+                if hasattr(plugin, 'write_raw'):
+                    record.com.update(com)
+                    plugin.write_raw(record)
+                    continue
+                record = record.decode()
 
+            _update_com(record, com)
             plugin.write(record)
 
         except Exception as e:
             _log.exception('%s_worker: %s: Failed; error: %s: %s',
                            worker_type, worker_name, type(e).__name__, e)
+            failed = True
 
     _log.info('%s_worker: %s: Stopped', worker_type, worker_name)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,227 @@
+"""Ingestion benchmark of EsStore against a local Elasticsearch stand-in.
+
+A small HTTP server that accepts bulk API requests the way Elasticsearch
+does stands in for a cluster. Synthetic processed recommendations are
+fed through ``EsStore`` and the throughput and latency of the bulk API
+requests are reported, so that buffer sizes and concurrency settings
+can be compared offline.
+
+Usage:
+    PYTHONPATH=. python3 test/bench_es.py --records 50000 --thread-count 4
+"""
+
+import gzip
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from CureIAM import transport
+from CureIAM.plugins.elastic.esstore import EsStore
+
+
+class FakeElasticsearch(ThreadingHTTPServer):
+    """HTTP server that acknowledges bulk API requests."""
+
+    daemon_threads = True
+
+    def __init__(self, address, delay=0.0):
+        super().__init__(address, _Handler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.docs = 0
+        self.bytes = 0
+        self.latencies = []
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        # The client refuses to talk to servers without this header.
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._send(200, {'version': {'number': '8.7.0'}})
+
+    def do_HEAD(self):
+        self._send(200, {})
+
+    def do_PUT(self):
+        if '_bulk' in self.path:
+            self.do_POST()
+            return
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send(200, {'acknowledged': True})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        size = len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if '_bulk' not in self.path:
+            self._send(200, {'acknowledged': True})
+            return
+
+        items = []
+        lines = body.splitlines()
+        for line in lines[::2]:
+            op_type, meta = json.loads(line).popitem()
+            items.append({op_type: {'_index': meta.get('_index'),
+                                    '_id': meta.get('_id'),
+                                    'status': 201, 'result': 'created'}})
+        time.sleep(self.server.delay)
+        self._send(200, {'took': 1, 'errors': False, 'items': items})
+
+        with self.server.lock:
+            self.server.docs += len(items)
+            self.server.bytes += size
+            self.server.latencies.append(time.perf_counter() - start)
+
+
+def make_record(i):
+    """Return a record shaped like a processed IAM recommendation."""
+    project = 'project-%d' % (i % 500)
+    member = 'user:someone-%d@example.com' % i
+    return {
+        'raw': {
+            'name': 'projects/%s/locations/global/recommenders/'
+                    'google.iam.policy.Recommender/recommendations/%d'
+                    % (project, i),
+            'description': 'Replace the current role with a smaller role '
+                           'to cover the permissions needed.',
+            'lastRefreshTime': '2023-05-01T07:00:00Z',
+            'primaryImpact': {'category': 'SECURITY'},
+            'content': {'operationGroups': [{'operations': [{
+                'action': 'remove',
+                'resourceType': 'cloudresourcemanager.googleapis.com/Project',
+                'resource': '//cloudresourcemanager.googleapis.com/projects/'
+                            + project,
+                'path': '/iamPolicy/bindings/*/members/*',
+                'pathFilters': {
+                    '/iamPolicy/bindings/*/condition/expression': '',
+                    '/iamPolicy/bindings/*/members/*': member,
+                    '/iamPolicy/bindings/*/role': 'roles/editor',
+                },
+            }]}]},
+            'stateInfo': {'state': 'ACTIVE'},
+            'etag': '"%016x"' % i,
+            'recommenderSubtype': 'REMOVE_ROLE',
+            'project': project,
+        },
+        'processor': {
+            'project': project,
+            'recommendation_id': 'recommendations/%d' % i,
+            'recommendation_description': 'Remove the role',
+            'recommendetion_recommender_subtype': 'REMOVE_ROLE',
+            'account_type': 'user',
+            'account_id': member.split(':')[1],
+            'account_total_permissions': 3000,
+            'account_used_permissions': i % 50,
+            'account_permission_insights_category': 'SECURITY',
+        },
+        'score': {
+            'safe_to_apply_recommendation_score': 90,
+            'safe_to_apply_recommendation_score_factors': 3,
+            'risk_score': 97,
+            'risk_score_factors': 2,
+            'over_privilege_score': 98,
+        },
+        'com': {'audit_key': 'bench', 'audit_version': '20230501_000000',
+                'origin_worker': 'bench_processor'},
+    }
+
+
+def main(args):
+    server = FakeElasticsearch(('127.0.0.1', 0), args.delay / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    store = EsStore(host='127.0.0.1', port=server.server_address[1],
+                    buffer_size=args.buffer_size,
+                    chunk_size=args.chunk_size,
+                    thread_count=args.thread_count,
+                    http_compress=args.http_compress,
+                    install_template=False)
+
+    # Time each flush, i.e., each call of the bulk helper, as the store
+    # sees it.
+    flush_latencies = []
+    bulk = store._bulk
+
+    def timed_bulk(actions):
+        start = time.perf_counter()
+        result = bulk(actions)
+        flush_latencies.append(time.perf_counter() - start)
+        return result
+
+    store._bulk = timed_bulk
+
+    records = [make_record(i) for i in range(args.records)]
+    if args.raw:
+        records = [transport.EncodedRecord(r) for r in records]
+        write = store.write_raw
+    else:
+        write = store.write
+
+    start = time.perf_counter()
+    for record in records:
+        write(record)
+    store.done()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    def ms(seconds):
+        return seconds * 1000
+
+    print('Records:        %d' % args.records)
+    print('Indexed:        %d' % server.docs)
+    print('Elapsed:        %.2f s' % elapsed)
+    print('Docs/sec:       %.0f' % (server.docs / elapsed))
+    print('Bytes/sec:      %.0f (%.2f MB/s on the wire)'
+          % (server.bytes / elapsed, server.bytes / elapsed / 1e6))
+    print('Bulk requests:  %d' % len(server.latencies))
+    if flush_latencies:
+        flush_latencies.sort()
+        print('Flush latency:  mean %.1f ms; p50 %.1f ms; p95 %.1f ms; '
+              'max %.1f ms' % (
+                  ms(statistics.mean(flush_latencies)),
+                  ms(flush_latencies[len(flush_latencies) // 2]),
+                  ms(flush_latencies[int(len(flush_latencies) * 0.95)]),
+                  ms(flush_latencies[-1])))
+    if server.latencies:
+        print('Server latency: mean %.1f ms'
+              % ms(statistics.mean(server.latencies)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Benchmark EsStore ingestion against a fake bulk API')
+    parser.add_argument('--records', '-n', type=int, default=50000,
+                        help='Number of records')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='Maximum number of records per bulk request')
+    parser.add_argument('--buffer-size', type=int, default=5000000,
+                        help='Maximum number of bytes per bulk request')
+    parser.add_argument('--thread-count', type=int, default=4,
+                        help='Maximum number of bulk requests in flight')
+    parser.add_argument('--http-compress', action='store_true',
+                        help='Compress request bodies with gzip')
+    parser.add_argument('--delay', type=float, default=20,
+                        help='Simulated processing time of the fake '
+                             'server per bulk request in ms')
+    parser.add_argument('--raw', action='store_true',
+                        help='Write pre-serialized records with write_raw')
+    main(parser.parse_args())
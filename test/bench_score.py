@@ -0,0 +1,70 @@
+"""Benchmark of scalar and batch scoring of IAM recommendations.
+
+Scores processed recommendations one at a time with
+``IAMRiskScoreModel.score`` and all together with
+``IAMRiskScoreModel.score_batch``. The scores are checked to be
+identical, including edge cases such as unknown or zero total
+permissions, before timing both ways.
+
+Usage:
+    PYTHONPATH=. python3 test/bench_score.py --records 100000
+"""
+
+import random
+import timeit
+
+from CureIAM.models.iamriskscore import IAMRiskScoreModel
+
+
+def make_records(count, seed=0):
+    """Return processor dicts with random permission counts."""
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        total = rng.randint(0, 10000)
+        records.append({
+            'account_type': rng.choice(['user', 'group', 'serviceAccount']),
+            'account_permission_insights_category':
+                rng.choice(['SECURITY', 'REMOVE_ROLE', 'REPLACE_ROLE']),
+            'account_used_permissions': rng.randint(0, total + 10),
+            'account_total_permissions': None if i % 97 == 0 else total,
+        })
+
+    # Excess permission ratios whose powers are exactly halfway between
+    # two integers once scaled, to check the rounding.
+    for total, used in ((2, 1), (4, 1), (4, 3), (8, 1), (8, 5), (1, 0),
+                        (0, 0), (1, 5)):
+        for account_type in ('user', 'group', 'serviceAccount'):
+            records.append({
+                'account_type': account_type,
+                'account_permission_insights_category': 'SECURITY',
+                'account_used_permissions': used,
+                'account_total_permissions': total,
+            })
+    return records
+
+
+def main(args):
+    records = make_records(args.records)
+
+    scalar = [IAMRiskScoreModel(r).score() for r in records]
+    batch = IAMRiskScoreModel.score_batch(records)
+    assert scalar == batch, 'Scores differ'
+    assert all(type(v) is int for s in batch for v in s.values())
+    print('Scores are identical')
+
+    for name, func in (
+            ('score', lambda: [IAMRiskScoreModel(r).score()
+                               for r in records]),
+            ('score_batch', lambda: IAMRiskScoreModel.score_batch(records))):
+        seconds = timeit.timeit(func, number=1)
+        print('%-12s %8.2f us/record' % (name, seconds / len(records) * 1e6))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Benchmark scalar and batch risk scoring')
+    parser.add_argument('--records', '-n', type=int, default=100000,
+                        help='Number of records')
+    main(parser.parse_args())
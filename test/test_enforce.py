@@ -0,0 +1,294 @@
+"""Tests of the grouped enforcement of GCPIAMRecommendationProcessor.
+
+The Cloud Resource Manager and Recommender APIs are replaced with
+in-memory fakes, so these tests run offline.
+
+Usage:
+    python3 -m pytest test/test_enforce.py
+"""
+
+import copy
+import threading
+import unittest
+from unittest import mock
+
+import httplib2
+from googleapiclient import errors
+
+from CureIAM.plugins.gcp import util_gcp
+from CureIAM.plugins.gcp.gcpcloudiam import GCPIAMRecommendationProcessor
+from CureIAM.plugins.gcp.replaycloud import GCPReplayRecommendations
+
+
+def http_error(status):
+    return errors.HttpError(httplib2.Response({'status': status}), b'')
+
+
+class FakeRequest:
+
+    uri = 'fake'
+
+    def __init__(self, func):
+        self._func = func
+
+    def execute(self):
+        return self._func()
+
+
+class FakeCloudResourceManager:
+    """Holds IAM policies and fails setIamPolicy on demand."""
+
+    def __init__(self):
+        self.policies = {}
+        self.set_errors = {}
+        self.calls = {'getIamPolicy': 0, 'setIamPolicy': 0}
+
+    def projects(self):
+        return self
+
+    def getIamPolicy(self, resource, body):
+        def get():
+            self.calls['getIamPolicy'] += 1
+            return copy.deepcopy(self.policies.setdefault(
+                resource, {'version': 1, 'etag': 'BwE=', 'bindings': []}))
+        return FakeRequest(get)
+
+    def setIamPolicy(self, resource, body):
+        def set_():
+            self.calls['setIamPolicy'] += 1
+            statuses = self.set_errors.get(resource)
+            if statuses:
+                raise http_error(statuses.pop(0))
+            self.policies[resource] = body['policy']
+            return body['policy']
+        return FakeRequest(set_)
+
+
+class FakeRecommender:
+    """Records the names of the recommendations marked succeeded."""
+
+    def __init__(self):
+        self.marked = []
+        self._lock = threading.Lock()
+
+    def projects(self):
+        return self
+
+    def locations(self):
+        return self
+
+    def recommenders(self):
+        return self
+
+    def recommendations(self):
+        return self
+
+    def markSucceeded(self, body, name):
+        def mark():
+            with self._lock:
+                self.marked.append(name)
+            return {}
+        return FakeRequest(mark)
+
+
+class EnforcementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cloud = FakeCloudResourceManager()
+        self.recommender = FakeRecommender()
+        patches = [
+            mock.patch.object(util_gcp, 'build_resource',
+                              return_value=self.cloud),
+            mock.patch.object(util_gcp, 'get_resource',
+                              return_value=self.recommender),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # The project and account blocklists are left unset on purpose.
+        self.processor = GCPIAMRecommendationProcessor(
+            mode_scan=True, mode_enforce=True, enforcer={
+                'blocklist_account_types': [],
+                'allowlist_account_types': ['user', 'group',
+                                            'serviceAccount'],
+                'min_safe_to_apply_score_user': 0,
+                'min_safe_to_apply_score_group': 0,
+                'min_safe_to_apply_score_SA': 0,
+            })
+
+    def records(self, count=30, projects=3):
+        records = list(GCPReplayRecommendations(
+            count=count, projects=projects).read())
+        for record in records:
+            record['raw']['stateInfo']['state'] = 'ACTIVE'
+        return records
+
+    def run_processor(self, records, batch_size):
+        out = []
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            if batch_size == 1:
+                out.extend(self.processor.eval(batch[0]))
+            else:
+                out.extend(self.processor.eval_batch(batch))
+        held_back = len(records) - len(out)
+        flushed = list(self.processor.eval_flush())
+        self.assertEqual(len(flushed), held_back)
+        return out + flushed
+
+    def test_one_policy_update_per_project_across_batches(self):
+        for batch_size in (1, 4):
+            self.setUp()
+            out = self.run_processor(self.records(), batch_size)
+            self.assertEqual(len(out), 30)
+            self.assertEqual(self.cloud.calls,
+                             {'getIamPolicy': 3, 'setIamPolicy': 3})
+            stats = self.processor.done()
+            self.assertEqual(stats['recommendations_applied_today'], 30)
+            self.assertEqual(stats['recommendations_marked_succeeded'], 30)
+            self.assertEqual(len(self.recommender.marked), 30)
+
+    def test_full_groups_are_applied_before_the_end(self):
+        self.processor._enforce_group_size = 4
+        records = self.records()
+        out = []
+        for start in range(0, len(records), 5):
+            out.extend(self.processor.eval_batch(records[start:start + 5]))
+        # Each project has 10 records, so two groups of 4 per project
+        # are applied while evaluating and the rest at the end.
+        self.assertEqual(len(out), 24)
+        self.assertEqual(self.cloud.calls['setIamPolicy'], 6)
+        out.extend(self.processor.eval_flush())
+        self.assertEqual(len(out), 30)
+        self.assertEqual(self.cloud.calls['setIamPolicy'], 9)
+        self.processor.done()
+
+    def test_old_groups_are_applied_before_the_end(self):
+        self.processor._enforce_group_wait = 0
+        out = list(self.processor.eval_batch(self.records()))
+        self.assertEqual(len(out), 30)
+        self.assertEqual(list(self.processor.eval_flush()), [])
+        self.assertEqual(self.cloud.calls['setIamPolicy'], 3)
+        self.processor.done()
+
+    def test_conflicts_are_retried(self):
+        self.cloud.set_errors['project-00000'] = [409, 412]
+        out = self.run_processor(self.records(), 10)
+        applied = [r for r in out
+                   if r['raw']['stateInfo']['state'] == 'SUCCEEDED']
+        self.assertEqual(len(applied), 30)
+        self.assertEqual(self.cloud.calls['getIamPolicy'], 5)
+        self.processor.done()
+
+    def test_failed_project_is_not_applied(self):
+        # Too many conflicts for one project, a non-conflict error for
+        # another. The third project is applied regardless.
+        self.cloud.set_errors['project-00000'] = [409] * 4
+        self.cloud.set_errors['project-00001'] = [400, 409]
+        out = self.run_processor(self.records(), 10)
+        states = {}
+        for r in out:
+            states.setdefault(r['processor']['project'], set()).add(
+                r['raw']['stateInfo']['state'])
+        self.assertEqual(states, {'project-00000': {'ACTIVE'},
+                                  'project-00001': {'ACTIVE'},
+                                  'project-00002': {'SUCCEEDED'}})
+        self.assertEqual(self.cloud.set_errors['project-00001'], [409])
+        self.processor.done()
+
+    def test_failed_approval_loses_only_its_record(self):
+        records = self.records()
+        bad_name = records[4]['raw']['name']
+        validate = self.processor._enforce_recommendation
+
+        def enforce_recommendation(record):
+            if record['raw']['name'] == bad_name:
+                raise ValueError('bad record')
+            return validate(record)
+
+        self.processor._enforce_recommendation = enforce_recommendation
+        out = self.run_processor(records, 10)
+        self.assertEqual(len(out), 30)
+        states = {r['raw']['name']: r['raw']['stateInfo']['state']
+                  for r in out}
+        self.assertEqual(states.pop(bad_name), 'ACTIVE')
+        self.assertEqual(set(states.values()), {'SUCCEEDED'})
+        self.processor.done()
+
+    def test_malformed_record_is_counted_and_skipped(self):
+        for batch_size in (1, 4):
+            self.setUp()
+            records = self.records(count=8)
+            del records[2]['raw']['content']
+            for start in range(0, len(records), batch_size):
+                batch = records[start:start + batch_size]
+                if batch_size == 1:
+                    list(self.processor.eval(batch[0]))
+                else:
+                    list(self.processor.eval_batch(batch))
+            self.assertEqual(len(list(self.processor.eval_flush())), 7)
+            self.assertEqual(self.processor.done()['records_failed'], 1)
+
+
+class PolicyModificationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = GCPIAMRecommendationProcessor()
+
+    def test_remove_member_keeps_conditional_bindings(self):
+        condition = {'title': 'expires', 'expression': 'request.time < x'}
+        policy = {'bindings': [
+            {'role': 'roles/editor', 'members': ['user:a@x', 'user:b@x']},
+            {'role': 'roles/editor', 'members': ['user:a@x'],
+             'condition': condition},
+        ]}
+        self.processor.modify_policy_remove_member(
+            policy, 'roles/editor', 'user:a@x')
+        self.assertEqual(policy['bindings'], [
+            {'role': 'roles/editor', 'members': ['user:b@x']},
+            {'role': 'roles/editor', 'members': ['user:a@x'],
+             'condition': condition},
+        ])
+
+    def test_remove_member_drops_empty_bindings(self):
+        policy = {'bindings': [
+            {'role': 'roles/editor', 'members': ['user:a@x']},
+            {'role': 'roles/viewer', 'members': []},
+            {'role': 'roles/owner', 'members': ['user:o@x']},
+        ]}
+        self.processor.modify_policy_remove_member(
+            policy, 'roles/editor', 'user:a@x')
+        self.assertEqual(policy['bindings'], [
+            {'role': 'roles/owner', 'members': ['user:o@x']},
+        ])
+
+        # Removing a member that is already gone changes nothing.
+        self.processor.modify_policy_remove_member(
+            policy, 'roles/editor', 'user:a@x')
+        self.assertEqual(policy['bindings'], [
+            {'role': 'roles/owner', 'members': ['user:o@x']},
+        ])
+
+    def test_add_member_joins_unconditional_binding(self):
+        condition = {'title': 't', 'expression': 'e'}
+        policy = {'bindings': [
+            {'role': 'roles/viewer', 'members': ['user:c@x'],
+             'condition': condition},
+            {'role': 'roles/viewer', 'members': ['user:b@x']},
+        ]}
+        for _ in range(2):
+            self.processor.modify_policy_add_member(
+                policy, 'roles/viewer', 'user:a@x')
+        self.processor.modify_policy_add_member(
+            policy, 'roles/logging.viewer', 'user:a@x')
+        self.assertEqual(policy['bindings'], [
+            {'role': 'roles/viewer', 'members': ['user:c@x'],
+             'condition': condition},
+            {'role': 'roles/viewer', 'members': ['user:b@x', 'user:a@x']},
+            {'role': 'roles/logging.viewer', 'members': ['user:a@x']},
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()